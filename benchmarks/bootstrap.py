@@ -0,0 +1,109 @@
+"""Latency from starting a generated script to its first Python statement.
+
+Generates `gen` and `dist` scripts, with the lean and the legacy bootstrap
+header, whose first statement prints the time. Each script is started many
+times and the median delay between Popen() and that time is printed, in ms.
+This covers the shell reading the header, finding and starting the
+interpreter, and pysh loading and compiling the script (from its caches,
+which the first run warms).
+
+The legacy header pipes the bootstrap through echo and needs `set -o
+pipefail`, so it runs under a shell with both (bash with xpg_echo by default).
+
+Usage:
+  python benchmarks/bootstrap.py [--runs N] [--shell SHELL]
+                                 [--legacy-shell SHELL]
+"""
+
+from __future__ import print_function
+import argparse
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SCRIPT = 'import sys, time\nsys.stdout.write(repr(time.time()))\n'
+
+# (name, `pysh` arguments to generate it)
+VARIANTS = [
+  ('gen', ['gen']),
+  ('gen legacy', ['gen', '--legacy-bootstrap']),
+  ('dist', ['dist']),
+  ('dist legacy', ['dist', '--legacy-bootstrap']),
+]
+
+
+def _generate(argv, script, env):
+  with open(script, 'w') as script_f:
+    script_f.write(SCRIPT)
+  subprocess.check_call([sys.executable, '-m', 'pysh'] + argv + [script],
+                        env=env)
+
+
+def measure(shell, script, runs, env):
+  """Return the median latency in seconds, or raise RuntimeError."""
+  samples = []
+  # The first run warms the caches.
+  for _ in range(runs + 1):
+    start = time.time()
+    proc = subprocess.Popen(shell + [script], stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, env=env)
+    stdout, stderr = proc.communicate()
+    if proc.returncode != 0:
+      raise RuntimeError(stderr.decode('utf-8', 'replace').strip())
+    samples.append(float(stdout) - start)
+
+  samples = sorted(samples[1:])
+  return samples[len(samples) // 2]
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--runs', type=int, default=30)
+  parser.add_argument('--shell', default='/bin/sh',
+                      help='shell for the lean header (default: %(default)s)')
+  parser.add_argument('--legacy-shell', default='bash -O xpg_echo',
+                      help=('shell for the legacy header '
+                            '(default: %(default)s)'))
+  args = parser.parse_args()
+
+  temp_dir = tempfile.mkdtemp()
+  try:
+    env = dict(os.environ)
+    env['PYTHONPATH'] = REPO_ROOT
+    env['PYSH_CACHE_DIR'] = os.path.join(temp_dir, 'cache')
+    env.pop('PYSH_PYTHON', None)
+    # Put this interpreter first, for both headers to find.
+    env['PATH'] = os.pathsep.join(
+      [os.path.dirname(sys.executable), env.get('PATH', '')])
+
+    status = 0
+    for name, argv in VARIANTS:
+      script = os.path.join(temp_dir, name.replace(' ', '-') + '.sh')
+      _generate(argv, script, env)
+      shell = shlex.split(
+        args.legacy_shell if 'legacy' in name else args.shell)
+      run_env = env
+      if name.startswith('dist'):
+        # As on a system without pysh.
+        run_env = dict(env)
+        del run_env['PYTHONPATH']
+      try:
+        latency = measure(shell, script, args.runs, run_env)
+      except RuntimeError as e:
+        print('{:12s} failed: {}'.format(name, e))
+        status = 1
+        continue
+      print('{:12s} {:8.1f} ms'.format(name, latency * 1e3))
+    return status
+  finally:
+    shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+  sys.exit(main())
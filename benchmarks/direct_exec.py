@@ -0,0 +1,48 @@
+"""Cost of running a trivial command with and without /bin/sh.
+
+Runs `!true` many times through the pysh runtime, once exec'ing it directly
+and once through the shell, and prints the mean time per command. Note that
+shells such as dash have `true` built in, so the shell path only pays for
+starting /bin/sh; try `--command uname` to include the extra exec an external
+program costs.
+
+Usage:
+  python benchmarks/direct_exec.py [--count N] [--command CMD]
+"""
+
+from __future__ import print_function
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pysh import runtime
+
+
+def measure(command, count, direct):
+  runtime.DIRECT_EXEC = direct
+  stub = runtime.get_ipython()
+  start = time.time()
+  for _ in range(count):
+    stub.system(command)
+  return (time.time() - start) / count
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--count', type=int, default=10000)
+  parser.add_argument('--command', default='true')
+  args = parser.parse_args()
+
+  shell_s = measure(args.command, args.count, direct=False)
+  direct_s = measure(args.command, args.count, direct=True)
+  print('shell   {:8.1f} us/command'.format(shell_s * 1e6))
+  print('direct  {:8.1f} us/command  ({:.2f}x)'.format(
+    direct_s * 1e6, shell_s / direct_s))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
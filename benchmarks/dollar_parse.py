@@ -0,0 +1,62 @@
+"""Cost of finding $foo fields in long commands.
+
+Parses 100KB commands with DollarFormatter, the way `!psql -c '...'` with a
+large quoted payload would be, and prints the time per parse. With
+--compare, also times the lookahead regex the parser used before, which
+rescans the rest of the command after every $; at 100KB that takes over a minute.
+
+Usage:
+  python benchmarks/dollar_parse.py [--size BYTES] [--count N] [--compare]
+"""
+
+from __future__ import print_function
+import argparse
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pysh.ipython import text
+
+_OLD_PATTERN = re.compile(r"(.*?)\$(\$?[\w\.]+)(?=([^']*'[^']*')*[^']*$)")
+
+
+def make_commands(size):
+  row = "('$name', $value, 'it''s $$5'), "
+  sql = (row * (size // len(row) + 1))[:size]
+  return {
+    'quoted sql': "psql -c 'insert into t values {}'".format(sql),
+    'dollars': ' '.join(['$x'] * (size // 3)),
+    'no dollars': 'x' * size,
+  }
+
+
+def measure(parse, command, count):
+  start = time.time()
+  for _ in range(count):
+    list(parse(command))
+  return (time.time() - start) / count
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--size', type=int, default=100 * 1024)
+  parser.add_argument('--count', type=int, default=20)
+  parser.add_argument('--compare', action='store_true')
+  args = parser.parse_args()
+
+  formatter = text.DollarFormatter()
+  for name, command in sorted(make_commands(args.size).items()):
+    new_s = measure(formatter.parse, command, args.count)
+    line = '{:12} {:10.2f} ms/parse'.format(name, new_s * 1e3)
+    if args.compare:
+      old_s = measure(_OLD_PATTERN.finditer, command, 1)
+      line += '  (regex {:.2f} ms)'.format(old_s * 1e3)
+    print(line)
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
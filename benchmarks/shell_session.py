@@ -0,0 +1,60 @@
+"""Throughput of tiny commands, with and without a shell session.
+
+Runs the same small command many times: with Popen(shell=True), through the
+pysh runtime (which execs simple commands directly), and through the runtime
+within a shell_session(), and prints the mean time per command.
+
+Usage:
+  python benchmarks/shell_session.py [--count N] [--command CMD]
+"""
+
+from __future__ import print_function
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pysh import runtime
+
+
+def measure(run, count):
+  start = time.time()
+  for _ in range(count):
+    run()
+  return (time.time() - start) / count
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--count', type=int, default=2000)
+  parser.add_argument('--command', default='test -f /etc/passwd')
+  args = parser.parse_args()
+
+  stub = runtime.get_ipython()
+  command = args.command
+
+  popen_s = measure(
+    lambda: subprocess.Popen(command, shell=True).wait(), args.count)
+  print('Popen(shell=True) {:8.1f} us/command'.format(popen_s * 1e6))
+
+  runtime_s = measure(lambda: stub.system(command, expand=False), args.count)
+  print('runtime           {:8.1f} us/command  ({:.2f}x)'.format(
+    runtime_s * 1e6, popen_s / runtime_s))
+
+  with runtime.shell_session():
+    session_s = measure(lambda: stub.system(command, expand=False),
+                        args.count)
+    capture_s = measure(lambda: stub.getoutput(command, expand=False),
+                        args.count)
+  print('shell_session     {:8.1f} us/command  ({:.2f}x)'.format(
+    session_s * 1e6, popen_s / session_s))
+  print('  captured        {:8.1f} us/command  ({:.2f}x)'.format(
+    capture_s * 1e6, popen_s / capture_s))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,128 @@
+"""Import-time budget for `python -m pysh` subcommands.
+
+Each scenario runs a pysh subcommand under `python -X importtime` and adds up
+the self time of every module it imports that a bare interpreter doesn't. The
+fastest of several runs is compared against startup_budget.json, and the
+benchmark exits non-zero when a scenario goes over its budget.
+
+Usage:
+  python benchmarks/startup.py            # check against the budget
+  python benchmarks/startup.py --record   # re-record the budget
+"""
+
+from __future__ import print_function
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUDGET_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'startup_budget.json')
+
+SCRIPT = 'import sys\n!true\nsys.exit(0)\n'
+
+# name -> (argv after `-m pysh`, whether the script is regenerated first)
+SCENARIOS = {
+  'gen': (['gen', '{script}'], True),
+  'dist': (['dist', '{script}'], True),
+  'compile': (['compile', '{script}', '-o', '{script}.py'], False),
+  'run': (['run', '{script}'], False),
+  'run-no-cache': (['run', '--no-cache', '{script}'], False),
+}
+
+
+def _parse_importtime(stderr):
+  """Return {module: self time in us} from -X importtime output."""
+  times = {}
+  for line in stderr.decode('utf-8', 'replace').splitlines():
+    if not line.startswith('import time:'):
+      continue
+    fields = line[len('import time:'):].split('|')
+    if len(fields) != 3 or not fields[0].strip().isdigit():
+      continue
+    times[fields[2].strip()] = int(fields[0])
+  return times
+
+
+def _importtime(argv, env, cwd):
+  # Run outside the repo so `-m pysh` imports the tree on PYTHONPATH.
+  proc = subprocess.Popen([sys.executable, '-X', 'importtime'] + argv,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          env=env, cwd=cwd)
+  _, stderr = proc.communicate()
+  if proc.returncode != 0:
+    raise RuntimeError('{} failed:\n{}'.format(argv, stderr.decode('utf-8')))
+  return _parse_importtime(stderr)
+
+
+def measure(name, runs, env, temp_dir):
+  argv, regenerate = SCENARIOS[name]
+  script = os.path.join(temp_dir, '{}.pysh'.format(name))
+  baseline = set(_importtime(['-c', 'pass'], env, temp_dir))
+  samples = []
+  # The first run warms __pycache__ and the pysh bytecode cache.
+  for _ in range(runs + 1):
+    if regenerate or not os.path.exists(script):
+      with open(script, 'w') as script_f:
+        script_f.write(SCRIPT)
+    times = _importtime(
+      ['-m', 'pysh'] + [a.format(script=script) for a in argv], env,
+      temp_dir)
+    samples.append(sum(t for m, t in times.items() if m not in baseline))
+
+  # The minimum is the least noisy estimate of the inherent cost.
+  return min(samples[1:])
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+  parser.add_argument('--record', action='store_true',
+                      help='write the measured times as the new budget')
+  parser.add_argument('--runs', type=int, default=7)
+  parser.add_argument('scenarios', nargs='*', default=sorted(SCENARIOS))
+  args = parser.parse_args()
+
+  with open(BUDGET_PATH) as budget_f:
+    budget = json.load(budget_f)
+
+  env = dict(os.environ)
+  # Measure the common case, where pysh's own modules load from __pycache__.
+  env.pop('PYTHONDONTWRITEBYTECODE', None)
+  env['PYTHONPATH'] = os.pathsep.join(
+    [REPO_ROOT] + [p for p in [env.get('PYTHONPATH')] if p])
+  temp_dir = tempfile.mkdtemp()
+  env['PYSH_CACHE_DIR'] = os.path.join(temp_dir, 'cache')
+  failed = []
+  try:
+    for name in args.scenarios:
+      us = measure(name, args.runs, env, temp_dir)
+      limit = budget['budget_us'].get(name)
+      if args.record:
+        budget['budget_us'][name] = us
+        status = 'recorded'
+      elif limit is None:
+        status = 'no budget'
+      elif us > limit * budget['tolerance']:
+        status = 'OVER BUDGET ({} us allowed)'.format(
+          int(limit * budget['tolerance']))
+        failed.append(name)
+      else:
+        status = 'ok'
+      print('{:14s} {:7d} us  {}'.format(name, us, status))
+  finally:
+    shutil.rmtree(temp_dir)
+
+  if args.record:
+    with open(BUDGET_PATH, 'w') as budget_f:
+      json.dump(budget, budget_f, indent=2, sort_keys=True)
+      budget_f.write('\n')
+
+  return 1 if failed else 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -1 +1,32 @@
-from .pysh import main, CalledProcessError
+__version__ = '0.0.1'
+
+from .errors import CalledProcessError
+
+
+def main(script, use_cache=True):
+  """Run the pysh script at the given path."""
+  # Imported here so that `import pysh` doesn't load the runtime.
+  from . import pysh
+  pysh.main(script, use_cache=use_cache)
+
+
+def wait_all(jobs=None):
+  """Wait for background jobs started with `!cmd &`; see runtime.wait_all()."""
+  from . import runtime
+  return runtime.wait_all(jobs)
+
+
+def pmap(template, jobs=None, fail_fast=True, **iterables):
+  """Run a command template over iterables in parallel; see runtime.pmap()."""
+  import sys
+  from . import runtime
+  frame = sys._getframe(1)
+  return runtime.map_commands(
+    template, frame.f_locals, iterables, jobs=jobs, fail_fast=fail_fast,
+    location=(frame.f_code.co_filename, frame.f_lineno))
+
+
+def shell_session():
+  """Run commands in one long-lived /bin/sh; see runtime.shell_session()."""
+  from . import runtime
+  return runtime.shell_session()
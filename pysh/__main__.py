@@ -4,8 +4,6 @@ import argparse
 import os
 import os.path
 import sys
-from . import generator
-from . import pysh
 
 USAGE = """\
 PySH extends Python scripts just enough such that it's easy to run bash scripts.
@@ -18,6 +16,17 @@ incantation in the script header installs pip and pysh if needed.
 """
 
 
+def _positive_int(value):
+  try:
+    number = int(value)
+  except ValueError:
+    number = 0
+  if number < 1:
+    raise argparse.ArgumentTypeError(
+      'must be a positive integer, not {!r}'.format(value))
+  return number
+
+
 def parse_args(argv=None):
   parser = argparse.ArgumentParser(usage=USAGE)
   subparsers = parser.add_subparsers(dest='subcommand')
@@ -26,41 +35,157 @@ def parse_args(argv=None):
     'dist',
     help=('add header and a copy of pysh module to a pysh script, for '
           'standalone distribution to systems without pysh'))
-  dist.add_argument('script_path', help='path to the script')
-
   gen = subparsers.add_parser('gen', help='add header to pysh script')
-  gen.add_argument('script_path', help='path to the script')
+  for sub in (dist, gen):
+    sub.add_argument(
+      '--legacy-bootstrap', action='store_true',
+      help=('write the older header, which pipes the bootstrap through echo; '
+            'it needs a shell whose echo expands \\n, such as dash'))
+    sub.add_argument(
+      '-j', '--jobs', type=_positive_int,
+      help='processes to generate scripts with (default: number of CPUs)')
+    sub.add_argument(
+      'script_paths', nargs='+', metavar='script_path',
+      help=('path to a script, or a directory to search for scripts generated '
+            'before and *.pysh files; scripts already up to date are skipped; '
+            '- reads stdin and writes stdout'))
+
+  compile_ = subparsers.add_parser(
+    'compile',
+    help=('transform a pysh script into a standalone Python (.py) or bytecode '
+          '(.pyc) file which only needs the pysh runtime'))
+  compile_.add_argument('script_path', help='path to the script')
+  compile_.add_argument(
+    '-o', '--output', dest='output_path',
+    help=('output path; a .pyc extension writes bytecode (default: script '
+          'path with a .py extension)'))
+
+  forkserver = subparsers.add_parser(
+    'forkserver',
+    help=('serve runs of generated scripts from a warm, preloaded process; '
+          'scripts use it when PYSH_FORKSERVER_SOCKET names its socket'))
+  forkserver.add_argument(
+    '--socket', dest='socket_path',
+    help='socket to listen on (default: $PYSH_FORKSERVER_SOCKET)')
+  forkserver.add_argument(
+    '--preload', action='append', default=[], metavar='MODULE',
+    help='also import MODULE before serving; may be repeated')
 
   run = subparsers.add_parser('run', help='run a pysh script')
+  run.add_argument('--no-cache', action='store_true',
+                   help=('don\'t read or write the compiled script cache '
+                         '(also disabled by setting PYSH_NO_CACHE)'))
+  run.add_argument('--trace', metavar='FILE',
+                   help=('record each command the script runs to FILE: a '
+                         'Chrome trace if it ends with .json, JSON lines '
+                         'otherwise (also enabled by setting PYSH_TRACE)'))
+  run.add_argument('--profile', action='store_true',
+                   help=('sample the script as it runs, and print the time '
+                         'spent on each of its lines to stderr'))
+  run.add_argument('--profile-collapsed', metavar='FILE',
+                   help=('with --profile, also write collapsed stacks for '
+                         'flame graphs to FILE'))
+  run.add_argument('--profile-pstats', metavar='FILE',
+                   help=('with --profile, also run cProfile and write its '
+                         'stats to FILE'))
   run.add_argument('script_path', help='path to the script')
   run.add_argument('args', nargs='*')
 
   argv = argv if argv is not None else sys.argv[1:]
-  if argv and argv[0] not in ('run', 'gen') and os.path.exists(argv[0]):
+  commands = ('run', 'gen', 'dist', 'compile', 'forkserver')
+  if argv and argv[0] not in commands and os.path.exists(argv[0]):
     argv.insert(0, 'run')
   elif not argv:
     argv = ['--help']
 
-  return parser.parse_args(argv)
+  args = parser.parse_args(argv)
+  if (args.subcommand in ('gen', 'dist') and '-' in args.script_paths and
+      len(args.script_paths) > 1):
+    subparsers.choices[args.subcommand].error(
+      "- (stdin) can't be combined with other paths")
+  return args
+
 
+# Each command imports only the modules it needs, to keep startup fast.
 
 def _GenCommand(args):
-  generator.generate(args.script_path, dist=False)
+  _generate(args, dist=False)
 
 
 def _DistCommand(args):
-  generator.generate(args.script_path, dist=True)
+  _generate(args, dist=True)
+
+
+def _generate(args, dist):
+  from . import generator
+  if args.script_paths == ['-']:
+    generator.generate('-', dist=dist, legacy_bootstrap=args.legacy_bootstrap)
+    return
+
+  results = generator.generate_all(
+    args.script_paths, dist=dist, legacy_bootstrap=args.legacy_bootstrap,
+    jobs=args.jobs)
+  errors = [(path, error) for path, _, error in results if error is not None]
+  for path, error in errors:
+    sys.stderr.write('pysh: {}: {}\n'.format(path, error))
+  if len(results) > 1:
+    sys.stderr.write('pysh: {} of {} scripts updated\n'.format(
+      sum(1 for _, changed, _ in results if changed), len(results)))
+  if errors:
+    sys.exit(1)
+
+
+def _CompileCommand(args):
+  from . import compiler
+  output_path = args.output_path
+  if output_path is None:
+    output_path = '{}.py'.format(os.path.splitext(args.script_path)[0])
+    if output_path == args.script_path:
+      sys.exit('pysh: {} already has a .py extension; pass --output'.format(
+        args.script_path))
+
+  compiler.compile_script(args.script_path, output_path)
 
 
 def _RunCommand(args):
+  from . import pysh
+  if args.trace:
+    from . import runtime
+    runtime.start_tracing(args.trace)
+  profiler = None
+  if args.profile:
+    from . import profiler as profiler_
+    profiler = profiler_.Profiler(
+      args.script_path, collapsed_path=args.profile_collapsed,
+      pstats_path=args.profile_pstats)
+  elif args.profile_collapsed or args.profile_pstats:
+    sys.exit('pysh: --profile-collapsed and --profile-pstats need --profile')
   sys.argv = [args.script_path] + args.args
-  pysh.main(args.script_path)
+  pysh.main(args.script_path, use_cache=not args.no_cache, profiler=profiler)
+
+
+def _ForkServerCommand(args):
+  from . import forkserver
+  socket_path = args.socket_path or forkserver.socket_path_from_env()
+  if not socket_path:
+    sys.exit('pysh: pass --socket or set {}'.format(forkserver.SOCKET_ENV_VAR))
+
+  try:
+    argv = forkserver.serve(
+      socket_path, forkserver.DEFAULT_PRELOAD + tuple(args.preload))
+  except KeyboardInterrupt:
+    return
+
+  # Only the forked process which runs a script gets here.
+  forkserver.run_script(argv)
 
 
 COMMAND_MAP = {
   'gen': _GenCommand,
   'dist': _DistCommand,
+  'compile': _CompileCommand,
   'run': _RunCommand,
+  'forkserver': _ForkServerCommand,
 }
 
 
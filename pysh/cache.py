@@ -0,0 +1,166 @@
+"""On-disk cache of compiled pysh scripts.
+
+This plays the same role as ``__pycache__`` does for regular modules: the code
+object produced by transforming and compiling a script is marshalled to disk,
+so that running an unchanged script again skips the input transformer and
+``compile()`` entirely.
+
+Entries live in one file per (script, interpreter) pair. Each entry records a
+key made of the script content, the path it was compiled with, the pysh
+version and the interpreter magic number; an entry whose key no longer matches
+is stale and gets overwritten by the next store. The key is stored and compared
+in full rather than hashed, which keeps hashlib off the startup path.
+"""
+
+import marshal
+import os
+import struct
+import sys
+import time
+import zlib
+
+try:
+  from importlib.util import MAGIC_NUMBER
+except ImportError:
+  import imp
+  MAGIC_NUMBER = imp.get_magic()
+
+from . import __version__
+
+
+# Set to any non-empty value to disable the cache.
+DISABLE_ENV_VAR = 'PYSH_NO_CACHE'
+
+# Overrides the cache root directory.
+DIR_ENV_VAR = 'PYSH_CACHE_DIR'
+
+# Entries not rewritten for this long are removed when the cache is pruned.
+MAX_ENTRY_AGE_SECONDS = 30 * 24 * 60 * 60
+
+_LENGTH = struct.Struct('<I')
+
+
+def is_enabled():
+  return not os.environ.get(DISABLE_ENV_VAR)
+
+
+def cache_root():
+  """Return the root directory of the user's pysh cache."""
+  root = os.environ.get(DIR_ENV_VAR)
+  if root:
+    return root
+
+  root = os.environ.get('XDG_CACHE_HOME')
+  if not root:
+    root = os.path.join(os.path.expanduser('~'), '.cache')
+
+  return os.path.join(root, 'pysh')
+
+
+def _to_bytes(s):
+  if isinstance(s, bytes):
+    return s
+  return s.encode('utf-8')
+
+
+class BytecodeCache(object):
+  """Stores marshalled code objects for pysh scripts."""
+
+  def __init__(self, directory=None):
+    self.directory = directory or os.path.join(cache_root(), 'bytecode')
+
+  @staticmethod
+  def make_key(source, filename, options=()):
+    """Compute the cache key for a script.
+
+    Args:
+      source: the script text.
+      filename: the filename the code object is compiled with.
+      options: strings describing any transformer settings that influence the
+        generated code.
+    """
+    parts = []
+    for part in [__version__, MAGIC_NUMBER, filename] + list(options):
+      part = _to_bytes(part)
+      parts.append(_LENGTH.pack(len(part)))
+      parts.append(part)
+
+    parts.append(_to_bytes(source))
+    return b''.join(parts)
+
+  def entry_path(self, script_path):
+    script_path = os.path.abspath(script_path)
+    slot = '{}-{:08x}'.format(
+      os.path.basename(script_path),
+      zlib.crc32(_to_bytes(script_path)) & 0xffffffff)
+    tag = getattr(getattr(sys, 'implementation', None), 'cache_tag', None)
+    if tag is None:
+      tag = 'py{}{}'.format(*sys.version_info[:2])
+
+    return os.path.join(self.directory, '{}.{}.pyshc'.format(slot, tag))
+
+  def load(self, script_path, key):
+    """Return the cached code object for script_path, or None on a miss."""
+    try:
+      with open(self.entry_path(script_path), 'rb') as entry_f:
+        data = entry_f.read()
+    except (IOError, OSError):
+      return None
+
+    header_size = len(MAGIC_NUMBER) + _LENGTH.size
+    if (data[:len(MAGIC_NUMBER)] != MAGIC_NUMBER or
+        data[len(MAGIC_NUMBER):header_size] != _LENGTH.pack(len(key)) or
+        data[header_size:header_size + len(key)] != key):
+      return None
+
+    try:
+      return marshal.loads(data[header_size + len(key):])
+    except (EOFError, ValueError, TypeError):
+      return None
+
+  def store(self, script_path, key, code):
+    """Atomically write code to the cache. Failures are silently ignored."""
+    import tempfile
+
+    path = self.entry_path(script_path)
+    try:
+      if not os.path.isdir(self.directory):
+        os.makedirs(self.directory)
+
+      fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+    except (IOError, OSError):
+      return
+
+    try:
+      with os.fdopen(fd, 'wb') as tmp_f:
+        tmp_f.write(MAGIC_NUMBER)
+        tmp_f.write(_LENGTH.pack(len(key)))
+        tmp_f.write(key)
+        tmp_f.write(marshal.dumps(code))
+
+      os.rename(tmp_path, path)
+    except (IOError, OSError):
+      try:
+        os.unlink(tmp_path)
+      except OSError:
+        pass
+
+      return
+
+    self.prune()
+
+  def prune(self, max_age=MAX_ENTRY_AGE_SECONDS):
+    """Remove entries (and abandoned temp files) older than max_age."""
+    cutoff = time.time() - max_age
+    try:
+      names = os.listdir(self.directory)
+    except OSError:
+      return
+
+    for name in names:
+      path = os.path.join(self.directory, name)
+      try:
+        if os.stat(path).st_mtime < cutoff:
+          os.unlink(path)
+      except OSError:
+        pass
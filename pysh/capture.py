@@ -0,0 +1,331 @@
+"""Ways of holding the captured output of a command, other than as text.
+
+getoutput() decodes output as UTF-8 by default. Scripts which only hash it,
+write it elsewhere or parse it as binary can skip that with a capture mode:
+  'bytes': the output as bytes, as read from the pipe.
+  'bytearray': the output read with readinto() into a preallocated buffer which
+    grows as needed, rather than joined from chunks.
+  'mmap': the command writes straight to an unlinked temporary file, which is
+    then mapped into memory if it is at least MMAP_THRESHOLD bytes, or read if
+    it's smaller. See MappedOutput.
+  'bounded': only the head and tail of the output are kept in memory, and the
+    rest goes to a temporary file. See BoundedOutput.
+Each of them can still be decoded when needed, with .decode().
+
+capture='both' captures stderr as well as stdout, as an Output; see
+read_streams().
+"""
+
+import codecs
+import collections
+import io
+import mmap
+import os
+
+
+# Outputs at least this large are mapped rather than read into memory.
+MMAP_THRESHOLD = 256 * 1024
+
+# The initial size of a 'bytearray' capture buffer; it doubles when full.
+BYTEARRAY_INITIAL_SIZE = 64 * 1024
+
+
+def read_bytearray(stream, initial_size=BYTEARRAY_INITIAL_SIZE):
+  """Read all of a binary stream into a bytearray, with readinto()."""
+  buf = bytearray(initial_size)
+  size = 0
+  while True:
+    if size == len(buf):
+      buf.extend(bytes(len(buf)))
+    with memoryview(buf) as view:
+      count = stream.readinto(view[size:])
+    if not count:
+      break
+    size += count
+
+  del buf[size:]
+  return buf
+
+
+class MappedOutput(object):
+  """The output of a command, captured to a temporary file.
+
+  Large outputs are memory-mapped, so they are paged in from the page cache
+  as they are used instead of being copied into the process. The object
+  supports len(), indexing and slicing (which return bytes), bytes(), and
+  buffer access through .buffer, e.g. for hashlib or struct.unpack_from().
+
+  Attributes:
+    mapped: whether the output is memory-mapped, rather than held as bytes.
+  """
+
+  def __init__(self, output_file, threshold=MMAP_THRESHOLD):
+    """Take ownership of output_file, which holds the whole output."""
+    size = os.fstat(output_file.fileno()).st_size
+    self.mapped = size >= threshold and size > 0
+    if self.mapped:
+      self._data = mmap.mmap(output_file.fileno(), size,
+                             access=mmap.ACCESS_READ)
+    else:
+      output_file.seek(0)
+      self._data = output_file.read()
+    # The mapping keeps its own reference to the file.
+    output_file.close()
+
+  @property
+  def buffer(self):
+    """A memoryview of the output, without copying it."""
+    return memoryview(self._data)
+
+  def decode(self, encoding='utf-8', errors='strict'):
+    return codecs.decode(self._data, encoding, errors)
+
+  def __len__(self):
+    return len(self._data)
+
+  def __getitem__(self, index):
+    return self._data[index]
+
+  def __bytes__(self):
+    return self._data[:]
+
+  def close(self):
+    """Unmap the output. Views of .buffer must have been released."""
+    if self.mapped:
+      self._data.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+  def __repr__(self):
+    return '<MappedOutput {} bytes{}>'.format(
+      len(self), ', mapped' if self.mapped else '')
+
+
+# Set to the number of bytes a 'bounded' capture keeps in memory at each end of
+# the output, e.g. 65536, 64K or 1M.
+LIMIT_ENV_VAR = 'PYSH_CAPTURE_LIMIT'
+
+DEFAULT_LIMIT = 64 * 1024
+
+_SIZE_SUFFIXES = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+
+_READ_SIZE = 64 * 1024
+
+
+def capture_limit():
+  """The limit of 'bounded' captures, from $PYSH_CAPTURE_LIMIT."""
+  value = os.environ.get(LIMIT_ENV_VAR, '').strip().upper()
+  if not value:
+    return DEFAULT_LIMIT
+
+  multiplier = _SIZE_SUFFIXES.get(value[-1], 1)
+  if value[-1] in _SIZE_SUFFIXES:
+    value = value[:-1]
+  try:
+    return int(value) * multiplier
+  except ValueError:
+    raise ValueError('{} must be a size such as 65536 or 64K, not {!r}'.format(
+      LIMIT_ENV_VAR, os.environ[LIMIT_ENV_VAR]))
+
+
+def read_bounded(stream, limit=None):
+  """Read all of a binary stream, holding at most 2 * limit bytes in memory.
+
+  The first limit bytes are kept as the head. Of the rest, the last limit bytes
+  are kept as the tail; if there is more than that, everything after the head
+  is also spilled to an unlinked temporary file, so the whole output can still
+  be read back.
+
+  Returns:
+    A BoundedOutput.
+  """
+  import tempfile
+  if limit is None:
+    limit = capture_limit()
+
+  fd = stream.fileno()
+  head = bytearray()
+  tail = bytearray()
+  spill = None
+  size = 0
+  try:
+    while True:
+      chunk = os.read(fd, _READ_SIZE)
+      if not chunk:
+        break
+      size += len(chunk)
+
+      if len(head) < limit:
+        taken = limit - len(head)
+        head += chunk[:taken]
+        chunk = chunk[taken:]
+        if not chunk:
+          continue
+
+      tail += chunk
+      if len(tail) > limit:
+        if spill is None:
+          spill = tempfile.TemporaryFile()
+          spill.write(tail)
+        else:
+          spill.write(chunk)
+        del tail[:len(tail) - limit]
+  except BaseException:
+    if spill is not None:
+      spill.close()
+    raise
+
+  return BoundedOutput(bytes(head), bytes(tail), size, spill)
+
+
+class BoundedOutput(object):
+  """Output captured with at most its head and tail in memory.
+
+  Attributes:
+    head: the first bytes of the output, up to the capture limit.
+    tail: the last bytes after the head, up to the capture limit.
+    size: the size of the whole output.
+    truncated: whether head and tail leave out part of the output; the whole
+      output is then in a temporary file until close().
+  """
+
+  def __init__(self, head, tail, size, spill=None):
+    self.head = head
+    self.tail = tail
+    self.size = size
+    self.truncated = spill is not None
+    self._spill = spill
+
+  def preview(self, encoding='utf-8'):
+    """The head and tail as text, with a note of how much was left out."""
+    text = self.head.decode(encoding, 'replace')
+    omitted = self.size - len(self.head) - len(self.tail)
+    if omitted:
+      text += '\n[... {} bytes omitted ...]\n'.format(omitted)
+    return text + self.tail.decode(encoding, 'replace')
+
+  def open(self, encoding=None):
+    """Return a file object which reads the whole output from the start.
+
+    It reads bytes, or text if an encoding is given.
+    """
+    if self.truncated and self._spill is None:
+      raise ValueError('the output was closed')
+
+    reader = io.BufferedReader(_BoundedReader(self))
+    if encoding is None:
+      return reader
+    return io.TextIOWrapper(reader, encoding=encoding)
+
+  def read(self):
+    """Return the whole output as bytes."""
+    with self.open() as output_f:
+      return output_f.read()
+
+  def decode(self, encoding='utf-8', errors='strict'):
+    """Return the whole output as text."""
+    return self.read().decode(encoding, errors)
+
+  def __len__(self):
+    return self.size
+
+  def __str__(self):
+    return self.preview()
+
+  def close(self):
+    """Remove the temporary file, if any; only head and tail remain."""
+    if self._spill is not None:
+      self._spill.close()
+      self._spill = None
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+  def __repr__(self):
+    return '<BoundedOutput {} bytes{}>'.format(
+      self.size, ', truncated' if self.truncated else '')
+
+
+class _BoundedReader(io.RawIOBase):
+  # Reads the head, then either the spilled rest or the tail.
+
+  def __init__(self, output):
+    self._output = output
+    self._pos = 0
+
+  def readable(self):
+    return True
+
+  def readinto(self, buf):
+    head = self._output.head
+    if self._pos < len(head):
+      data = head[self._pos:self._pos + len(buf)]
+    elif self._output.truncated:
+      spill = self._output._spill
+      spill.seek(self._pos - len(head))
+      data = spill.read(len(buf))
+    else:
+      start = self._pos - len(head)
+      data = self._output.tail[start:start + len(buf)]
+
+    buf[:len(data)] = data
+    self._pos += len(data)
+    return len(data)
+
+
+Output = collections.namedtuple('Output', ('stdout', 'stderr'))
+Output.__doc__ = "The stdout and stderr of a command, from capture='both'."
+
+
+def read_streams(stdout, stderr=None, tee=False):
+  """Read binary pipes until they're all closed, without threads.
+
+  A selector reads whichever pipe has data, so a command filling one pipe
+  while pysh waits on the other can't deadlock.
+
+  Args:
+    stdout, stderr: the pipes; stderr may be None.
+    tee: if true, also forward everything read as it arrives, to this
+      process's stdout (fd 1) or stderr (fd 2) respectively.
+
+  Returns:
+    (stdout data, stderr data) as bytearrays; the latter is None without a
+    stderr pipe.
+  """
+  import selectors
+  outputs = {}
+  tee_fds = {}
+  selector = selectors.DefaultSelector()
+  for stream, tee_fd in ((stdout, 1), (stderr, 2)):
+    if stream is not None:
+      outputs[stream.fileno()] = bytearray()
+      tee_fds[stream.fileno()] = tee_fd
+      selector.register(stream.fileno(), selectors.EVENT_READ)
+
+  try:
+    while selector.get_map():
+      for key, _ in selector.select():
+        chunk = os.read(key.fd, _READ_SIZE)
+        if not chunk:
+          selector.unregister(key.fd)
+          continue
+        outputs[key.fd] += chunk
+        if tee:
+          _write_all(tee_fds[key.fd], chunk)
+  finally:
+    selector.close()
+
+  return (outputs[stdout.fileno()],
+          outputs[stderr.fileno()] if stderr is not None else None)
+
+
+def _write_all(fd, data):
+  while data:
+    data = data[os.write(fd, data):]
@@ -0,0 +1,30 @@
+"""Helpers which differ between Python 2 and 3.
+
+Kept separate so that both the generator and the runtime can import them
+cheaply.
+"""
+
+import fcntl
+import os
+
+
+def cpu_count():
+  """The number of CPUs, importing multiprocessing only on Python 2."""
+  try:
+    return os.cpu_count() or 1
+  except AttributeError:
+    import multiprocessing
+    return multiprocessing.cpu_count()
+
+
+def pipe():
+  """os.pipe(), with both ends closed on exec as on Python 3 (PEP 446).
+
+  On Python 2 they would otherwise be inherited by every child, which keeps
+  e.g. a pipe's write end open in the command reading from it.
+  """
+  fds = os.pipe()
+  for fd in fds:
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+  return fds
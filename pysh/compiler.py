@@ -0,0 +1,119 @@
+"""Ahead-of-time compilation of pysh scripts into plain Python.
+
+The output only imports ``pysh.runtime``, so running it doesn't load the
+input transformer at all.
+"""
+
+import ast
+import marshal
+import os
+import struct
+import sys
+
+try:
+  import importlib.util
+  MAGIC_NUMBER = importlib.util.MAGIC_NUMBER
+except (ImportError, AttributeError):
+  import imp
+  MAGIC_NUMBER = imp.get_magic()
+
+
+RUNTIME_IMPORT = 'from pysh.runtime import get_ipython'
+
+COMPILED_HEADER = """\
+#!/usr/bin/env python3
+# Generated by `pysh compile` from {script_path}. Do not edit.
+"""
+
+
+def transform(script_text):
+  """Return the plain Python equivalent of a pysh script."""
+  from . import runtime
+  from .ipython import inputtransformer2
+  manager = inputtransformer2.TransformerManager(
+    compile_time_expansion=runtime.compile_time_expansion())
+  return manager.transform_cell(script_text)
+
+
+def _runtime_import_index(tree):
+  """Index of the first statement which may run before the runtime import.
+
+  The import has to follow the module docstring and any __future__ imports.
+  """
+  for i, node in enumerate(tree.body):
+    if i == 0 and ast.get_docstring(tree) is not None:
+      continue
+
+    if isinstance(node, ast.ImportFrom) and node.module == '__future__':
+      continue
+
+    return i
+
+  return len(tree.body)
+
+
+def compile_to_source(script_text, script_path):
+  """Return standalone Python source for a pysh script."""
+  transformed = transform(script_text)
+  lines = transformed.split('\n')
+  tree = ast.parse(transformed)
+  index = _runtime_import_index(tree)
+  if index < len(tree.body):
+    node = tree.body[index]
+    insert_at = min([node.lineno] + [d.lineno for d in getattr(
+      node, 'decorator_list', [])]) - 1
+  else:
+    insert_at = len(lines) - 1
+
+  lines.insert(insert_at, RUNTIME_IMPORT)
+  return COMPILED_HEADER.format(script_path=script_path) + '\n'.join(lines)
+
+
+def compile_to_code(script_text, filename):
+  """Compile a pysh script to a code object which imports the runtime.
+
+  Line numbers in the code object refer to the original script.
+  """
+  tree = ast.parse(transform(script_text), filename=filename)
+  index = _runtime_import_index(tree)
+  runtime_import = ast.parse(RUNTIME_IMPORT).body[0]
+  if index < len(tree.body):
+    ast.copy_location(runtime_import, tree.body[index])
+    ast.fix_missing_locations(runtime_import)
+  tree.body.insert(index, runtime_import)
+  ast.fix_missing_locations(tree)
+  return compile(tree, filename, 'exec')
+
+
+def pyc_header(source):
+  """Return a .pyc header for code compiled from source (bytes)."""
+  source_hash = getattr(importlib.util, 'source_hash', None)
+  if source_hash is not None:
+    # PEP 552 unchecked hash-based pyc: it doesn't embed a timestamp.
+    return MAGIC_NUMBER + struct.pack('<I', 0b01) + source_hash(source)
+
+  header = MAGIC_NUMBER + struct.pack('<I', 0)
+  if sys.version_info >= (3, 3):
+    header += struct.pack('<I', len(source) & 0xFFFFFFFF)
+  return header
+
+
+def compile_script(script_path, output_path):
+  """Compile the pysh script at script_path to a .py or .pyc file."""
+  from .pysh import read_script
+  script_text = read_script(script_path)
+
+  if output_path.endswith('.pyc'):
+    code = compile_to_code(script_text, script_path)
+    source = script_text.encode('utf-8')
+    data = pyc_header(source) + marshal.dumps(code)
+    mode = 'wb'
+  else:
+    data = compile_to_source(script_text, script_path)
+    mode = 'w'
+
+  tmp_path = '{}.tmp'.format(output_path)
+  with open(tmp_path, mode) as output_f:
+    output_f.write(data)
+
+  os.rename(tmp_path, output_path)
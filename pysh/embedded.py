@@ -0,0 +1,11 @@
+"""The layout of dist scripts.
+
+`pysh dist` writes the script's text, then the notice line, then a zip of
+pysh (see payload.py). Kept separate so that both the generator and the
+runtime, which reads a script only up to the notice, can import it cheaply.
+"""
+
+NOTICE = '# PySH: Module embedded below'
+
+# The notice as a line of the script, as read in binary mode.
+NOTICE_LINE = (NOTICE + '\n').encode('ascii')
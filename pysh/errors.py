@@ -0,0 +1,49 @@
+"""Exceptions raised by pysh scripts.
+
+Kept separate from the runtime so that ``import pysh`` stays cheap.
+"""
+
+
+class CalledProcessError(Exception):
+    """Raised when run() is called with check=True and the process
+    returns a non-zero exit status.
+    Attributes:
+      cmd, returncode, stdout, stderr, output
+      pipestatus: for pipelines pysh ran itself, the exit status of each
+        stage (None otherwise)
+    """
+    def __init__(self, returncode, cmd, output=None, stderr=None,
+                 pipestatus=None):
+        self.returncode = returncode
+        self.cmd = cmd
+        self.output = output
+        self.stderr = stderr
+        self.pipestatus = pipestatus
+
+    def __str__(self):
+        import signal
+        if self.returncode and self.returncode < 0:
+            try:
+                return "Command '%s' died with %r." % (
+                        self.cmd, signal.Signals(-self.returncode))
+            except ValueError:
+                return "Command '%s' died with unknown signal %d." % (
+                        self.cmd, -self.returncode)
+        elif self.pipestatus is not None:
+            return ("Command '%s' returned non-zero exit status %d "
+                    "(pipeline statuses %r)." % (
+                        self.cmd, self.returncode, self.pipestatus))
+        else:
+            return "Command '%s' returned non-zero exit status %d." % (
+                    self.cmd, self.returncode)
+
+    @property
+    def stdout(self):
+        """Alias for output attribute, to match stderr"""
+        return self.output
+
+    @stdout.setter
+    def stdout(self, value):
+        # There's no obvious reason to set this, but allow it anyway so
+        # .stdout is a transparent alias for .output
+        self.output = value
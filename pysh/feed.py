@@ -0,0 +1,161 @@
+"""Feeding data from Python into a command's stdin, for getoutput(stdin=...).
+
+The source can be:
+  - a seekable file with a file descriptor (e.g. from open()): it becomes the
+    command's stdin, so the command reads it straight from the file, from its
+    current position, and nothing is copied through Python. As with `cmd <&3`,
+    the command moves the file's position as it reads.
+  - str, bytes or another buffer (bytearray, memoryview, mmap, ...): written
+    as is; str as UTF-8.
+  - any other file object (a pipe, a socket, io.BytesIO, ...): read in chunks.
+  - an iterable of str or bytes: each item is written as is, like
+    file.writelines(), so records need their own newlines. Small items are
+    batched into larger writes.
+
+Everything but a seekable file is written to a pipe by a writer thread, so
+the command can fill its stdout while pysh is still writing its stdin without
+either side blocking the other. The iterable is consumed lazily, so it can
+produce more records than fit in memory. If the command exits without reading
+all of its input (e.g. `head`), the rest is dropped; if the source raises, the
+command gets EOF and the error is raised where its exit status is checked.
+"""
+
+import io
+import itertools
+import os
+import sys
+import threading
+
+from . import compat
+
+
+# The size of the writes a writer thread batches items into.
+WRITE_SIZE = 64 * 1024
+
+if sys.version_info[0] == 3:
+  _text_type = str
+else:
+  _text_type = unicode  # noqa: F821
+
+
+def prepare(source):
+  """Return (stdin, feeder) for running a command with stdin from source.
+
+  stdin is what to pass to Popen. feeder is None if the command reads the
+  source itself; otherwise it's a Feeder to start() once the command is
+  running, or close() if it couldn't be started.
+  """
+  if source is None:
+    return None, None
+  if _is_seekable_file(source):
+    # Drops any read-ahead, so the descriptor is where the file object is.
+    source.seek(source.tell())
+    return source, None
+
+  feeder = Feeder(source)
+  return feeder.stdin, feeder
+
+
+def _is_seekable_file(source):
+  try:
+    source.fileno()
+    return source.seekable()
+  except (AttributeError, io.UnsupportedOperation, ValueError):
+    return False
+
+
+class Feeder(object):
+  """Writes a source to a pipe from a thread, as the command reads it.
+
+  Attributes:
+    stdin: the read end of the pipe, for the command.
+  """
+
+  def __init__(self, source):
+    self._chunks = _chunks(source)
+    self.stdin, self._fd = compat.pipe()
+    self._thread = None
+    self._error = None
+
+  def start(self):
+    """Start writing; the command must have been given stdin by now."""
+    os.close(self.stdin)
+    self._thread = threading.Thread(target=self._write)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _write(self):
+    try:
+      for chunk in self._chunks:
+        _write_all(self._fd, chunk)
+    except EnvironmentError as e:
+      import errno
+      if e.errno != errno.EPIPE:
+        self._error = e
+    except BaseException as e:
+      self._error = e
+    finally:
+      os.close(self._fd)
+
+  def join(self):
+    """Wait for the writer, and raise whatever the source raised, if anything.
+
+    Only blocks for long if the command is still reading.
+    """
+    self._thread.join()
+    if self._error is not None:
+      error, self._error = self._error, None
+      raise error
+
+  def close(self):
+    """Close the pipe, for a command which didn't start."""
+    os.close(self.stdin)
+    os.close(self._fd)
+
+
+def _chunks(source):
+  if isinstance(source, _text_type):
+    return [source.encode('utf-8')]
+  try:
+    memoryview(source)
+  except TypeError:
+    pass
+  else:
+    return [source]
+
+  if hasattr(source, 'read'):
+    read = getattr(source, 'read1', source.read)
+    source = iter(lambda: read(WRITE_SIZE), source.read(0))
+  return _batched(source)
+
+
+def _batched(items):
+  # Joins batches of items, sized so that each write is about WRITE_SIZE; a
+  # batch of str is encoded at once, which is much faster than item by item.
+  items = iter(items)
+  count = 64
+  while True:
+    batch = list(itertools.islice(items, count))
+    if not batch:
+      return
+    try:
+      if isinstance(batch[0], _text_type):
+        chunk = u''.join(batch).encode('utf-8')
+      else:
+        chunk = b''.join(batch)
+    except TypeError:
+      # A mix of str and bytes.
+      chunk = b''.join(item.encode('utf-8') if isinstance(item, _text_type)
+                       else item for item in batch)
+    yield chunk
+    count = min(max(1, count * WRITE_SIZE // max(1, len(chunk))), 4096)
+
+
+def _write_all(fd, data):
+  # Slicing the memoryview doesn't copy what's left of a large buffer.
+  view = memoryview(data)
+  if view.ndim != 1 or view.itemsize != 1:
+    view = view.cast('B')
+  while len(view):
+    view = view[os.write(fd, view):]
+
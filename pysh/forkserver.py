@@ -0,0 +1,347 @@
+"""A long-lived process which runs pysh scripts by forking.
+
+Starting a script normally costs a fresh interpreter plus importing pysh and
+the input transformer. The fork server pays that once: it preloads pysh and
+listens on a Unix socket, and generated scripts whose bootstrap finds
+$PYSH_FORKSERVER_SOCKET hand their argv, environment, working directory and
+stdio file descriptors to it instead. For each request the server forks a
+runner, which forks the process that actually runs the script, waits for it
+and reports its exit status back to the client.
+
+Protocol, over one connection per script run:
+  client -> server: a 10-digit length, then that many bytes of NUL-separated
+    fields: cwd, argc, argv (script path first), then environment entries
+    (KEY=VALUE). The client's stdin, stdout and stderr travel with the first
+    bytes as SCM_RIGHTS ancillary data.
+  server -> client: "P <pid>\\n" once the script process exists (the client
+    forwards signals to its process group), then "X <status>\\n" when it exits;
+    a negative status means it was killed by that signal.
+
+When the client's terminal is also the server's (the server was started from
+the same session), the script's process group takes the terminal over while
+the client has it, and gives it back when the script stops or exits; see
+_run_request(). Otherwise the terminal isn't the script's controlling terminal
+at all, so reading from it works anyway, and the client forwards the
+terminal's signals, ^Z included.
+
+The client side lives in the script bootstrap, see generator.py.
+"""
+
+from __future__ import print_function
+import collections
+import os
+import signal
+import sys
+
+
+SOCKET_ENV_VAR = 'PYSH_FORKSERVER_SOCKET'
+
+# Modules imported before serving, so scripts don't have to.
+DEFAULT_PRELOAD = (
+  'pysh.pysh', 'pysh.runtime', 'pysh.shell', 'pysh.cache',
+  'pysh.ipython.inputtransformer2', 'pysh.ipython.text',
+  'argparse', 'json', 're', 'shutil', 'subprocess', 'tempfile', 'threading',
+)
+
+_LENGTH_DIGITS = 10
+
+# The client sends exactly stdin, stdout and stderr.
+_NUM_FDS = 3
+
+
+Request = collections.namedtuple('Request', ('cwd', 'argv', 'environ', 'fds'))
+
+
+def socket_path_from_env():
+  return os.environ.get(SOCKET_ENV_VAR)
+
+
+def preload(modules):
+  """Import modules, and warm up anything which is created on first use."""
+  import importlib
+  for module in modules:
+    importlib.import_module(module)
+
+  from . import runtime
+  runtime._dollar_formatter()
+
+
+def serve(socket_path, preload_modules=DEFAULT_PRELOAD):
+  """Serve script runs on socket_path, until interrupted.
+
+  Only returns in a forked process which should run a script; its stdio,
+  environment and working directory are already set up, and the return value
+  is the script's argv (the script path first).
+  """
+  import socket
+
+  preload(preload_modules)
+
+  if os.path.exists(socket_path):
+    os.unlink(socket_path)
+
+  listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  old_umask = os.umask(0o077)
+  try:
+    listener.bind(socket_path)
+  finally:
+    os.umask(old_umask)
+  listener.listen(64)
+
+  # Runners are never waited for; let the kernel reap them.
+  signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+  # Remove the socket when stopped with e.g. kill.
+  signal.signal(signal.SIGTERM, _exit_on_signal)
+  server_pid = os.getpid()
+  try:
+    while True:
+      conn, _ = listener.accept()
+      sys.stdout.flush()
+      sys.stderr.flush()
+      if os.fork() != 0:
+        conn.close()
+        continue
+
+      listener.close()
+      signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+      signal.signal(signal.SIGTERM, signal.SIG_DFL)
+      return _run_request(conn)
+  finally:
+    if os.getpid() == server_pid:
+      listener.close()
+      try:
+        os.unlink(socket_path)
+      except OSError:
+        pass
+
+
+def _exit_on_signal(signum, frame):
+  sys.exit(128 + signum)
+
+
+def run_script(argv):
+  """Run the script in the script process, then exit it.
+
+  Exits like the interpreter would: atexit functions run, streams are flushed,
+  and the status reflects SystemExit or an uncaught exception. Tearing down
+  all the preloaded modules is skipped, though, as that takes longer than
+  running a typical script.
+  """
+  import atexit
+  import threading
+  from . import pysh
+
+  code = 0
+  kill_signal = None
+  try:
+    pysh.main(argv[0])
+  except SystemExit as e:
+    code = _system_exit_code(e)
+  except KeyboardInterrupt:
+    sys.excepthook(*sys.exc_info())
+    kill_signal = signal.SIGINT
+  except BaseException:
+    sys.excepthook(*sys.exc_info())
+    code = 1
+
+  if any(not t.daemon and t is not threading.current_thread()
+         for t in threading.enumerate()):
+    # Let the interpreter wait for them, as usual.
+    sys.exit(code)
+
+  atexit._run_exitfuncs()
+  for stream in (sys.stdout, sys.stderr):
+    try:
+      stream.flush()
+    except (IOError, OSError, ValueError):
+      pass
+
+  if kill_signal is not None:
+    signal.signal(kill_signal, signal.SIG_DFL)
+    os.kill(os.getpid(), kill_signal)
+  os._exit(code)
+
+
+def _system_exit_code(e):
+  if e.code is None:
+    return 0
+  if isinstance(e.code, int):
+    return e.code & 0xff
+  sys.stderr.write('{}\n'.format(e.code))
+  return 1
+
+
+def _run_request(conn):
+  # Runs in the runner process. Returns the argv in the script process; the
+  # runner itself exits here.
+  try:
+    request = _read_request(conn)
+  except Exception:
+    os._exit(1)
+  client_pgrp = _peer_pgrp(conn)
+
+  pid = os.fork()
+  if pid == 0:
+    # Own process group, so the client can signal the script and the commands
+    # it runs together, like a terminal does.
+    os.setpgid(0, 0)
+    conn.close()
+    _setup_script_process(request)
+    # When the server runs on the client's terminal (e.g. `pysh forkserver &`
+    # from the same shell), that group is in the background of the terminal's
+    # session, and reading from it would stop the script with SIGTTIN. Take
+    # the terminal over, as a shell does for the jobs it starts, if the client
+    # has it.
+    _move_terminal(0, client_pgrp, os.getpgrp())
+    return request.argv
+
+  try:
+    os.setpgid(pid, pid)
+  except OSError:
+    pass
+  # The script's stdin stays open here, to give the terminal back.
+  stdin_fd = request.fds[0]
+  for fd in request.fds[1:]:
+    os.close(fd)
+
+  try:
+    conn.sendall('P {}\n'.format(pid).encode('ascii'))
+  except (IOError, OSError):
+    pass
+
+  while True:
+    _, status = os.waitpid(pid, os.WUNTRACED | os.WCONTINUED)
+    if os.WIFSTOPPED(status):
+      # E.g. ^Z while the script had the terminal: stop the client too, so
+      # its shell sees the job stopped and gets the terminal back.
+      if _move_terminal(stdin_fd, pid, client_pgrp):
+        _killpg(client_pgrp, signal.SIGTSTP)
+    elif os.WIFCONTINUED(status):
+      # The client forwards the SIGCONT of e.g. `fg`.
+      _move_terminal(stdin_fd, client_pgrp, pid)
+    else:
+      break
+  _move_terminal(stdin_fd, pid, client_pgrp)
+  os.close(stdin_fd)
+
+  if os.WIFSIGNALED(status):
+    code = -os.WTERMSIG(status)
+  else:
+    code = os.WEXITSTATUS(status)
+
+  try:
+    conn.sendall('X {}\n'.format(code).encode('ascii'))
+  except (IOError, OSError):
+    pass
+
+  os._exit(0)
+
+
+def _peer_pgrp(conn):
+  # The process group of the client, or None if it can't be found.
+  import socket
+  import struct
+  try:
+    creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                            struct.calcsize('3i'))
+    return os.getpgid(struct.unpack('3i', creds)[0])
+  except (AttributeError, OSError, struct.error):
+    return None
+
+
+def _move_terminal(fd, from_pgrp, to_pgrp):
+  """Move the terminal on fd from the foreground of one group to another.
+
+  Only if it's the controlling terminal of this process, and from_pgrp has it.
+  Returns whether it was moved.
+  """
+  if from_pgrp is None or to_pgrp is None:
+    return False
+  try:
+    if os.tcgetpgrp(fd) != from_pgrp:
+      return False
+    # Otherwise a process in the background gets SIGTTOU.
+    handler = signal.signal(signal.SIGTTOU, signal.SIG_IGN)
+    try:
+      os.tcsetpgrp(fd, to_pgrp)
+    finally:
+      signal.signal(signal.SIGTTOU, handler)
+  except OSError:
+    return False
+  return True
+
+
+def _killpg(pgrp, signum):
+  try:
+    os.killpg(pgrp, signum)
+  except OSError:
+    pass
+
+
+def _read_request(conn):
+  import array
+  import socket
+
+  fds = array.array('i')
+  data, ancdata, _, _ = conn.recvmsg(
+    _LENGTH_DIGITS, socket.CMSG_LEN(_NUM_FDS * fds.itemsize))
+  for level, kind, cmsg_data in ancdata:
+    if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+      fds.frombytes(cmsg_data[:len(cmsg_data) - len(cmsg_data) % fds.itemsize])
+
+  if len(fds) != _NUM_FDS:
+    raise ValueError('expected {} fds, got {}'.format(_NUM_FDS, len(fds)))
+
+  data = _recv_exactly(conn, data, _LENGTH_DIGITS)
+  length = int(data)
+  payload = _recv_exactly(conn, b'', length)
+
+  fields = payload.split(b'\0')
+  cwd = fields[0]
+  argc = int(fields[1])
+  argv = [os.fsdecode(arg) for arg in fields[2:2 + argc]]
+  environ = dict(entry.split(b'=', 1) for entry in fields[2 + argc:]
+                 if b'=' in entry)
+  return Request(cwd=cwd, argv=argv, environ=environ, fds=list(fds))
+
+
+def _recv_exactly(conn, data, size):
+  while len(data) < size:
+    chunk = conn.recv(size - len(data))
+    if not chunk:
+      raise EOFError('fork server client disconnected')
+    data += chunk
+  return data
+
+
+def _setup_script_process(request):
+  for target_fd, fd in enumerate(request.fds):
+    os.dup2(fd, target_fd)
+  for fd in request.fds:
+    if fd > 2:
+      os.close(fd)
+
+  _reopen_stdio()
+
+  os.chdir(request.cwd)
+  os.environb.clear()
+  os.environb.update(request.environ)
+  sys.argv = list(request.argv)
+
+  if 'random' in sys.modules:
+    sys.modules['random'].seed()
+
+
+def _reopen_stdio():
+  # The server's sys.std* objects were flushed before forking, and would
+  # otherwise keep the server's notion of e.g. whether stdout is a terminal.
+  import io
+  for name, fd, mode in (('stdin', 0, 'r'), ('stdout', 1, 'w'),
+                         ('stderr', 2, 'w')):
+    old = getattr(sys, name)
+    line_buffered = mode == 'w' and (fd == 2 or os.isatty(fd))
+    stream = io.open(fd, mode, buffering=1 if line_buffered else -1,
+                     encoding=getattr(old, 'encoding', None),
+                     errors=getattr(old, 'errors', None), closefd=False)
+    setattr(sys, name, stream)
+    setattr(sys, '__{}__'.format(name), stream)
@@ -1,21 +1,14 @@
 """Defines code that generates the script header."""
 
 from __future__ import print_function
-import base64
 import collections
+import hashlib
 import os
 import re
 import stat
 import sys
-import zipfile
-
-if sys.version_info[0] == 3:
-  import io
-  BytesIO = io.BytesIO
-else:
-  import cStringIO
-  BytesIO = cStringIO.StringIO
 
+from . import embedded
 
 
 SHBANG_LINE = "#!/bin/sh -e"
@@ -29,11 +22,27 @@ PYSH_INFO_SECTION = """\
 """.split('\n')
 
 
-PYSH_BOOTSTRAP_SECTION_NAME = 'PySH Bootstrap'
+# Generated scripts record a stamp in their PySH Information section: a hash
+# of their text and of what `pysh gen`/`dist` would write around it (see
+# stamp_key()). A script whose stamp still matches would be regenerated as is,
+# so it is skipped.
+STAMP_PREFIX = '# Stamp: '
 
 
-_EMBEDDED_MODULE_NOTICE = '# PySH: Module embedded below'
+PYSH_BOOTSTRAP_SECTION_NAME = 'PySH Bootstrap'
+
 
+# The bootstrap comes in two variants. The legacy one echoes the Python code
+# into an interpreter reading it from /dev/fd/3, tries python3 and then
+# python (each found with `which`), and reports a missing pysh package from
+# the shell; it needs `set -o pipefail` and an echo which expands \n, as in
+# dash. The lean one (the default) finds the interpreter with the `command -v`
+# builtin and execs it with the code as -c, so no shell or pipe stays behind.
+# The Python code records the interpreter's path in $PYSH_PYTHON, and the
+# $PATH it was found with in $PYSH_PYTHON_PATH, so pysh scripts it runs skip
+# the lookup. Every process it starts inherits them, so a script only uses
+# them if its $PATH is still the same: one which runs after e.g. a virtualenv
+# was activated looks for its interpreter again.
 
 _NORMAL_PY_SCRIPT = """\
 from __future__ import print_function
@@ -46,32 +55,212 @@ pysh.main('$0')
 """
 
 
-_DISTRIBUTABLE_PY_SCRIPT = """\
-from base64 import b64decode
+# A distributable script ends with a zip of pysh, after the notice line, whose
+# comment holds a hash of its contents (see payload.py). pysh is imported from
+# the copy of that payload extracted to the user's cache (see
+# runtime_cache.py), which the first run with that payload creates. This
+# checks for the copy itself, to stay off the zip when there is one; it must
+# agree with cache.cache_root(). Without a cache, the script itself goes on
+# sys.path: zipimport finds the archive from its end. The path must be
+# absolute, as the zip is read again on each import. Like the fork server
+# client, this must not contain backslashes or double quotes, and only the
+# legacy variant has a dollar sign, in $0.
+_DISTRIBUTABLE_PY_TEMPLATE = """\
+import os
 import sys
-import tempfile
-with open('$0') as script_f:
-  with tempfile.NamedTemporaryFile(suffix='.zip') as f:
-    f.write(b64decode(eval(script_f.read().split('{_EMBEDDED_MODULE_NOTICE}\\n', 1)[1])))
-    f.flush()
-    sys.path.append(f.name)
-    import pysh
-    pysh.main('$0')
-""".format(_EMBEDDED_MODULE_NOTICE=_EMBEDDED_MODULE_NOTICE)
+{setup}script_path = {script_path}
+script = os.path.abspath(script_path)
+path = script
+env = os.environ
+try:
+  with open(script, 'rb') as f:
+    f.seek(-84, 2)
+    tail = f.read().decode('ascii')
+  if tail.startswith('pysh-payload sha256:') and not env.get('PYSH_NO_CACHE'):
+    root = env.get('PYSH_CACHE_DIR') or os.path.join(
+      env.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'),
+                                                '.cache'), 'pysh')
+    cached = os.path.join(root, 'runtime', tail[20:])
+    if not os.path.isdir(cached):
+      sys.path.insert(0, script)
+      from pysh import runtime_cache
+      cached = runtime_cache.extract(script, cached)
+      del sys.path[0]
+      for name in list(sys.modules):
+        if name == 'pysh' or name.startswith('pysh.'):
+          del sys.modules[name]
+    if cached:
+      path = cached
+      os.utime(cached, None)
+except Exception:
+  pass
+sys.path.insert(0, path)
+import pysh
+pysh.main(script_path)
+"""
+
+_DISTRIBUTABLE_PY_SCRIPT = _DISTRIBUTABLE_PY_TEMPLATE.format(
+  setup='', script_path="'$0'")
+
+_LEAN_SETUP = """\
+os.environ['PYSH_PYTHON'] = sys.executable
+os.environ['PYSH_PYTHON_PATH'] = os.environ.get('PATH', '')
+"""
+
+_LEAN_DISTRIBUTABLE_PY_SCRIPT = _DISTRIBUTABLE_PY_TEMPLATE.format(
+  setup=_LEAN_SETUP, script_path='sys.argv.pop(1)')
+
+# Like the legacy header, a script whose python3 lacks pysh is retried with
+# python, for which it may be installed (e.g. Python 2). The shell runs the
+# script again with $PYSH_PYTHON set to python, which also stops a python
+# without pysh from retrying in turn.
+_LEAN_NORMAL_PY_SCRIPT = """\
+import os
+import sys
+retry = sys.version_info[0] > 2 and os.environ.get('PYSH_PYTHON') != 'python'
+""" + _LEAN_SETUP + """\
+script_path = sys.argv.pop(1)
+try:
+  import pysh
+except ImportError:
+  if retry:
+    import shutil
+    if shutil.which('python'):
+      os.environ['PYSH_PYTHON'] = 'python'
+      os.execv('/bin/sh', ['/bin/sh', '-e', script_path] + sys.argv[1:])
+  sys.stderr.write('pysh: script ' + script_path + ' requires the pysh '
+                   'package. Install it with:' + chr(10) + '      pip install '
+                   'https://github.com/areusch/pysh/archive/master.zip' +
+                   chr(10))
+  sys.exit(253)
+pysh.main(script_path)
+"""
+
+
+# Client for the fork server (see forkserver.py), run with `python3 -S` to
+# keep its own startup cheap; for the same reason it uses the _socket and
+# _signal modules, which don't import enum. If the server can't take the
+# request, it re-runs the script without $PYSH_FORKSERVER_SOCKET, which takes
+# the normal path. It must not contain backslashes, double quotes or dollar
+# signs.
+_FORKSERVER_CLIENT_PY_SCRIPT = """\
+import os
+import sys
+NL = bytes([10])
+def fallback():
+  os.environ.pop('PYSH_FORKSERVER_SOCKET', None)
+  os.execv('/bin/sh', ['/bin/sh', '-e'] + sys.argv[1:])
+def readline(conn, buf):
+  while NL not in buf[0]:
+    chunk = conn.recv(256)
+    if not chunk:
+      return b''
+    buf[0] += chunk
+  line, buf[0] = buf[0].split(NL, 1)
+  return line
+try:
+  import _signal
+  import _socket
+  conn = _socket.socket(_socket.AF_UNIX, _socket.SOCK_STREAM)
+  conn.connect(os.environ['PYSH_FORKSERVER_SOCKET'])
+  fields = ([os.getcwdb(), str(len(sys.argv) - 1).encode()] +
+            [os.fsencode(arg) for arg in sys.argv[1:]] +
+            [k + b'=' + v for k, v in os.environb.items()])
+  payload = bytes([0]).join(fields)
+  fds = b''.join(fd.to_bytes(4, sys.byteorder) for fd in (0, 1, 2))
+  conn.sendmsg([('%010d' % len(payload)).encode() + payload],
+               [(_socket.SOL_SOCKET, _socket.SCM_RIGHTS, fds)])
+  buf = [b'']
+  line = readline(conn, buf)
+except Exception:
+  line = b''
+if not line.startswith(b'P '):
+  fallback()
+pid = int(line[2:])
+def forward(signum, frame):
+  try:
+    os.killpg(pid, signum)
+  except OSError:
+    pass
+for name in ('SIGINT', 'SIGTERM', 'SIGHUP', 'SIGQUIT', 'SIGUSR1', 'SIGUSR2',
+             'SIGWINCH', 'SIGCONT'):
+  _signal.signal(getattr(_signal, name), forward)
+def stop(signum, frame):
+  forward(signum, frame)
+  os.kill(os.getpid(), _signal.SIGSTOP)
+_signal.signal(_signal.SIGTSTP, stop)
+line = readline(conn, buf)
+if not line.startswith(b'X '):
+  sys.stderr.write('pysh: lost connection to the fork server' + NL.decode())
+  os._exit(255)
+status = int(line[2:])
+if status < 0:
+  _signal.signal(-status, _signal.SIG_DFL)
+  os.kill(os.getpid(), -status)
+os._exit(status)
+"""
 
 
 _ESCAPE_SEQ = re.compile(r'\\(?P<char>.)')
 
 
-def make_bootstrap_lines(dist):
-  script = _DISTRIBUTABLE_PY_SCRIPT if dist else _NORMAL_PY_SCRIPT
+def _escape_py(script):
+  # Escapes a Python script so that `echo "<escaped>"` in /bin/sh prints it.
+  return _ESCAPE_SEQ.sub(r'\\\\\\\1', script).replace('\n', '\\n')
+
+
+def bootstrap_py_script(dist, legacy=False):
+  """Return the Python code the bootstrap runs.
+
+  The lean variant's takes the script's path as its first argument.
+  """
+  if legacy:
+    return _DISTRIBUTABLE_PY_SCRIPT if dist else _NORMAL_PY_SCRIPT
+  return _LEAN_DISTRIBUTABLE_PY_SCRIPT if dist else _LEAN_NORMAL_PY_SCRIPT
+
+
+def _exec_code(script):
+  # The -c code which runs script, single-quoted for eval, then double-quoted
+  # as a word of a bootstrap line. Python reads the line as a string literal
+  # too, so it only has \\ and \" escapes. script has no double quotes, so
+  # its single quotes become double ones.
+  assert not any(c in script for c in '"$`\\')
+  literal = script.replace("'", '"').replace('"', '\\"').replace('\n', '\\n')
+  code = "'exec(\"{}\")'".format(literal)
+  return '"{}"'.format(code.replace('\\', '\\\\').replace('"', '\\"'))
+
+
+def make_bootstrap_lines(dist, legacy=False):
+  """Return the lines of the PySH Bootstrap section.
+
+  Each line is a shell command made only of quoted words, so that it is also
+  a Python expression statement.
+  """
+  if not legacy:
+    return _make_lean_bootstrap_lines(dist)
+
+  script = bootstrap_py_script(dist, legacy=True)
 #  script = "'foo\\n'"
 #  m = _ESCAPE_SEQ.search(script)
 #  print('m={!r} {!r}'.format(m.group(1), m.groupdict()))
-  _py = _ESCAPE_SEQ.sub(r'\\\\\\\1', script).replace('\n', '\\n')
+  _py = _escape_py(script)
 #  print('py={!s}'.format(_py), file=sys.stderr)
 
-  sh_evals = (
+  sh_evals = ()
+  if not dist:
+    # Distributable scripts bring their own copy of pysh, so they don't use
+    # a fork server (which has its own).
+    sh_evals += (
+      ('if [ -n \"${PYSH_FORKSERVER_SOCKET}\" ] &&',
+       '[ -S \"${PYSH_FORKSERVER_SOCKET}\" ] &&',
+       'command -v python3 >/dev/null; then',
+       'fs_py="{}";'.format(_escape_py(_FORKSERVER_CLIENT_PY_SCRIPT)),
+       '(', 'echo', '\"${fs_py}\"', '|', '(', 'python3', '-S', '/dev/fd/3',
+       '\"$0\"', '\"$@\"', '0<&4', ')', '3<&0', ')', '4<&0;',
+       'exit $?; fi'),
+    )
+
+  sh_evals += (
     ('py="{_py}"'.format(_py=_py), 'code=0; set -o pipefail'),
     ('python_bin=`which python3`;',),
     ('if [ -n \"${python_bin}\" ]; then ',
@@ -94,6 +283,27 @@ def make_bootstrap_lines(dist):
     for e in sh_evals]
 
 
+def _make_lean_bootstrap_lines(dist):
+  lines = []
+  if not dist:
+    # As in the legacy variant, but exec'd.
+    lines.append(
+      "'eval' 'if [ -n \"${PYSH_FORKSERVER_SOCKET}\" ] && "
+      "[ -S \"${PYSH_FORKSERVER_SOCKET}\" ] && "
+      "command -v python3 >/dev/null; then exec python3 -S -c' " +
+      _exec_code(_FORKSERVER_CLIENT_PY_SCRIPT) + " '\"$0\" \"$@\"; fi'")
+
+  lines.append(
+    "'eval' '[ -n \"${PYSH_PYTHON}\" ] && "
+    "[ \"${PYSH_PYTHON_PATH-}\" = \"${PATH-}\" ] || "
+    "if command -v python3 >/dev/null; then PYSH_PYTHON=python3; "
+    "else PYSH_PYTHON=python; fi'")
+  lines.append(
+    "'eval' 'exec \"${PYSH_PYTHON}\" -c' " +
+    _exec_code(bootstrap_py_script(dist)) + " '\"$0\" \"$@\"'")
+  return lines
+
+
 Metadata = collections.namedtuple('Metadata', ('leading', 'name', 'content'))
 
 
@@ -186,6 +396,18 @@ class Parser:
     return to_return
 
 
+def read_lines(script_f):
+  """Yield the lines of a script opened in binary mode, as text.
+
+  Stops after the embedded module notice, if any: what follows is a zip.
+  """
+  for line in script_f:
+    line = line.decode('utf-8')
+    yield line
+    if line.rstrip('\r\n') == embedded.NOTICE:
+      return
+
+
 class ParsedScript:
   """Encodes a parsed PySH script."""
 
@@ -272,7 +494,7 @@ class ParsedScript:
     dist = False
     _, content = parser.fetch()
     for i, line in enumerate(content):
-      if line == _EMBEDDED_MODULE_NOTICE:
+      if line == embedded.NOTICE:
         content = content[:i]
         dist = True
         break
@@ -282,7 +504,7 @@ class ParsedScript:
 
     return cls(metadata, content, dist)
 
-  def normalize(self, dist):
+  def normalize(self, dist, legacy_bootstrap=False):
     """Add required sections to the pysh file."""
     old_md = self._metadata
     self._metadata = collections.OrderedDict()
@@ -299,82 +521,263 @@ class ParsedScript:
 
         self.metadata[s] = old_md[s]
 
-    bootstrap_section_lines = make_bootstrap_lines(dist)
+    bootstrap_section_lines = make_bootstrap_lines(dist, legacy_bootstrap)
     self.metadata[PYSH_BOOTSTRAP_SECTION_NAME] = Metadata(
       leading=[''], name=PYSH_BOOTSTRAP_SECTION_NAME,
       content=bootstrap_section_lines)
     self._dist = dist
 
-  def write(self, script_f):
-    script_f.write('{}\n'.format(SHBANG_LINE))
+  def render(self, stamp=None):
+    """Return the text of the script, up to any embedded module."""
+    out = []
+    out.append('{}\n'.format(SHBANG_LINE))
     for name, metadata in self._metadata.items():
-      script_f.write('\n'.join(metadata.leading))
-      script_f.write('\n')
-      script_f.write(self.METADATA_START_FMT.format(name))
-      script_f.write('\n'.join(metadata.content))
-      script_f.write('\n')
-      script_f.write(self.METADATA_END_FMT.format(name))
-
-    script_f.write('\n'.join(self._content))
+      content = metadata.content
+      if stamp is not None and name == PYSH_INFO_SECTION_NAME:
+        # Before the section's trailing blank line.
+        content = content[:-1] + [STAMP_PREFIX + stamp] + content[-1:]
+      out.append('\n'.join(metadata.leading))
+      out.append('\n')
+      out.append(self.METADATA_START_FMT.format(name))
+      out.append('\n'.join(content))
+      out.append('\n')
+      out.append(self.METADATA_END_FMT.format(name))
+
+    content = '\n'.join(self._content)
+    out.append(content)
+    if self._dist:
+      if content and not content.endswith('\n'):
+        out.append('\n')
+      out.append('{}\n'.format(embedded.NOTICE))
+    return ''.join(out)
+
+  def write(self, script_f, key=None, payload_data=None):
+    """Write the script, stamped if key (from stamp_key()) is given.
+
+    A dist script is followed by payload_data, built if not given.
+    """
+    stamp = None
+    if key is not None:
+      stamp = make_stamp(key, self.render())
+    script_f.write(self.render(stamp))
     if self._dist:
-      script_f.write('{}\n'.format(_EMBEDDED_MODULE_NOTICE))
-      module_f = BytesIO()
-      zip_f = zipfile.ZipFile(module_f, 'w', zipfile.ZIP_DEFLATED)
-      top = os.path.dirname(__file__)
-      for dirpath, _, files in os.walk(top):
-        for file_name in files:
-          if not file_name.endswith('.py'):
-            continue
-
-          zip_path = os.path.relpath(
-            os.path.realpath('{}/{}'.format(dirpath, file_name)),
-            os.path.dirname(top))
-          with open(os.path.sep.join([dirpath, file_name]), 'rb') as f:
-            zip_f.writestr(zip_path, f.read())
-
-      zip_f.close()
-
-      script_f.write('"""')
-      b64_encoded = base64.b64encode(module_f.getvalue())
-      if sys.version_info[0] == 3:
-        b64_encoded = str(b64_encoded, 'utf-8')
-      script_f.write(b64_encoded)
-      script_f.write('"""\n')
-
-
-def generate(script_path_arg, dist=False):
+      if payload_data is None:
+        from . import payload
+        payload_data = payload.build()
+      # Appended as is, after the text.
+      script_f.flush()
+      getattr(script_f, 'buffer', script_f).write(payload_data)
+
+
+def stamp_key(dist, legacy_bootstrap=False, payload_data=None):
+  """Return a hash of what generating a script adds to it.
+
+  payload_data is the embedded module, for dist scripts.
+  """
+  key = hashlib.sha256()
+  lines = ([SHBANG_LINE, str(dist)] + PYSH_INFO_SECTION +
+           make_bootstrap_lines(dist, legacy_bootstrap))
+  for line in lines:
+    key.update(line.encode('utf-8') + b'\n')
+  if dist:
+    key.update(_payload_comment(payload_data))
+  return key.hexdigest()
+
+
+def _payload_comment(payload_data):
+  # The end of the zip: its comment, which records a hash of its contents.
+  from . import payload
+  return payload_data[-(len(payload.COMMENT_PREFIX) + 64):]
+
+
+def make_stamp(key, text):
+  """Return the stamp of a script's text, without its stamp line."""
+  stamp = hashlib.sha256(key.encode('ascii') + b'\n' + text.encode('utf-8'))
+  return 'sha256:' + stamp.hexdigest()
+
+
+def split_stamp(text):
+  """Return (stamp or None, the text without its stamp line)."""
+  start = 0
+  while True:
+    start = text.find(STAMP_PREFIX, start)
+    if start == -1:
+      return None, text
+    if start == 0 or text[start - 1] == '\n':
+      break
+    start += 1
+
+  end = text.find('\n', start)
+  if end == -1:
+    return None, text
+  return text[start + len(STAMP_PREFIX):end], text[:start] + text[end + 1:]
+
+
+def is_up_to_date(lines, key, script_f=None, payload_data=None):
+  """Whether a script would be regenerated as is.
+
+  lines are its text lines, from read_lines(). For a dist script, script_f is
+  the script, opened in binary mode, whose embedded module must be
+  payload_data.
+  """
+  stamp, text = split_stamp(''.join(lines))
+  if stamp is None or stamp != make_stamp(key, text):
+    return False
+  if payload_data is not None:
+    comment = _payload_comment(payload_data)
+    script_f.seek(0, os.SEEK_END)
+    if script_f.tell() < len(comment):
+      return False
+    script_f.seek(-len(comment), os.SEEK_END)
+    return script_f.read() == comment
+  return True
+
+
+def generate(script_path_arg, dist=False, legacy_bootstrap=False,
+             payload_data=None, key=None):
+  """Add the header to a script, or refresh it.
+
+  For a dist script, payload_data is the embedded module, built if not given.
+  key is stamp_key() for the other arguments, computed if not given.
+
+  Returns:
+    False if the script was already up to date, and left untouched.
+  """
+  if dist and payload_data is None:
+    from . import payload
+    payload_data = payload.build()
+  if key is None:
+    key = stamp_key(dist, legacy_bootstrap, payload_data)
+
   if script_path_arg == '-':
-    script_f = sys.stdin
+    script_f = getattr(sys.stdin, 'buffer', sys.stdin)
   else:
-    script_f = open(script_path_arg)
+    script_f = open(script_path_arg, 'rb')
 
   try:
-    parser = Parser(script_f)
-    script = ParsedScript.parse(parser)
+    lines = list(read_lines(script_f))
+    if script_path_arg != '-' and is_up_to_date(
+        lines, key, script_f, payload_data if dist else None):
+      return False
   finally:
     script_f.close()
 
-  script.normalize(dist)
+  script = ParsedScript.parse(iter(lines))
+  script.normalize(dist, legacy_bootstrap)
 
   if script_path_arg == '-':
-    script_f = sys.stdout
-  else:
-    tmp_name = '{}.tmp'.format(script_path_arg)
-    while os.path.exists(tmp_name):
-      tmp_name = '{}.tmp.{}'.format(script_path_arg, random.randint(0,100))
+    script.write(sys.stdout, key, payload_data)
+    return True
+
+  # Written next to the script, then renamed over it, so that it's replaced
+  # at once, keeping its mode.
+  import tempfile
+  st = os.stat(script_path_arg)
+  fd, tmp_name = tempfile.mkstemp(
+    dir=os.path.dirname(os.path.abspath(script_path_arg)),
+    prefix='{}.tmp'.format(os.path.basename(script_path_arg)))
+  try:
+    with os.fdopen(fd, 'w') as script_f:
+      script.write(script_f, key, payload_data)
+    os.chmod(tmp_name, stat.S_IMODE(st.st_mode) | stat.S_IXUSR)
+    os.rename(tmp_name, script_path_arg)
+  except BaseException:
+    os.unlink(tmp_name)
+    raise
 
-    script_f = open(tmp_name, 'w')
+  return True
 
-  try:
-    script.write(script_f)
-  finally:
-    script_f.close()
 
-  if script_path_arg != '-':
-    os.unlink(script_path_arg)
-    os.rename(tmp_name, script_path_arg)
+# What find_scripts() reads of a file to tell whether it's a pysh script.
+_SNIFF_SIZE = 4096
+
+SCRIPT_EXTENSION = '.pysh'
+
+
+def find_scripts(paths):
+  """Yield the scripts to generate for the given paths.
+
+  Files are yielded as given. Directories are searched recursively, skipping
+  hidden ones, for scripts generated before and for *.pysh files.
+  """
+  marker = '\n{}'.format(ParsedScript.METADATA_START_FMT.format(
+    PYSH_INFO_SECTION_NAME)).encode('ascii')
+  for path in paths:
+    if not os.path.isdir(path):
+      yield path
+      continue
+
+    for dir_path, dir_names, file_names in os.walk(path):
+      dir_names[:] = sorted(d for d in dir_names if not d.startswith('.'))
+      for name in sorted(file_names):
+        file_path = os.path.join(dir_path, name)
+        if name.endswith(SCRIPT_EXTENSION):
+          yield file_path
+          continue
+        try:
+          with open(file_path, 'rb') as script_f:
+            head = script_f.read(_SNIFF_SIZE)
+        except (IOError, OSError):
+          continue
+        if head.startswith(b'#!') and marker in head:
+          yield file_path
 
-    st = os.stat(script_path_arg)
-    if (st.st_mode & stat.S_IXUSR) == 0:
-      new_mode = st.st_mode | stat.S_IXUSR
-      os.chmod(script_path_arg, new_mode)
+
+# generate() arguments for the processes of generate_all(), set when each
+# starts.
+_worker_kwargs = None
+
+
+def _init_worker(kwargs):
+  global _worker_kwargs
+  _worker_kwargs = kwargs
+
+
+def _generate_one(script_path):
+  # Returns (path, whether it changed, error message or None).
+  try:
+    return script_path, generate(script_path, **_worker_kwargs), None
+  except (ScriptError, EnvironmentError, UnicodeDecodeError) as e:
+    return script_path, False, str(e)
+
+
+def generate_all(paths, dist=False, legacy_bootstrap=False, jobs=None):
+  """Generate every script find_scripts() finds for paths, in parallel.
+
+  The embedded module of dist scripts is built once, for all of them. jobs is
+  the number of processes, the number of CPUs by default.
+
+  Returns:
+    a list of (path, whether it changed, error message or None), by path.
+  """
+  kwargs = {'dist': dist, 'legacy_bootstrap': legacy_bootstrap}
+  if dist:
+    from . import payload
+    kwargs['payload_data'] = payload.build()
+  kwargs['key'] = stamp_key(dist, legacy_bootstrap, kwargs.get('payload_data'))
+
+  if '-' in paths:
+    raise ValueError("stdin can't be generated along with other scripts")
+  scripts = list(find_scripts(paths))
+  if jobs is None:
+    from . import compat
+    jobs = compat.cpu_count()
+  if jobs < 1:
+    raise ValueError('jobs must be at least 1, not {}'.format(jobs))
+  jobs = min(jobs, len(scripts))
+
+  if jobs <= 1:
+    _init_worker(kwargs)
+    results = [_generate_one(script) for script in scripts]
+  else:
+    import multiprocessing
+    pool = multiprocessing.Pool(jobs, _init_worker, (kwargs,))
+    try:
+      # Chunks amortize the round trips, and still balance the load.
+      results = pool.map(_generate_one, scripts,
+                         chunksize=max(1, len(scripts) // (jobs * 8)))
+    finally:
+      pool.close()
+      pool.join()
+
+  return results
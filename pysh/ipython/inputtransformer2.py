@@ -43,33 +43,37 @@ else:
 _indent_re = re.compile(r'^[ \t]+')
 
 def leading_empty_lines(lines):
-    """Remove leading empty lines
+    """Blank out leading empty lines
 
-    If the leading lines are empty or contain only whitespace, they will be
-    removed.
+    If the leading lines are empty or contain only whitespace, they are
+    replaced with empty lines, rather than removed, so that the remaining lines
+    keep their line numbers.
     """
     if not lines:
         return lines
     for i, line in enumerate(lines):
         if line and not line.isspace():
-            return lines[i:]
+            return ['\n'] * i + lines[i:]
     return lines
 
 def leading_indent(lines):
     """Remove leading indentation.
 
-    If the first line starts with a spaces or tabs, the same whitespace will be
-    removed from each following line in the cell.
+    If the first non-empty line starts with a spaces or tabs, the same
+    whitespace will be removed from each following line in the cell.
     """
-    if not lines:
+    for first, line in enumerate(lines):
+        if line and not line.isspace():
+            break
+    else:
         return lines
-    m = _indent_re.match(lines[0])
+    m = _indent_re.match(lines[first])
     if not m:
         return lines
     space = m.group(0)
     n = len(space)
-    return [l[n:] if l.startswith(space) else l
-            for l in lines]
+    return lines[:first] + [l[n:] if l.startswith(space) else l
+                            for l in lines[first:]]
 
 class PromptStripper:
     """Remove matching input prompts from a block of input.
@@ -202,6 +206,11 @@ class TokenTransformBase:
     # Lower numbers -> higher priority (for matches in the same location)
     priority = 10
 
+    # Whether shell commands have their {expr} and $var fields compiled into
+    # the generated code, rather than expanded by get_ipython() at runtime.
+    # Set by the TransformerManager.
+    compile_time_expansion = False
+
     def sortby(self):
         return self.start_line, self.start_col, self.priority
 
@@ -259,7 +268,10 @@ class MagicAssign(TokenTransformBase):
         new_line = lhs + call + '\n'
         lines_after = lines[end_line+1:]
 
-        return lines_before + [new_line] + lines_after
+        # Blank lines stand in for any continuation lines, so that later
+        # lines keep their line numbers.
+        return (lines_before + [new_line] + ['\n'] * (end_line - start_line)
+                + lines_after)
 
 
 class SystemAssign(TokenTransformBase):
@@ -295,11 +307,15 @@ class SystemAssign(TokenTransformBase):
         cmd = rhs[1:]
 
         lines_before = lines[:start_line]
-        call = "get_ipython().getoutput({!r})".format(cmd)
+        call = _tr_sh_cap(cmd, self.compile_time_expansion and
+                          not _in_class_body(lines, start_line))
         new_line = lhs + call + '\n'
         lines_after = lines[end_line + 1:]
 
-        return lines_before + [new_line] + lines_after
+        # Blank lines stand in for any continuation lines, so that later
+        # lines keep their line numbers.
+        return (lines_before + [new_line] + ['\n'] * (end_line - start_line)
+                + lines_after)
 
 # The escape sequences that define the syntax transformations IPython will
 # apply to user input.  These can NOT be just changed here: many regular
@@ -376,8 +392,168 @@ def _tr_paren(content):
     name, _, args = content.partition(' ')
     return '%s(%s)' % (name, ", ".join(args.split()))
 
-tr = { ESC_SHELL  : 'get_ipython().system({!r})'.format,
-       ESC_SH_CAP : 'get_ipython().getoutput({!r})'.format,
+# Modifiers which may be written between the escape and the command of a
+# captured command, e.g. `x = ![lines] ls`, and the getoutput() keyword
+# argument each one maps to.
+CAPTURE_MODIFIERS = {
+    'lines': ('capture', 'lines'),
+    'bytes': ('capture', 'bytes'),
+    'bytearray': ('capture', 'bytearray'),
+    'mmap': ('capture', 'mmap'),
+    'bounded': ('capture', 'bounded'),
+    'both': ('capture', 'both'),
+    'tee': ('tee', True),
+}
+
+# Modifiers which pass a Python name as a keyword argument of the same name,
+# e.g. `x = ![stdin=rows] sort`. Unlike the others, these also work with `!`.
+NAME_MODIFIERS = ('stdin',)
+
+_modifiers_re = re.compile(r"^\[([\w.=]+(?:,[\w.=]+)*)\]\s*")
+_dotted_name_re = re.compile(r"^[A-Za-z_]\w*(?:\.[A-Za-z_]\w*)*$")
+
+def _split_modifiers(cmd, captured=True):
+    """Split the ``[mod,...]`` prefix off a command.
+
+    Returns (source of the keyword arguments, command). A prefix naming
+    anything other than known modifiers, such as ``[ -f x ]``, is left as part
+    of the command.
+    """
+    m = _modifiers_re.match(cmd)
+    if m is None:
+        return [], cmd
+    args = []
+    for modifier in m.group(1).split(','):
+        name, eq, value = modifier.partition('=')
+        if eq and name in NAME_MODIFIERS and _dotted_name_re.match(value):
+            args.append('%s=%s' % (name, value))
+        elif not eq and captured and name in CAPTURE_MODIFIERS:
+            args.append('%s=%r' % CAPTURE_MODIFIERS[name])
+        else:
+            return [], cmd
+    return args, cmd[m.end():]
+
+# A single trailing & (not &&, >&, |& or an escaped \&) runs the command in
+# the background.
+_background_re = re.compile(r"(?<![&|>\\])&\s*$")
+
+def _split_background(cmd):
+    """Return (whether cmd ends with a background &, cmd without it)."""
+    m = _background_re.search(cmd)
+    if m is None:
+        return False, cmd
+    return True, cmd[:m.start()].rstrip()
+
+def _expansion_source(cmd):
+    """Python source for cmd with its {expr} and $var fields expanded.
+
+    This compiles what get_ipython().var_expand() does at runtime into the
+    generated code: the command is parsed with the same DollarFormatter, each
+    field becomes an expression in a lambda defined where the command runs, and
+    get_ipython().interpolate() formats their values into a precomputed
+    template. The lambda keeps a failing field from raising, but can't see a
+    class body's names, so commands there aren't compiled this way (see
+    _in_class_body()). If a field can't be evaluated, or the command can't be
+    parsed, the result is the unexpanded command, as with var_expand().
+
+    Returns None if a field can't be embedded in a single line of code (it
+    contains a comment), in which case the command is expanded at runtime.
+    """
+    from .text import DollarFormatter, compile_field
+    try:
+        parsed = list(DollarFormatter().parse(cmd))
+    except Exception:
+        return repr(cmd)
+
+    literal = []
+    template = []
+    fields = []
+    for literal_text, field_name, format_spec, conversion in parsed:
+        literal.append(literal_text)
+        template.append(literal_text.replace('{', '{{').replace('}', '}}'))
+        if field_name is None:
+            continue
+
+        if format_spec:
+            # As in FullEvalFormatter, ':' is slicing rather than a format spec.
+            field_name = ':'.join([field_name, format_spec])
+        if conversion not in (None, 'r', 's', 'a'):
+            return repr(cmd)
+        try:
+            compile_field(field_name)
+        except (SyntaxError, ValueError):
+            return repr(cmd)
+        if '#' in field_name:
+            return None
+
+        template.append('{%d%s}' % (
+            len(fields), '' if conversion is None else '!' + conversion))
+        fields.append('(%s)' % field_name.strip())
+
+    if not fields:
+        return repr(''.join(literal))
+
+    return 'get_ipython().interpolate(%r, %r, lambda: (%s,))' % (
+        cmd, ''.join(template), ', '.join(fields))
+
+_scope_header_re = re.compile(r"^(class|def|async\s+def)\b")
+
+def _in_class_body(lines, line_ix):
+    """Whether the statement on lines[line_ix] is directly in a class body.
+
+    A lambda defined there can't see the names the class body defines, so the
+    fields of commands there are expanded at runtime instead. This looks at the
+    enclosing blocks' headers only, by indentation; when in doubt (e.g. a
+    dedented line in a multi-line string), it says True, which is always
+    correct, if slower.
+    """
+    def width(line):
+        line = line.expandtabs(8)
+        return len(line) - len(line.lstrip())
+
+    indent = width(lines[line_ix])
+    for line in reversed(lines[:line_ix]):
+        stripped = line.strip()
+        if indent == 0:
+            break
+        if not stripped or stripped.startswith('#') or width(line) >= indent:
+            continue
+        indent = width(line)
+        m = _scope_header_re.match(stripped)
+        if m:
+            return m.group(1) == 'class'
+        if stripped.startswith(('"', "'")):
+            return True
+    return False
+
+def _command_args(cmd, compile_time_expansion):
+    """Source for the arguments passing cmd to system() or getoutput()."""
+    if compile_time_expansion:
+        source = _expansion_source(cmd)
+        if source is not None:
+            return [source, 'expand=False']
+    return [repr(cmd)]
+
+def _tr_system(content, compile_time_expansion=False):
+    "Translate lines escaped with: !"
+    modifiers, cmd = _split_modifiers(content, captured=False)
+    background, cmd = _split_background(cmd)
+    args = _command_args(cmd, compile_time_expansion) + modifiers
+    if background:
+        args.append('background=True')
+    return 'get_ipython().system(%s)' % ', '.join(args)
+
+def _tr_sh_cap(content, compile_time_expansion=False):
+    "Translate captured commands: a = !foo and !!foo"
+    modifiers, cmd = _split_modifiers(content)
+    background, cmd = _split_background(cmd)
+    args = _command_args(cmd, compile_time_expansion) + modifiers
+    if background:
+        args.append('background=True')
+    return 'get_ipython().getoutput(%s)' % ', '.join(args)
+
+tr = { ESC_SHELL  : _tr_system,
+       ESC_SH_CAP : _tr_sh_cap,
        ESC_HELP   : _tr_help,
        ESC_HELP2  : _tr_help2,
        ESC_MAGIC  : _tr_magic,
@@ -417,7 +593,10 @@ class EscapedCommand(TokenTransformBase):
         else:
             escape, content = line[:1], line[1:]
 
-        if escape in tr:
+        if escape in (ESC_SHELL, ESC_SH_CAP):
+            call = tr[escape](content, self.compile_time_expansion and
+                              not _in_class_body(lines, start_line))
+        elif escape in tr:
             call = tr[escape](content)
         else:
             call = ''
@@ -426,7 +605,10 @@ class EscapedCommand(TokenTransformBase):
         new_line = indent + call + '\n'
         lines_after = lines[end_line + 1:]
 
-        return lines_before + [new_line] + lines_after
+        # Blank lines stand in for any continuation lines, so that later
+        # lines keep their line numbers.
+        return (lines_before + [new_line] + ['\n'] * (end_line - start_line)
+                + lines_after)
 
 _help_end_re = re.compile(r"""(%{0,2}
                               [a-zA-Z_*][\w*]*        # Variable name
@@ -593,6 +775,83 @@ def make_tokens_by_line(lines): #:List[str]):
 
     return tokens_by_line
 
+class TokenizerState(collections.namedtuple(
+        'TokenizerState', 'indents parenlev group_parenlev')):
+    """Tokenizer state at a boundary between two lines of tokens.
+
+    ``indents`` holds the whitespace of each open indentation level (the
+    ``string`` of the INDENT tokens), ``parenlev`` is the bracket depth as
+    counted by :mod:`tokenize` and ``group_parenlev`` is the bracket depth as
+    counted by ``make_tokens_by_line()``.
+    """
+    __slots__ = ()
+
+TokenizerState.INITIAL = TokenizerState((), 0, 0)
+
+def iter_tokens_by_line(lines, start_line=0, state=TokenizerState.INITIAL):
+    """Tokenize ``lines[start_line:]`` lazily and group tokens by line.
+
+    Tokens are grouped exactly as ``make_tokens_by_line()`` groups them, and
+    carry their positions within *lines*. Tokenizing starts at *start_line*
+    as though ``lines[:start_line]`` had already been consumed, leaving the
+    tokenizer in *state*: a few synthetic lines which recreate the indentation
+    stack and bracket depth are fed to the tokenizer first, and their tokens
+    are dropped.
+
+    Yields ``(start_line, state, tokens)`` for each line of tokens, where
+    *start_line* and *state* describe the point just before *tokens* and can
+    be passed back in to resume tokenizing there.
+    """
+    NEWLINE, NL, INDENT, DEDENT, OP = (tokenize.NEWLINE, tokenize.NL,
+        tokenize.INDENT, tokenize.DEDENT, tokenize.OP)
+    indents, parenlev, group_parenlev = state
+    indents = list(indents)
+    prefix = [indent + '0\n' for indent in indents]
+    if parenlev < 0:
+        prefix.append((indents[-1] if indents else '') + ')' * -parenlev + '\n')
+    row_offset = start_line - len(prefix)
+
+    feed = iter(prefix + lines[start_line:])
+    line_tokens = []
+    line_start = start_line
+    line_state = TokenizerState(tuple(indents), parenlev, group_parenlev)
+    try:
+        for tok in tokenize.generate_tokens(lambda: next(feed)):
+            if tok[2][0] <= len(prefix):
+                continue
+            tok = TokenInfo(tok[0], tok[1],
+                            (tok[2][0] + row_offset, tok[2][1]),
+                            (tok[3][0] + row_offset, tok[3][1]), tok[4])
+            line_tokens.append(tok)
+            if tok.type == INDENT:
+                indents.append(tok.string)
+            elif tok.type == DEDENT:
+                indents.pop()
+            elif tok.type == OP:
+                if tok.string in '([{':
+                    parenlev += 1
+                elif tok.string in ')]}':
+                    parenlev -= 1
+
+            if (tok.type == NEWLINE) \
+                    or ((tok.type == NL) and (group_parenlev <= 0)):
+                yield line_start, line_state, line_tokens
+                line_tokens = []
+                line_start = tok.end[0]
+                line_state = TokenizerState(
+                    tuple(indents), parenlev, group_parenlev)
+            elif tok.string in {'(', '[', '{'}:
+                group_parenlev += 1
+            elif tok.string in {')', ']', '}'}:
+                if group_parenlev > 0:
+                    group_parenlev -= 1
+    except tokenize.TokenError:
+        # Input ended in a multiline string or expression. That's OK for us.
+        pass
+
+    if line_tokens:
+        yield line_start, line_state, line_tokens
+
 def show_linewise_tokens(s): #: str):
     """For investigation and debugging"""
     if not s.endswith('\n'):
@@ -612,7 +871,9 @@ class TransformerManager:
     The key methods for external use are ``transform_cell()``
     and ``check_complete()``.
     """
-    def __init__(self):
+    def __init__(self, single_pass=True, compile_time_expansion=False):
+        self.single_pass = single_pass
+        self.compile_time_expansion = compile_time_expansion
         self.cleanup_transforms = [
             leading_empty_lines,
             leading_indent,
@@ -629,6 +890,12 @@ class TransformerManager:
             HelpEnd,
         ]
 
+    def _find(self, transformer_cls, tokens_by_line):
+        transformer = transformer_cls.find(tokens_by_line)
+        if transformer:
+            transformer.compile_time_expansion = self.compile_time_expansion
+        return transformer
+
     def do_one_token_transform(self, lines):
         """Find and run the transform earliest in the code.
 
@@ -646,7 +913,7 @@ class TransformerManager:
         tokens_by_line = make_tokens_by_line(lines)
         candidates = []
         for transformer_cls in self.token_transformers:
-            transformer = transformer_cls.find(tokens_by_line)
+            transformer = self._find(transformer_cls, tokens_by_line)
             if transformer:
                 candidates.append(transformer)
 
@@ -661,7 +928,7 @@ class TransformerManager:
                 pass
         return False, lines
 
-    def do_token_transforms(self, lines):
+    def do_iterative_token_transforms(self, lines):
         for _ in range(TRANSFORM_LOOP_LIMIT):
             changed, lines = self.do_one_token_transform(lines)
             if not changed:
@@ -670,6 +937,74 @@ class TransformerManager:
         raise RuntimeError("Input transformation still changing after "
                            "%d iterations. Aborting." % TRANSFORM_LOOP_LIMIT)
 
+    def do_single_pass_token_transforms(self, lines):
+        """Run all token transformations, tokenizing the cell once.
+
+        This gives the same result as ``do_iterative_token_transforms()``, but
+        instead of retokenizing the whole cell after each transformation, it
+        resumes tokenizing at the start of the line of tokens that was just
+        rewritten. The cost is then roughly linear in the length of the cell,
+        rather than proportional to length times the number of transformations.
+
+        Unlike the iterative loop, there is no limit on the total number of
+        transformations; only a line which keeps being rewritten is an error.
+        """
+        # Transformers whose first match raised SyntaxError, mapped to the line
+        # where the failing match starts. The iterative loop keeps finding (and
+        # failing on) that match, so such a transformer can't apply to later
+        # lines unless the failing line itself is rewritten.
+        failed_at = {}
+        start_line, state = 0, TokenizerState.INITIAL
+        rewrites = 0
+        while True:
+            for line_start, line_state, line in iter_tokens_by_line(
+                    lines, start_line, state):
+                candidates = []
+                for transformer_cls in self.token_transformers:
+                    if failed_at.get(transformer_cls, line_start) < line_start:
+                        continue
+                    transformer = self._find(transformer_cls, [line])
+                    if transformer:
+                        candidates.append(transformer)
+
+                transformed = None
+                for transformer in sorted(candidates, key=TokenTransformBase.sortby):
+                    try:
+                        transformed = transformer.transform(lines)
+                        break
+                    except SyntaxError:
+                        failed_at[type(transformer)] = line_start
+
+                if transformed is not None:
+                    break
+
+            else:
+                return lines
+
+            if line_start != start_line:
+                rewrites = 0
+            rewrites += 1
+            if rewrites > TRANSFORM_LOOP_LIMIT:
+                raise RuntimeError("Input transformation still changing after "
+                                   "%d iterations. Aborting." % TRANSFORM_LOOP_LIMIT)
+
+            lines = transformed
+            start_line, state = line_start, line_state
+            failed_at = dict((cls, failed_line)
+                             for cls, failed_line in failed_at.items()
+                             if failed_line != line_start)
+
+    def do_token_transforms(self, lines):
+        if self.single_pass:
+            try:
+                return self.do_single_pass_token_transforms(lines)
+            except SyntaxError:
+                # Usually an IndentationError from the tokenizer. Let the
+                # iterative loop raise it with the usual line numbers.
+                pass
+
+        return self.do_iterative_token_transforms(lines)
+
     def transform_cell(self, cell): #: str): -> str:
         """Transforms a cell of input code"""
         if not cell.endswith('\n'):
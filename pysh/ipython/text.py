@@ -9,14 +9,18 @@ Inheritance diagram:
 """
 
 from __future__ import print_function
+import collections
 import os
 import re
 import sys
-import textwrap
+import threading
 from string import Formatter
 #from pathlib import Path
 
-from . import py3compat
+# textwrap is imported where it's used and py3compat only on Python 2, as
+# pysh imports this module whenever a script runs a command.
+if sys.version_info[0] == 2:
+    from . import py3compat
 
 # datetime.strftime date format for ipython
 if sys.platform == 'win32':
@@ -162,6 +166,7 @@ def dedent(text):
 
     For use in wrap_paragraphs.
     """
+    import textwrap
 
     if text.startswith('\n'):
         # text starts with blank line, don't ignore the first line
@@ -190,6 +195,7 @@ def wrap_paragraphs(text, ncols=80):
 
     list of complete paragraphs, wrapped to fill `ncols` columns.
     """
+    import textwrap
     paragraph_re = re.compile(r'\n(\s*\n)+', re.MULTILINE)
     text = dedent(text).strip()
     paragraphs = paragraph_re.split(text)[::2] # every other entry is space
@@ -309,6 +315,73 @@ class EvalFormatter(Formatter):
 # inside [], so EvalFormatter can handle slicing. Once we only support 3.4 and
 # above, it should be possible to remove FullEvalFormatter.
 
+#-----------------------------------------------------------------------------
+# Cache of parsed format strings
+#-----------------------------------------------------------------------------
+
+# Most recently used format strings kept by FullEvalFormatter.vformat().
+TEMPLATE_CACHE_SIZE = 512
+
+CacheInfo = collections.namedtuple(
+    'CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+def compile_field(field_name):
+    """Compile a format field to the code eval(field_name, ...) would run.
+
+    Like eval(), this ignores leading spaces and tabs, and the code object has
+    the same '<string>' filename.
+    """
+    return compile(field_name.lstrip(' \t'), '<string>', 'eval')
+
+
+class TemplateCache(object):
+    """A bounded, thread-safe LRU mapping of keys to parsed templates.
+
+    The hits and misses attributes count lookups since the last clear().
+    """
+
+    def __init__(self, maxsize=TEMPLATE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, build):
+        """Return the entry for key, calling build() to create it if needed.
+
+        Exceptions from build() propagate, and nothing is cached.
+        """
+        with self._lock:
+            try:
+                # Re-inserting moves the entry to the most recently used end.
+                value = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries[key] = value
+                return value
+
+        value = build()
+        with self._lock:
+            self._entries[key] = value
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+    def info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize,
+                         len(self._entries))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
 class FullEvalFormatter(Formatter):
     """A String Formatter that allows evaluation of simple expressions.
 
@@ -332,29 +405,54 @@ class FullEvalFormatter(Formatter):
         In [4]: f.format('{3*2}')
         Out[4]: '6'
     """
+    # Parsed format strings, shared by all instances (and keyed by the
+    # formatter's type, since subclasses parse differently).
+    template_cache = TemplateCache()
+
+    def _parse_template(self, format_string):
+        """Parse format_string into (literal, field code, conversion) tuples.
+
+        The field code is the compiled field, ready for eval(); if it doesn't
+        compile, it is the field source, so eval() raises the same error each
+        time it is used.
+        """
+        template = []
+        for literal_text, field_name, format_spec, conversion in \
+                self.parse(format_string):
+            code = None
+            if field_name is not None:
+                if format_spec:
+                    # override format spec, to allow slicing:
+                    field_name = ':'.join([field_name, format_spec])
+
+                try:
+                    code = compile_field(field_name)
+                except (SyntaxError, ValueError):
+                    code = field_name
+
+            template.append((literal_text, code, conversion))
+
+        return tuple(template)
+
     # copied from Formatter._vformat with minor changes to allow eval
     # and replace the format_spec code with slicing
     def vformat(self, format_string, args, kwargs):
+        template = self.template_cache.get(
+            (type(self), format_string),
+            lambda: self._parse_template(format_string))
+
         result = []
-        for literal_text, field_name, format_spec, conversion in \
-                self.parse(format_string):
+        for literal_text, code, conversion in template:
 
             # output the literal text
             if literal_text:
                 result.append(literal_text)
 
             # if there's a field, output it
-            if field_name is not None:
-                # this is some markup, find the object and do
-                # the formatting
-
-                if format_spec:
-                    # override format spec, to allow slicing:
-                    field_name = ':'.join([field_name, format_spec])
-
+            if code is not None:
                 # eval the contents of the field for the object
                 # to be formatted
-                obj = eval(field_name, kwargs)
+                obj = eval(code, kwargs)
 
                 # do any conversion on the resulting object
                 obj = self.convert_field(obj, conversion)
@@ -362,7 +460,9 @@ class FullEvalFormatter(Formatter):
                 # format the object and append to the result
                 result.append(self.format_field(obj, ''))
 
-        return ''.join(py3compat.cast_unicode(s) for s in result)
+        if sys.version_info[0] == 2:
+            return ''.join(py3compat.cast_unicode(s) for s in result)
+        return ''.join(result)
 
 
 class DollarFormatter(FullEvalFormatter):
@@ -384,7 +484,7 @@ class DollarFormatter(FullEvalFormatter):
         In [4]: f.format('$a or {b}', a=1, b=2)
         Out[4]: '1 or 2'
     """
-    _dollar_pattern_ignore_single_quote = re.compile(r"(.*?)\$(\$?[\w\.]+)(?=([^']*'[^']*')*[^']*$)")
+    _dollar_name_pattern = re.compile(r"\$?[\w\.]+")
     def parse(self, fmt_string):
         for literal_txt, field_name, format_spec, conversion \
                     in Formatter.parse(self, fmt_string):
@@ -392,19 +492,43 @@ class DollarFormatter(FullEvalFormatter):
             # Find $foo patterns in the literal text.
             continue_from = 0
             txt = ""
-            for m in self._dollar_pattern_ignore_single_quote.finditer(literal_txt):
-                new_txt, new_field = m.group(1,2)
+            for start, end in self._dollar_fields(literal_txt):
+                new_txt = literal_txt[continue_from:start]
+                new_field = literal_txt[start + 1:end]
                 # $$foo --> $foo
                 if new_field.startswith("$"):
                     txt += new_txt + new_field
                 else:
                     yield (txt + new_txt, new_field, "", None)
                     txt = ""
-                continue_from = m.end()
+                continue_from = end
 
             # Re-yield the {foo} style pattern
             yield (txt + literal_txt[continue_from:], field_name, format_spec, conversion)
 
+    def _dollar_fields(self, txt):
+        """Yield (start, end) of each $foo or $$foo in txt, in one pass.
+
+        A $ only counts if an even number of single quotes follows it, so
+        '$foo' in single quotes is left alone. Rather than look ahead from
+        every $, count the quotes once and keep a running total.
+        """
+        match_name = self._dollar_name_pattern.match
+        quotes_after = txt.count("'")
+        pos = 0
+        while True:
+            start = txt.find("$", pos)
+            if start < 0:
+                return
+            quotes_after -= txt.count("'", pos, start)
+            pos = start + 1
+            if quotes_after % 2:
+                continue
+            m = match_name(txt, pos)
+            if m is not None:
+                pos = m.end()
+                yield start, pos
+
 #-----------------------------------------------------------------------------
 # Utils to columnize a list of string
 #-----------------------------------------------------------------------------
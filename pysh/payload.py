@@ -0,0 +1,181 @@
+"""The copy of pysh that `pysh dist` appends to a script, as a zip.
+
+Only the modules a script can import at run time are included: those
+reachable from pysh/__init__.py (and runtime_cache.py, which the bootstrap
+uses) through import statements, including the ones inside functions, so e.g.
+the generator and the fork server are left out.
+Dist scripts require Python 3, so imports under `if sys.version_info[0] == 2`
+don't count.
+Each module is there as source, and also as a .pyc compiled (with -OO) for
+the Python which builds the payload, unless that's Python 2. zipimport tries
+the .pyc first and falls back to the source when the script runs under
+another Python version. The .pyc files are unchecked hash-based (PEP 552):
+they don't depend on timestamps, which zip entries don't keep precisely.
+
+The build is reproducible: entries are sorted, with fixed timestamps and
+permissions, so the same sources and Python give the same bytes. The zip
+comment records a hash of the contents, see payload_hash().
+"""
+
+import ast
+import hashlib
+import io
+import marshal
+import os
+import sys
+import zipfile
+
+from . import compiler
+
+
+PACKAGE = 'pysh'
+
+# The roots of the dependency analysis: what the bootstrap imports.
+ENTRY_MODULES = (PACKAGE, PACKAGE + '.runtime_cache')
+
+COMMENT_PREFIX = b'pysh-payload sha256:'
+
+_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+
+def _package_dir():
+  return os.path.dirname(os.path.abspath(__file__))
+
+
+def module_path(name, package_dir=None):
+  """The path of the module with the given name, or None if there's none."""
+  package_dir = package_dir or _package_dir()
+  parts = name.split('.')
+  if parts[0] != PACKAGE:
+    return None
+
+  base = os.path.join(package_dir, *parts[1:])
+  for path in (os.path.join(base, '__init__.py'), base + '.py'):
+    if os.path.isfile(path):
+      return path
+  return None
+
+
+_PY2_TEST = ast.dump(ast.parse('sys.version_info[0] == 2', mode='eval').body)
+
+
+def _walk_py3(node):
+  # Like ast.walk(), skipping what only runs on Python 2.
+  pending = [node]
+  while pending:
+    node = pending.pop()
+    yield node
+    if isinstance(node, ast.If) and ast.dump(node.test) == _PY2_TEST:
+      pending.extend(node.orelse)
+    else:
+      pending.extend(ast.iter_child_nodes(node))
+
+
+def _imported_names(tree, name, is_package):
+  # Every module name an import in the tree could refer to.
+  package = name if is_package else name.rpartition('.')[0]
+  for node in _walk_py3(tree):
+    if isinstance(node, ast.Import):
+      for alias in node.names:
+        yield alias.name
+    elif isinstance(node, ast.ImportFrom):
+      if node.level:
+        base = package.split('.')
+        base = base[:len(base) - node.level + 1]
+        if node.module:
+          base.append(node.module)
+        module = '.'.join(base)
+      else:
+        module = node.module
+      yield module
+      # `from . import runtime` imports a module, too.
+      for alias in node.names:
+        yield '{}.{}'.format(module, alias.name)
+
+
+def find_modules(package_dir=None, entries=ENTRY_MODULES):
+  """Return {module name: path} of the modules the entries can import.
+
+  The packages which contain each module are included too.
+  """
+  package_dir = package_dir or _package_dir()
+  found = {}
+  pending = list(entries)
+  while pending:
+    name = pending.pop()
+    if name in found:
+      continue
+    path = module_path(name, package_dir)
+    if path is None:
+      continue
+
+    found[name] = path
+    with open(path, 'rb') as source_f:
+      tree = ast.parse(source_f.read(), path)
+    is_package = os.path.basename(path) == '__init__.py'
+    for imported in _imported_names(tree, name, is_package):
+      parts = imported.split('.')
+      # Importing a module imports its packages first.
+      for i in range(1, len(parts) + 1):
+        pending.append('.'.join(parts[:i]))
+
+  return found
+
+
+def _entries(modules, optimize):
+  # (zip path, data) for each file, in order.
+  entries = []
+  for name, path in modules.items():
+    zip_path = '/'.join(name.split('.'))
+    if os.path.basename(path) == '__init__.py':
+      zip_path += '/__init__'
+    with open(path, 'rb') as source_f:
+      source = source_f.read()
+
+    entries.append((zip_path + '.py', source))
+    if sys.version_info[0] > 2:
+      code = compile(source, zip_path + '.py', 'exec', dont_inherit=True,
+                     optimize=optimize)
+      entries.append((zip_path + '.pyc',
+                      compiler.pyc_header(source) + marshal.dumps(code)))
+
+  return sorted(entries)
+
+
+def build(package_dir=None, optimize=2):
+  """Return the payload, a zip of pysh, as bytes."""
+  entries = _entries(find_modules(package_dir), optimize)
+  content_hash = hashlib.sha256()
+  for zip_path, data in entries:
+    content_hash.update(zip_path.encode('utf-8') + b'\0')
+    content_hash.update(hashlib.sha256(data).digest())
+
+  payload_f = io.BytesIO()
+  # compresslevel is new in Python 3.7; older ones use zlib's default.
+  kwargs = {'compresslevel': 9} if sys.version_info >= (3, 7) else {}
+  with zipfile.ZipFile(payload_f, 'w', zipfile.ZIP_DEFLATED,
+                       **kwargs) as zip_f:
+    for zip_path, data in entries:
+      info = zipfile.ZipInfo(zip_path, date_time=_DATE_TIME)
+      info.compress_type = zipfile.ZIP_DEFLATED
+      info.create_system = 3
+      info.external_attr = 0o644 << 16
+      zip_f.writestr(info, data)
+    zip_f.comment = COMMENT_PREFIX + content_hash.hexdigest().encode('ascii')
+
+  return payload_f.getvalue()
+
+
+def payload_hash(data):
+  """Return the content hash recorded in a payload, or None.
+
+  data may be the payload, or anything ending with it (such as a script).
+  """
+  if isinstance(data, bytes):
+    data = io.BytesIO(data)
+  with zipfile.ZipFile(data) as zip_f:
+    comment = zip_f.comment
+  if not comment.startswith(COMMENT_PREFIX):
+    return None
+  return comment[len(COMMENT_PREFIX):].decode('ascii')
+
@@ -0,0 +1,149 @@
+"""Per-line profiling of pysh scripts, for `pysh run --profile`.
+
+A sampling thread looks at the script's main thread every millisecond or so
+and charges the time since its last look to the script line being run then.
+Since it measures wall time, a line spends waiting on a `!` command counts as
+much as one spent running Python, unlike with cProfile. The input transformer
+keeps line numbers, so they refer to the original script.
+
+Each line gets two times: self, while it was the innermost script line being
+run, and total, while it was on the stack at all (e.g. a call to a function
+the script defines). Only the thread which runs the script is sampled, so
+commands run by pmap() show up as the pmap() line waiting for them.
+
+Optionally, the profiler also writes:
+  - collapsed stacks (`frame;frame;frame microseconds` per line), as read by
+    flamegraph.pl, speedscope and similar tools. Frames start at the script.
+  - cProfile statistics, for pstats or snakeviz. These are per function
+    rather than per line, and cProfile slows down Python-heavy scripts.
+"""
+
+from __future__ import print_function
+import collections
+import linecache
+import os
+import sys
+import threading
+import time
+
+try:
+  _now = time.monotonic
+except AttributeError:
+  _now = time.time
+
+
+DEFAULT_INTERVAL = 0.001
+
+
+class Profiler(object):
+  """Samples a script's main thread while it runs.
+
+  Args:
+    filename: the filename the script's code was compiled with.
+    interval: seconds between samples.
+    collapsed_path: if given, where to write collapsed stacks.
+    pstats_path: if given, also run cProfile and write its stats there.
+  """
+
+  def __init__(self, filename, interval=DEFAULT_INTERVAL, collapsed_path=None,
+               pstats_path=None):
+    self.filename = filename
+    self.interval = interval
+    self.collapsed_path = collapsed_path
+    self.pstats_path = pstats_path
+    self.self_time = collections.defaultdict(float)
+    self.total_time = collections.defaultdict(float)
+    self.stacks = collections.defaultdict(float)
+    self.samples = 0
+    self.wall_time = 0.0
+    self._thread_id = None
+    self._sampler = None
+    self._stopped = threading.Event()
+    self._cprofile = None
+    self._start = None
+
+  def start(self):
+    """Start profiling the calling thread."""
+    self._thread_id = threading.current_thread().ident
+    self._start = _now()
+    self._sampler = threading.Thread(target=self._sample)
+    self._sampler.daemon = True
+    self._sampler.start()
+    if self.pstats_path:
+      import cProfile
+      self._cprofile = cProfile.Profile()
+      self._cprofile.enable()
+
+  def stop(self):
+    """Stop profiling, and write the stats files asked for."""
+    if self._cprofile is not None:
+      self._cprofile.disable()
+      self._cprofile.dump_stats(self.pstats_path)
+      self._cprofile = None
+    self._stopped.set()
+    self._sampler.join()
+    self.wall_time = _now() - self._start
+
+    if self.collapsed_path:
+      with open(self.collapsed_path, 'w') as collapsed_f:
+        for stack, seconds in sorted(self.stacks.items()):
+          collapsed_f.write('{} {}\n'.format(stack, int(seconds * 1e6)))
+
+  def _sample(self):
+    last = _now()
+    while not self._stopped.wait(self.interval):
+      frame = sys._current_frames().get(self._thread_id)
+      now = _now()
+      if frame is not None:
+        self._record(frame, now - last)
+      last = now
+      # Dropped at once, so the sampled frames aren't kept alive.
+      frame = None
+
+  def _record(self, frame, elapsed):
+    stack = []
+    while frame is not None:
+      stack.append(frame)
+      frame = frame.f_back
+
+    # Innermost first; frames outside the script (e.g. pysh's own) are only
+    # kept below the script's first frame.
+    script_depths = [i for i, f in enumerate(stack)
+                     if f.f_code.co_filename == self.filename]
+    if not script_depths:
+      return
+
+    self.samples += 1
+    script_lines = [stack[i].f_lineno for i in script_depths]
+    self.self_time[script_lines[0]] += elapsed
+    for lineno in set(script_lines):
+      self.total_time[lineno] += elapsed
+
+    if self.collapsed_path:
+      frames = reversed(stack[:script_depths[-1] + 1])
+      self.stacks[';'.join(_frame_name(f) for f in frames)] += elapsed
+
+  def report(self, out=None, limit=20):
+    """Print the lines which took the most time."""
+    out = out if out is not None else sys.stderr
+    print('pysh profile of {}: {:.3f}s wall, {} samples'.format(
+      self.filename, self.wall_time, self.samples), file=out)
+    print('{:>6}  {:>10}  {:>10}  {:>6}  {}'.format(
+      'line', 'self ms', 'total ms', 'self%', 'source'), file=out)
+
+    lines = sorted(self.total_time,
+                   key=lambda l: (-self.self_time.get(l, 0.0),
+                                  -self.total_time[l], l))
+    for lineno in lines[:limit]:
+      self_s = self.self_time.get(lineno, 0.0)
+      source = linecache.getline(self.filename, lineno).strip()
+      print('{:>6}  {:>10.1f}  {:>10.1f}  {:>5.1f}%  {}'.format(
+        lineno, self_s * 1e3, self.total_time[lineno] * 1e3,
+        100 * self_s / self.wall_time if self.wall_time else 0.0,
+        source), file=out)
+
+
+def _frame_name(frame):
+  code = frame.f_code
+  return '{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename),
+                             frame.f_lineno)
@@ -1,116 +1,74 @@
 from __future__ import print_function
 import os.path
-import re
-import subprocess
 import sys
 
-from .ipython import inputtransformer2
-from .ipython import text
-
-
-class CalledProcessError(Exception):
-    """Raised when run() is called with check=True and the process
-    returns a non-zero exit status.
-    Attributes:
-      cmd, returncode, stdout, stderr, output
-    """
-    def __init__(self, returncode, cmd, output=None, stderr=None):
-        self.returncode = returncode
-        self.cmd = cmd
-        self.output = output
-        self.stderr = stderr
-
-    def __str__(self):
-        if self.returncode and self.returncode < 0:
-            try:
-                return "Command '%s' died with %r." % (
-                        self.cmd, signal.Signals(-self.returncode))
-            except ValueError:
-                return "Command '%s' died with unknown signal %d." % (
-                        self.cmd, -self.returncode)
-        else:
-            return "Command '%s' returned non-zero exit status %d." % (
-                    self.cmd, self.returncode)
-
-    @property
-    def stdout(self):
-        """Alias for output attribute, to match stderr"""
-        return self.output
-
-    @stdout.setter
-    def stdout(self, value):
-        # There's no obvious reason to set this, but allow it anyway so
-        # .stdout is a transparent alias for .output
-        self.output = value
-
-
-class IPythonStub:
-
-  def __init__(self):
-    self.user_ns = {}
-
-  def var_expand(self, cmd, depth=0, formatter=text.DollarFormatter()):
-    """Expand python variables in a string.
-
-    The depth argument indicates how many frames above the caller should
-    be walked to look for the local namespace where to expand variables.
-
-    The global namespace for expansion is always the user's interactive
-    namespace.
-    """
-    ns = self.user_ns.copy()
-    try:
-      frame = sys._getframe(depth+1)
-    except ValueError:
-      # This is thrown if there aren't that many frames on the stack,
-      # e.g. if a script called run_line_magic() directly.
-      pass
-    else:
-      ns.update(frame.f_locals)
+from . import cache
+from . import embedded
+from . import runtime
+from .runtime import CalledProcessError, IPythonStub, get_ipython
+
+
+# Part of the cache key; bump it when the transformer's output changes, so
+# scripts compiled by an older transformer are recompiled.
+TRANSFORM_VERSION = '2'
+
+def read_script(path):
+  """Return the text of the script at path, without any embedded modules."""
+  # Read as bytes, and only up to the notice: what follows is a zip.
+  lines = []
+  with open(path, 'rb') as script_f:
+    for line in script_f:
+      if line == embedded.NOTICE_LINE:
+        break
+      lines.append(line)
+  return b''.join(lines).decode('utf-8')
 
-    try:
-      # We have to use .vformat() here, because 'self' is a valid and common
-      # name, and expanding **ns for .format() would make it collide with
-      # the 'self' argument of the method.
-      cmd = formatter.vformat(cmd, args=[], kwargs=ns)
-    except Exception:
-      # if formatter couldn't format, just let it go untransformed
-      pass
-
-    return cmd
-
-  def system(self, *args):
-    depth = 1 if sys.version_info[0] == 2 else 2
-    proc = subprocess.Popen([self.var_expand(a, depth=depth) for a in args],
-                            shell=True)
-    proc.wait()
-    if proc.returncode != 0:
-      raise CalledProcessError(proc.returncode, args, None, None)
-
-  def getoutput(self, *args):
-    kw = dict(shell=True, stdout=subprocess.PIPE)
-    if sys.version_info[0] == 3:
-      kw['encoding'] = 'utf-8'
-
-    proc = subprocess.Popen([self.var_expand(a, depth=2) for a in args], **kw)
-    out, _ = proc.communicate()
-    if proc.returncode != 0:
-      raise CalledProcessError(proc.returncode, args, out, None)
-
-    return out
 
 class Executor:
 
-  def __init__(self, script):
+  def __init__(self, script, use_cache=True, profiler=None):
     self.script = script
-    self.transformer_manager = inputtransformer2.TransformerManager()
+    self.use_cache = use_cache and cache.is_enabled()
+    # A profiler.Profiler to run the script under, if any.
+    self.profiler = profiler
+    self.compile_time_expansion = runtime.compile_time_expansion()
+    self._transformer_manager = None
+
+  @property
+  def transformer_manager(self):
+    # Imported lazily: scripts loaded from the bytecode cache never need it.
+    if self._transformer_manager is None:
+      from .ipython import inputtransformer2
+      self._transformer_manager = inputtransformer2.TransformerManager(
+        compile_time_expansion=self.compile_time_expansion)
+
+    return self._transformer_manager
+
+  def compile(self, script_text):
+    transformed = self.transformer_manager.transform_cell(script_text)
+    return compile(transformed, filename=self.script, mode='exec')
 
-  def execute(self):
-    with open(self.script) as script_f:
-      script_text = script_f.read()
+  def load_code(self):
+    """Return the code object for the script, using the bytecode cache."""
+    script_text = read_script(self.script)
 
-    transformed = self.transformer_manager.transform_cell(script_text)
-    code = compile(transformed, filename=self.script, mode='exec')
+    if not self.use_cache:
+      return self.compile(script_text)
+
+    bytecode_cache = cache.BytecodeCache()
+    key = bytecode_cache.make_key(
+      script_text, self.script,
+      ['transform=' + TRANSFORM_VERSION,
+       'expand=compile' if self.compile_time_expansion else 'expand=runtime'])
+    code = bytecode_cache.load(self.script, key)
+    if code is None:
+      code = self.compile(script_text)
+      bytecode_cache.store(self.script, key, code)
+
+    return code
+
+  def execute(self):
+    code = self.load_code()
     old_sys_path = sys.path
 
     package_dir = os.path.dirname(self.script) or os.getcwd()
@@ -121,14 +79,20 @@ class Executor:
 
     sys.argv[0] = self.script
 
-    globals_locals = {'get_ipython': IPythonStub,
+    globals_locals = {'get_ipython': get_ipython,
                       '__name__': '__main__'}
+    if self.profiler is not None:
+      self.profiler.start()
     try:
 
       exec(code, globals_locals, globals_locals)
     except:
       sys.path = old_sys_path
       raise
+    finally:
+      if self.profiler is not None:
+        self.profiler.stop()
+        self.profiler.report()
 
-def main(script):
-  Executor(script).execute()
+def main(script, use_cache=True, profiler=None):
+  Executor(script, use_cache=use_cache, profiler=profiler).execute()
@@ -0,0 +1,859 @@
+"""Runtime support for transformed pysh code.
+
+Code produced by the input transformer calls ``get_ipython()`` to run shell
+commands. This module provides it without depending on the transformer, so
+pre-compiled scripts only need to import this module.
+"""
+
+from __future__ import print_function
+import os
+import signal
+import subprocess
+import sys
+
+from . import shell
+from .errors import CalledProcessError
+
+
+# Set to any non-empty value to always run commands through /bin/sh.
+NO_DIRECT_EXEC_ENV_VAR = 'PYSH_NO_DIRECT_EXEC'
+
+# Whether simple commands are exec'd directly rather than through /bin/sh.
+DIRECT_EXEC = not os.environ.get(NO_DIRECT_EXEC_ENV_VAR)
+
+# Values accepted for the capture argument of getoutput(); see also capture.py.
+CAPTURE_MODES = (None, 'lines', 'bytes', 'bytearray', 'mmap', 'bounded',
+                 'both')
+
+# Capture modes whose output is decoded as text.
+TEXT_CAPTURE_MODES = (None, 'lines')
+
+# Set to 'runtime' to expand {expr} and $var in commands when they run, as
+# get_ipython().var_expand() does, instead of compiling the expansion into the
+# transformed script.
+EXPAND_ENV_VAR = 'PYSH_EXPAND'
+
+# Set to a file to record a span for each command run; see tracing.py.
+TRACE_ENV_VAR = 'PYSH_TRACE'
+
+# Set to any non-empty value to run commands in one long-lived /bin/sh, as in
+# a shell_session() block.
+SHELL_SESSION_ENV_VAR = 'PYSH_SHELL_SESSION'
+
+
+def compile_time_expansion():
+  """Whether scripts should be transformed with compile-time expansion."""
+  return os.environ.get(EXPAND_ENV_VAR, 'compile') != 'runtime'
+
+
+_DOLLAR_FORMATTER = None
+
+
+def _dollar_formatter():
+  # Created on first use, so scripts which never run a command don't import
+  # the formatter machinery.
+  global _DOLLAR_FORMATTER
+  if _DOLLAR_FORMATTER is None:
+    from .ipython import text
+    _DOLLAR_FORMATTER = text.DollarFormatter()
+
+  return _DOLLAR_FORMATTER
+
+
+_TRACER = None
+_TRACE_ENV_CHECKED = False
+
+
+def start_tracing(path):
+  """Record a span for each command run from now on, to the file at path."""
+  global _TRACER, _TRACE_ENV_CHECKED
+  from . import tracing
+  if _TRACER is not None:
+    _TRACER.close()
+  _TRACER = tracing.Tracer(path)
+  _TRACE_ENV_CHECKED = True
+  return _TRACER
+
+
+def _tracer():
+  # $PYSH_TRACE is only looked at when the first command runs, so that a
+  # fork server's script processes see their own environment.
+  global _TRACE_ENV_CHECKED
+  if not _TRACE_ENV_CHECKED:
+    _TRACE_ENV_CHECKED = True
+    path = os.environ.get(TRACE_ENV_VAR)
+    if path:
+      start_tracing(path)
+
+  return _TRACER
+
+
+def _start_span(cmd, location):
+  # Returns None, at the cost of one call, when tracing is off.
+  tracer = _tracer()
+  if tracer is None:
+    return None
+
+  if isinstance(cmd, list):
+    cmd = ' '.join(cmd)
+  filename, lineno = location()
+  return tracer.start(cmd, filename, lineno)
+
+
+_SESSION = None
+_SESSION_ENV_CHECKED = False
+
+
+def _session():
+  # Like _tracer(), $PYSH_SHELL_SESSION is looked at when a command first runs.
+  global _SESSION, _SESSION_ENV_CHECKED
+  if not _SESSION_ENV_CHECKED:
+    _SESSION_ENV_CHECKED = True
+    if _SESSION is None and os.environ.get(SHELL_SESSION_ENV_VAR):
+      from . import session
+      _SESSION = session.ShellSession()
+
+  return _SESSION
+
+
+class _SessionScope(object):
+
+  def __enter__(self):
+    global _SESSION
+    self._outer = _session()
+    if self._outer is None:
+      from . import session
+      _SESSION = session.ShellSession()
+    return _SESSION
+
+  def __exit__(self, *exc_info):
+    global _SESSION
+    if self._outer is None:
+      _SESSION.close()
+      _SESSION = None
+
+
+def shell_session():
+  """Run commands in one long-lived /bin/sh, within a with block.
+
+  Saves starting a shell for every command, which is most of the cost of tiny
+  commands like `!test -f {p}`; see session.py. Only commands which run in the
+  foreground and capture all of their output, if any, use the session, and
+  pipelines don't (see popen()). When a session is already active (e.g. from
+  $PYSH_SHELL_SESSION), the block uses that one.
+  """
+  return _SessionScope()
+
+
+def _session_runs(cmd):
+  # Whether a session can run cmd. Pipelines run as a Pipeline, which checks
+  # every stage's status.
+  return len(cmd) == 1 and shell.split_stages(cmd[0]) is None
+
+
+def _run_in_session(session, cmd, args, span, capture=False, text=True):
+  returncode, out = session.run(cmd, capture=capture)
+  if capture and text:
+    out = _decode_output(out)
+  if span is not None:
+    if capture:
+      span.add_output(out)
+    span.finish_status(returncode)
+  if returncode != 0:
+    raise CalledProcessError(returncode, args, out)
+
+  return out
+
+
+def popen(args, **kwargs):
+  """Start the shell command(s) in args, like Popen(args, shell=True).
+
+  A single command made only of plain words is exec'd directly, skipping the
+  shell. If that fails (e.g. the program doesn't exist, or is a script without
+  a #! line), the command goes through /bin/sh after all, which reports the
+  error or runs it exactly as it always would have.
+
+  A pipeline runs as a Pipeline, so that it fails if any stage does, whatever
+  its stages contain: stages made only of plain words are exec'd directly, and
+  the others each run in a /bin/sh of their own (the shell would run each in a
+  subshell anyway). Only commands which are a single pipeline get this;
+  anything else, such as `a | b; c`, goes to /bin/sh as a whole.
+  """
+  if len(args) == 1:
+    sources = shell.split_stages(args[0])
+    if sources is not None:
+      try:
+        return Pipeline([_pipeline_stage(s) for s in sources], **kwargs)
+      except OSError:
+        return Pipeline([['/bin/sh', '-c', s] for s in sources], **kwargs)
+
+    if DIRECT_EXEC:
+      argv = shell.split_simple_command(args[0])
+      if argv is not None:
+        try:
+          return subprocess.Popen(argv, **kwargs)
+        except OSError:
+          pass
+
+  return subprocess.Popen(args, shell=True, **kwargs)
+
+
+def _pipeline_stage(source):
+  # The argv of a pipeline stage.
+  argv = shell.split_simple_command(source) if DIRECT_EXEC else None
+  if argv is not None and _is_executable(argv[0]):
+    return argv
+  return ['/bin/sh', '-c', source]
+
+
+def _popen_fed(args, stdin=None, **kwargs):
+  # popen(), with stdin from any source feed.prepare() takes. A writer thread
+  # feeding it is joined by _raise_for_status().
+  from . import feed
+  stdin, feeder = feed.prepare(stdin)
+  try:
+    proc = popen(args, stdin=stdin, **kwargs)
+  except BaseException:
+    if feeder is not None:
+      feeder.close()
+    raise
+
+  if feeder is not None:
+    feeder.start()
+    proc.stdin_feeder = feeder
+  return proc
+
+
+def _is_executable(program):
+  # Checked before starting any stage of a pipeline, so that a missing program
+  # is found before the stages before it have started running.
+  if os.sep in program:
+    candidates = [program]
+  else:
+    candidates = [os.path.join(d or os.curdir, program)
+                  for d in os.environ.get('PATH', os.defpath).split(os.pathsep)]
+
+  for path in candidates:
+    if os.path.isfile(path) and os.access(path, os.X_OK):
+      return True
+
+  return False
+
+
+class Pipeline(object):
+  """A Popen-like handle on a pipeline whose stages pysh started itself.
+
+  Each stage is exec'd, directly or through /bin/sh, and consecutive stages are
+  connected by OS pipes, so the data never passes through Python. The
+  returncode follows pipefail semantics: it is the status of the last stage
+  which failed, or 0. A stage killed by SIGPIPE (-13, or 141 from /bin/sh)
+  doesn't count as failed unless it is the last one, since that's how e.g.
+  `yes | head -1` normally ends.
+
+  Attributes:
+    procs: the Popen object of each stage.
+    pipestatus: the returncode of each stage, once they have all exited.
+  """
+
+  def __init__(self, stages, stdin=None, stdout=None, stderr=None, **kwargs):
+    self.procs = []
+    self._through_shell = [argv[:2] == ['/bin/sh', '-c'] for argv in stages]
+    self.stderr = None
+    if stderr == subprocess.PIPE:
+      # One pipe for every stage, as the shell would have it.
+      stderr_r, stderr = os.pipe()
+      self.stderr = os.fdopen(stderr_r, 'rb')
+    prev_stdout = stdin
+    try:
+      for i, argv in enumerate(stages):
+        if i == len(stages) - 1:
+          proc = subprocess.Popen(argv, stdin=prev_stdout, stdout=stdout,
+                                  stderr=stderr, **kwargs)
+        else:
+          proc = subprocess.Popen(argv, stdin=prev_stdout,
+                                  stdout=subprocess.PIPE, stderr=stderr)
+
+        if i > 0:
+          # Only the stages need the pipe between them.
+          prev_stdout.close()
+        prev_stdout = proc.stdout
+        self.procs.append(proc)
+    except OSError:
+      if self.procs:
+        self.procs[-1].stdout.close()
+      if self.stderr is not None:
+        self.stderr.close()
+      self.kill()
+      self.wait()
+      raise
+    finally:
+      if self.stderr is not None:
+        # Only the stages write to it.
+        os.close(stderr)
+
+    self.stdin = self.procs[0].stdin
+    self.stdout = self.procs[-1].stdout
+    self.pipestatus = None
+    self.returncode = None
+
+  @property
+  def pid(self):
+    return self.procs[-1].pid
+
+  def _set_returncode(self):
+    self.pipestatus = [proc.returncode for proc in self.procs]
+    self.returncode = 0
+    for i, status in enumerate(self.pipestatus):
+      if status != 0 and not (i < len(self.procs) - 1 and
+                              self._killed_by_sigpipe(i, status)):
+        self.returncode = status
+
+  def _killed_by_sigpipe(self, i, status):
+    # A stage run through /bin/sh reports the signal as 128+N.
+    return (status == -signal.SIGPIPE or
+            (self._through_shell[i] and status == 128 + signal.SIGPIPE))
+
+  def poll(self):
+    if self.returncode is None:
+      if all(proc.poll() is not None for proc in self.procs):
+        self._set_returncode()
+    return self.returncode
+
+  def wait(self):
+    for proc in self.procs:
+      proc.wait()
+    self._set_returncode()
+    return self.returncode
+
+  def communicate(self, input=None):
+    # input goes to the first stage, from a thread, while the output of the
+    # last one is read.
+    writer = None
+    stdin = self.procs[0].stdin
+    if stdin is not None:
+      if input:
+        import threading
+        writer = threading.Thread(target=_write_input, args=(stdin, input))
+        writer.daemon = True
+        writer.start()
+      else:
+        stdin.close()
+
+    out, err = self.procs[-1].communicate()
+    if writer is not None:
+      writer.join()
+    self.wait()
+    return out, err
+
+  def kill(self):
+    for proc in self.procs:
+      if proc.poll() is None:
+        try:
+          proc.kill()
+        except OSError:
+          pass
+
+
+def _write_input(stdin, data):
+  try:
+    stdin.write(data)
+  except EnvironmentError as e:
+    import errno
+    # The first stage may exit without reading all of it.
+    if e.errno not in (errno.EPIPE, errno.EINVAL):
+      raise
+  finally:
+    try:
+      stdin.close()
+    except EnvironmentError:
+      pass
+
+
+def _raise_for_status(proc, args, output=None, stderr=None):
+  feeder = getattr(proc, 'stdin_feeder', None)
+  if feeder is not None:
+    feeder.join()
+  if proc.returncode != 0:
+    raise CalledProcessError(proc.returncode, args, output, stderr,
+                             pipestatus=getattr(proc, 'pipestatus', None))
+
+
+def _decode_output(data):
+  # As Popen's text mode would.
+  if sys.version_info[0] == 2:
+    return bytes(data)
+  return data.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+
+
+def _check_no_kwargs(kwargs):
+  if kwargs:
+    raise TypeError('unexpected keyword arguments: {}'.format(
+      ', '.join(sorted(kwargs))))
+
+
+def _wait(proc, span=None):
+  if span is None:
+    return proc.wait()
+  return span.finish(proc)
+
+
+def _communicate(proc, span=None, capture=None):
+  # Returns the output; only stdout may be a pipe.
+  if capture == 'bytearray':
+    from . import capture as capture_
+    out = capture_.read_bytearray(proc.stdout)
+  elif capture == 'bounded':
+    from . import capture as capture_
+    out = capture_.read_bounded(proc.stdout)
+  elif span is None:
+    out, _ = proc.communicate()
+    return out
+  else:
+    out = proc.stdout.read()
+
+  proc.stdout.close()
+  if span is not None:
+    span.add_output(out)
+  _wait(proc, span)
+  return out
+
+
+def _capture_streams(cmd, args, span, both, tee, stdin=None):
+  # The 'both' capture mode, and tee.
+  from . import capture
+  kwargs = dict(stdout=subprocess.PIPE)
+  if both:
+    kwargs['stderr'] = subprocess.PIPE
+  proc = _popen_fed(cmd, stdin, **kwargs)
+  try:
+    out, err = capture.read_streams(proc.stdout, proc.stderr, tee=tee)
+  finally:
+    proc.stdout.close()
+    if both:
+      proc.stderr.close()
+
+  out = _decode_output(out)
+  if both:
+    err = _decode_output(err)
+  if span is not None:
+    span.add_output(out)
+    if both:
+      span.add_output(err)
+  _wait(proc, span)
+  _raise_for_status(proc, args, out, err)
+  return capture.Output(out, err) if both else out
+
+
+def _capture_to_file(cmd, args, span, stdin=None):
+  # The 'mmap' capture mode: the command writes straight to the file.
+  import tempfile
+  from . import capture
+  output_file = tempfile.TemporaryFile()
+  try:
+    proc = _popen_fed(cmd, stdin, stdout=output_file)
+    _wait(proc, span)
+  except BaseException:
+    output_file.close()
+    raise
+
+  out = capture.MappedOutput(output_file)
+  if span is not None:
+    span.captured_bytes = len(out)
+  _raise_for_status(proc, args, out)
+  return out
+
+
+def _iter_lines(proc, args, span=None):
+  # Closing the generator early closes the pipe, so the command gets SIGPIPE
+  # on its next write instead of blocking forever.
+  try:
+    for line in iter(proc.stdout.readline, ''):
+      if span is not None:
+        span.add_output(line)
+      if line.endswith('\n'):
+        line = line[:-1]
+      yield line
+  finally:
+    proc.stdout.close()
+    _wait(proc, span)
+
+  _raise_for_status(proc, args)
+
+
+# Background jobs which haven't been waited for yet, in the order they started.
+_PENDING_JOBS = []
+
+
+class Job(object):
+  """A command running in the background, started by `!cmd &`.
+
+  Failures surface as CalledProcessError from wait() or result(), not when the
+  command exits.
+  """
+
+  def __init__(self, proc, args, capture, span=None):
+    self.args = args
+    self._proc = proc
+    self._capture = capture
+    self._span = span
+    self._output = None
+    self._reader = None
+    if capture or span is not None:
+      # Drain the pipe as the command writes, so it never blocks on a full pipe
+      # while nobody is waiting for it. A traced command is also reaped as soon
+      # as it exits, so its span ends then.
+      import threading
+      self._reader = threading.Thread(target=self._read_output)
+      self._reader.daemon = True
+      self._reader.start()
+
+    _PENDING_JOBS.append(self)
+
+  def _read_output(self):
+    if self._capture:
+      self._output = _communicate(self._proc, self._span)
+    else:
+      _wait(self._proc, self._span)
+
+  @property
+  def pid(self):
+    return self._proc.pid
+
+  @property
+  def returncode(self):
+    """The exit status, or None while the command is still running."""
+    return self._proc.poll()
+
+  def done(self):
+    return self.returncode is not None
+
+  def wait(self):
+    """Wait for the command to exit. Raises CalledProcessError if it failed."""
+    if self._reader is not None:
+      self._reader.join()
+    self._proc.wait()
+    if self in _PENDING_JOBS:
+      _PENDING_JOBS.remove(self)
+
+    _raise_for_status(self._proc, self.args, self._output)
+    return self._proc.returncode
+
+  def result(self):
+    """Wait for the command, then return its captured output (if any)."""
+    self.wait()
+    return self._output
+
+  def __repr__(self):
+    return '<Job pid={} returncode={} {!r}>'.format(
+      self.pid, self.returncode, self.args)
+
+
+def wait_all(jobs=None):
+  """Wait for background jobs, by default all those not yet waited for.
+
+  Every job is waited for even if some fail; the CalledProcessError of the
+  first failed job (in the order given, or the order they started) is raised
+  afterwards.
+
+  Returns:
+    The list of the jobs' results.
+  """
+  if jobs is None:
+    jobs = list(_PENDING_JOBS)
+
+  results = []
+  error = None
+  for job in jobs:
+    try:
+      results.append(job.result())
+    except CalledProcessError as e:
+      results.append(None)
+      if error is None:
+        error = e
+
+  if error is not None:
+    raise error
+
+  return results
+
+
+def pmap(template, jobs=None, fail_fast=True, **iterables):
+  """Run a command template over some iterables, jobs commands at a time.
+
+  For example, `pmap('gzip {f}', f=files)` runs `gzip` once per item of files.
+  The template is expanded like a `!` line, in the caller's namespace plus one
+  item from each of the iterables (which must all have the same length).
+
+  Args:
+    template: the command to run, with {var} / $var references.
+    jobs: the most commands to run at once; defaults to the number of CPUs.
+    fail_fast: if True, start no more commands once one fails, and raise the
+      CalledProcessError of the earliest failed command once the running ones
+      are done. If False, run every command; the result of a failed command
+      is its CalledProcessError.
+    iterables: the values each command is expanded with, by variable name.
+
+  Returns:
+    The output of each command, in the same order as the iterables.
+  """
+  frame = sys._getframe(1)
+  return map_commands(template, frame.f_locals, iterables, jobs=jobs,
+                      fail_fast=fail_fast,
+                      location=(frame.f_code.co_filename, frame.f_lineno))
+
+
+def map_commands(template, namespace, iterables, jobs=None, fail_fast=True,
+                 location=None):
+  """Implements pmap(), expanding the template with the given namespace.
+
+  location is the (filename, lineno) pmap() was called from, for tracing.
+  """
+  import threading
+
+  iterables = dict((name, list(values)) for name, values in iterables.items())
+  lengths = set(len(values) for values in iterables.values())
+  if len(lengths) > 1:
+    raise ValueError('pmap() iterables have different lengths: {}'.format(
+      ', '.join('{}={}'.format(name, len(values))
+                for name, values in sorted(iterables.items()))))
+  count = lengths.pop() if lengths else 0
+
+  if jobs is None:
+    from . import compat
+    jobs = compat.cpu_count()
+  if jobs < 1:
+    raise ValueError('jobs must be at least 1, not {}'.format(jobs))
+
+  formatter = _dollar_formatter()
+  commands = []
+  for i in range(count):
+    ns = dict(namespace)
+    for name, values in iterables.items():
+      ns[name] = values[i]
+    commands.append(_expand(formatter, template, ns))
+
+  results = [None] * count
+  failed = []
+  # Unexpected exceptions (e.g. out of file descriptors), re-raised below.
+  errors = []
+  lock = threading.Lock()
+  next_index = [0]
+
+  def worker():
+    while True:
+      with lock:
+        if next_index[0] >= count or errors or (fail_fast and failed):
+          return
+        i = next_index[0]
+        next_index[0] += 1
+
+      try:
+        span = _start_span(commands[i], lambda: location or ('<unknown>', 0))
+        proc = popen([commands[i]], **_output_kwargs())
+        out = _communicate(proc, span)
+        _raise_for_status(proc, commands[i], out)
+        results[i] = out
+      except CalledProcessError as e:
+        results[i] = e
+        with lock:
+          failed.append(i)
+      except Exception as e:
+        with lock:
+          errors.append(e)
+
+  threads = [threading.Thread(target=worker) for _ in range(min(jobs, count))]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+  if errors:
+    raise errors[0]
+  if fail_fast and failed:
+    raise results[min(failed)]
+
+  return results
+
+
+def _output_kwargs(capture=None):
+  kw = dict(stdout=subprocess.PIPE)
+  if sys.version_info[0] == 3 and capture in TEXT_CAPTURE_MODES:
+    kw['encoding'] = 'utf-8'
+  return kw
+
+
+def _expand(formatter, cmd, ns):
+  try:
+    # We have to use .vformat() here, because 'self' is a valid and common
+    # name, and expanding **ns for .format() would make it collide with
+    # the 'self' argument of the method.
+    return formatter.vformat(cmd, args=[], kwargs=ns)
+  except Exception:
+    # if formatter couldn't format, just let it go untransformed
+    return cmd
+
+
+def _caller_location():
+  # Where the script called system() or getoutput(): the frames above are
+  # _start_span() and the method.
+  frame = sys._getframe(3)
+  return frame.f_code.co_filename, frame.f_lineno
+
+
+class IPythonStub:
+
+  def __init__(self):
+    self.user_ns = {}
+
+  def var_expand(self, cmd, depth=0, formatter=None):
+    """Expand python variables in a string.
+
+    The depth argument indicates how many frames above the caller should
+    be walked to look for the local namespace where to expand variables.
+
+    The global namespace for expansion is always the user's interactive
+    namespace.
+    """
+    if formatter is None:
+      formatter = _dollar_formatter()
+
+    ns = self.user_ns.copy()
+    try:
+      frame = sys._getframe(depth+1)
+    except ValueError:
+      # This is thrown if there aren't that many frames on the stack,
+      # e.g. if a script called run_line_magic() directly.
+      pass
+    else:
+      ns.update(frame.f_locals)
+
+    return _expand(formatter, cmd, ns)
+
+  def interpolate(self, cmd, template, values):
+    """Expand a command whose fields were compiled into the script.
+
+    Args:
+      cmd: the command as written, returned if expansion fails.
+      template: cmd as a str.format() template with positional fields.
+      values: a function returning the value of each field.
+    """
+    try:
+      return template.format(*values())
+    except Exception:
+      # if formatter couldn't format, just let it go untransformed
+      return cmd
+
+  def _expand_args(self, args):
+    # Expands in the namespace of whoever called system() or getoutput(). A
+    # plain loop rather than a comprehension keeps the frame depth the same on
+    # every Python version.
+    expanded = []
+    for arg in args:
+      expanded.append(self.var_expand(arg, depth=2))
+    return expanded
+
+  def system(self, *args, **kwargs):
+    """Run a command, raising CalledProcessError if it fails.
+
+    Keyword args:
+      stdin: what to feed the command's stdin from, instead of the script's
+        stdin: a file, a str, bytes or other buffer, or an iterable of str or
+        bytes, which is consumed as the command reads it. See feed.py.
+      background: if True, return a Job instead of waiting for the command.
+      expand: if False, run the command as given, without var_expand(); used
+        when the expansion was compiled into the script.
+    """
+    stdin = kwargs.pop('stdin', None)
+    background = kwargs.pop('background', False)
+    expand = kwargs.pop('expand', True)
+    _check_no_kwargs(kwargs)
+
+    cmd = self._expand_args(args) if expand else list(args)
+    span = _start_span(cmd, _caller_location)
+    session = _session()
+    if (session is not None and stdin is None and not background
+        and _session_runs(cmd)):
+      _run_in_session(session, cmd[0], args, span)
+      return
+
+    proc = _popen_fed(cmd, stdin)
+    if background:
+      return Job(proc, args, capture=False, span=span)
+
+    _wait(proc, span)
+    _raise_for_status(proc, args)
+
+  def getoutput(self, *args, **kwargs):
+    """Run a command and return its standard output.
+
+    Keyword args:
+      capture: None to return the whole output as a string once the command
+        exits. 'lines' to return a generator which yields each line (without
+        its newline) as soon as the command writes it; it raises
+        CalledProcessError once exhausted if the command failed. 'bytes',
+        'bytearray' or 'mmap' to return the output undecoded, as bytes, a
+        bytearray or a capture.MappedOutput. 'bounded' to return a
+        capture.BoundedOutput, which only keeps the head and tail of the
+        output in memory ($PYSH_CAPTURE_LIMIT bytes of each) and spills the
+        rest to a temporary file; if the command fails, the
+        CalledProcessError only gets the head and tail, as text. 'both' to
+        capture stderr too, returning a capture.Output(stdout, stderr) of
+        strings; a CalledProcessError then has both as well.
+      tee: if True, also pass the output through to the script's stdout (and
+        stderr) as the command writes it. Only for capture None or 'both'.
+      stdin: as for system().
+      background: if True, return a Job whose result() is the output instead
+        of waiting for the command. Only for capture None or 'bytes'.
+      expand: as for system().
+    """
+    capture = kwargs.pop('capture', None)
+    tee = kwargs.pop('tee', False)
+    stdin = kwargs.pop('stdin', None)
+    background = kwargs.pop('background', False)
+    expand = kwargs.pop('expand', True)
+    _check_no_kwargs(kwargs)
+    if capture not in CAPTURE_MODES:
+      raise ValueError('unknown capture mode: {!r}'.format(capture))
+    if tee and capture not in (None, 'both'):
+      raise ValueError("tee can't be used with capture={!r}".format(capture))
+    if background and (tee or capture not in (None, 'bytes')):
+      raise ValueError("capture={!r}{} can't be used in the background".format(
+        capture, ' with tee' if tee else ''))
+
+    cmd = self._expand_args(args) if expand else list(args)
+    span = _start_span(cmd, _caller_location)
+    session = _session()
+    if (session is not None and stdin is None and not background and not tee
+        and capture in (None, 'bytes') and _session_runs(cmd)):
+      return _run_in_session(session, cmd[0], args, span, capture=True,
+                             text=capture is None)
+
+    if capture == 'both' or tee:
+      return _capture_streams(cmd, args, span, capture == 'both', tee, stdin)
+    if capture == 'mmap':
+      return _capture_to_file(cmd, args, span, stdin)
+
+    proc = _popen_fed(cmd, stdin, **_output_kwargs(capture))
+    if capture == 'lines':
+      return _iter_lines(proc, args, span)
+    if background:
+      return Job(proc, args, capture=True, span=span)
+
+    out = _communicate(proc, span, capture)
+    if capture == 'bounded' and proc.returncode != 0:
+      preview = out.preview()
+      out.close()
+      out = preview
+    _raise_for_status(proc, args, out)
+
+    return out
+
+
+  def wait_all(self, jobs=None):
+    """Same as the module-level wait_all()."""
+    return wait_all(jobs)
+
+
+def get_ipython():
+  """Return the object which transformed pysh code calls into."""
+  return IPythonStub()
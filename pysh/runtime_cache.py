@@ -0,0 +1,126 @@
+"""Cache of the pysh copies embedded in dist scripts, extracted to disk.
+
+A dist script ends with a zip of pysh (see payload.py) whose comment holds a
+hash of its contents. The first time a script with a given payload runs, the
+bootstrap extracts it to <cache root>/runtime/<hash> and byte-compiles it for
+the running Python; from then on, every script embedding the same payload
+imports pysh from there, as a regular package, without opening the zip. Other
+Python versions write their own __pycache__ next to the first one's.
+
+Extraction goes to a temporary directory which is renamed into place, so
+concurrent first runs are safe: one rename wins and the others use its copy.
+Each run touches the directory it uses; when a new one is extracted, the
+least recently used ones beyond MAX_RUNTIMES are removed, once they haven't
+been used for MIN_UNUSED_SECONDS (a script still running may import from its
+copy later).
+
+The cache root and $PYSH_NO_CACHE are as for the bytecode cache, see cache.py.
+The bootstrap checks for an extracted copy itself, before importing anything
+from the zip; that check must stay in line with runtime_dir().
+"""
+
+import os
+import shutil
+import time
+
+from . import cache
+
+
+RUNTIME_DIR = 'runtime'
+
+# How many extracted copies to keep, at least.
+MAX_RUNTIMES = 8
+
+MIN_UNUSED_SECONDS = 24 * 60 * 60
+
+_TMP_MARKER = '.tmp-'
+
+
+def runtime_dir(key):
+  """The directory the payload with the given content hash extracts to."""
+  return os.path.join(cache.cache_root(), RUNTIME_DIR, key)
+
+
+def extract(script_path, path):
+  """Extract the payload of the dist script at script_path to path.
+
+  Returns:
+    path once it holds the payload, or None if it couldn't be created.
+  """
+  import tempfile
+  import zipfile
+  parent = os.path.dirname(path)
+  try:
+    os.makedirs(parent)
+  except OSError:
+    pass
+  try:
+    tmp_path = tempfile.mkdtemp(
+      dir=parent, prefix=os.path.basename(path) + _TMP_MARKER)
+  except OSError:
+    return None
+
+  try:
+    with zipfile.ZipFile(script_path) as zip_f:
+      sources = [name for name in zip_f.namelist() if name.endswith('.py')]
+      zip_f.extractall(tmp_path, sources)
+    for name in sources:
+      _byte_compile(os.path.join(tmp_path, name))
+    os.rename(tmp_path, path)
+  except (OSError, IOError, zipfile.BadZipfile):
+    # Most likely another run renamed its copy into place first.
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    return path if os.path.isdir(path) else None
+
+  prune(parent, exclude=os.path.basename(path))
+  return path
+
+
+def _byte_compile(source_path):
+  # The directory never changes once it's in place, so the .pyc files don't
+  # need to be checked against their sources.
+  import py_compile
+  kwargs = {}
+  if hasattr(py_compile, 'PycInvalidationMode'):
+    kwargs['invalidation_mode'] = py_compile.PycInvalidationMode.UNCHECKED_HASH
+  try:
+    py_compile.compile(source_path, doraise=True, **kwargs)
+  except py_compile.PyCompileError:
+    pass
+
+
+def prune(directory, keep=MAX_RUNTIMES, min_unused=MIN_UNUSED_SECONDS,
+          exclude=None):
+  """Remove the least recently used copies beyond the keep most recent ones.
+
+  Copies used within min_unused seconds are kept regardless, and so are
+  temporary directories of extractions which may still be running.
+  """
+  cutoff = time.time() - min_unused
+  entries = []
+  try:
+    names = os.listdir(directory)
+  except OSError:
+    return
+
+  for name in names:
+    if name == exclude:
+      continue
+    path = os.path.join(directory, name)
+    try:
+      mtime = os.stat(path).st_mtime
+    except OSError:
+      continue
+    if _TMP_MARKER in name:
+      if mtime < cutoff:
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+      entries.append((mtime, path))
+
+  entries.sort(reverse=True)
+  if exclude is not None:
+    # The excluded copy takes a slot; it was just used.
+    keep -= 1
+  for mtime, path in entries[max(0, keep):]:
+    if mtime < cutoff:
+      shutil.rmtree(path, ignore_errors=True)
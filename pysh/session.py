@@ -0,0 +1,195 @@
+"""A long-lived /bin/sh which runs one command after another.
+
+Running a command normally starts a new /bin/sh for it. For scripts which run
+thousands of tiny commands (`!test -f {p}`, `!grep -q ...`), that startup is
+most of the cost. A ShellSession starts /bin/sh once, and writes it each
+command over a control pipe:
+
+  ( eval 'COMMAND' ) 3<&- 4>&-; printf '%s %d\\n' TOKEN "$?" >&4
+
+(with >&4 before 3<&- to capture stdout).
+
+The shell reads the control pipe (fd 3) a line at a time and evals each line,
+so a newline inside a quoted word is written as "$pysh_nl" instead. (Sourcing
+the pipe with `.` would hang in bash, which reads the whole file before it
+runs any of it.) Each command runs in a subshell, so `cd`, `exit`, variables
+and syntax errors only affect that command, as they would with a shell of its
+own. Its stdin and stderr are the script's, like in the per-command mode; its
+stdout is the script's too, or else the result pipe (fd 4) when the output is
+captured. After each command the shell writes a sentinel, TOKEN and the exit
+status, to the result pipe; the token is random, so the output of a command
+can't fake it.
+
+Before each command, the session brings the shell's working directory and
+environment in line with the script's (os.chdir(), os.environ), so commands
+see the same ones as they would otherwise. Environment variables whose names
+the shell can't handle aren't passed on, though, and a command killed by a
+signal has the exit status 128+N the shell reports rather than -N.
+"""
+
+from __future__ import print_function
+import binascii
+import fcntl
+import os
+import re
+import subprocess
+import threading
+
+from . import compat
+
+
+_CONTROL_FD = 3
+_RESULT_FD = 4
+
+_ENV_NAME_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+# Evals the control pipe line by line. $pysh_nl is a newline; command
+# substitution strips trailing newlines, hence the x.
+_LOOP = ('pysh_nl=$(printf \'\\nx\'); pysh_nl=${{pysh_nl%x}}; '
+         'while IFS= read -r pysh_line <&{fd}; do eval "$pysh_line"; done')
+
+
+def quote(s):
+  """Quote s as a single word for /bin/sh."""
+  return "'" + s.replace("'", "'\\''") + "'"
+
+
+def _quote_line(s):
+  # quote(s), on a single line of the control pipe.
+  return quote(s).replace('\n', '\'"$pysh_nl"\'')
+
+
+class ShellSession(object):
+  """A /bin/sh coprocess, started when it runs its first command."""
+
+  def __init__(self, shell='/bin/sh'):
+    self.shell = shell
+    self._proc = None
+    self._control = None
+    self._results = None
+    self._token = None
+    self._count = 0
+    self._cwd = None
+    self._environ = None
+    self._lock = threading.Lock()
+
+  def _start(self):
+    control_r, control_w = compat.pipe()
+    results_r, results_w = compat.pipe()
+
+    def setup_fds():
+      # Runs in the child. Either pipe may already be fd 3 or 4, so move them
+      # out of the way first; the final copies don't have FD_CLOEXEC set.
+      control = fcntl.fcntl(control_r, fcntl.F_DUPFD, 10)
+      results = fcntl.fcntl(results_w, fcntl.F_DUPFD, 10)
+      os.dup2(control, _CONTROL_FD)
+      os.dup2(results, _RESULT_FD)
+      os.close(control)
+      os.close(results)
+
+    try:
+      self._proc = subprocess.Popen(
+        [self.shell, '-c', _LOOP.format(fd=_CONTROL_FD), self.shell],
+        preexec_fn=setup_fds, close_fds=False)
+    finally:
+      os.close(control_r)
+      os.close(results_w)
+
+    self._control = control_w
+    self._results = results_r
+    self._token = 'pysh-{}'.format(
+      binascii.hexlify(os.urandom(16)).decode('ascii'))
+    self._cwd = os.getcwd()
+    self._environ = dict(os.environ)
+
+  @property
+  def pid(self):
+    """The pid of the shell, or None if it isn't running."""
+    return self._proc.pid if self._proc is not None else None
+
+  def run(self, cmd, capture=False):
+    """Run cmd in the shell, and wait for it.
+
+    Returns:
+      (returncode, output): output is the command's stdout as bytes if capture
+      is true, None otherwise.
+    """
+    with self._lock:
+      if self._proc is None:
+        self._start()
+
+      try:
+        return self._run(cmd, capture)
+      except BaseException:
+        # E.g. KeyboardInterrupt: the shell is somewhere in the middle of the
+        # command, so start again with a new one.
+        self.close()
+        raise
+
+  def _run(self, cmd, capture):
+    self._count += 1
+    sentinel = '{}-{}'.format(self._token, self._count)
+    script = self._sync_state()
+    # On the same line, since each line is a new eval which resets $?.
+    script.append(
+      '( eval {} ){} 3<&- 4>&-; printf \'%s %d\\n\' {} "$?" >&4\n'.format(
+        _quote_line(cmd), ' >&4' if capture else '', sentinel))
+    _write_all(self._control, '\n'.join(script).encode('utf-8'))
+
+    marker = (sentinel + ' ').encode('ascii')
+    data = bytearray()
+    while True:
+      chunk = os.read(self._results, 65536)
+      if not chunk:
+        # The shell itself died; report its status as the command's.
+        returncode = self._proc.wait()
+        self.close()
+        return returncode or 1, (bytes(data) if capture else None)
+
+      # Only the end can hold the sentinel, unless the output contains it.
+      search_from = max(0, len(data) - len(marker) - 16)
+      data += chunk
+      index = data.find(marker, search_from)
+      if index >= 0 and data.endswith(b'\n'):
+        status = data[index + len(marker):-1]
+        return int(status), (bytes(data[:index]) if capture else None)
+
+  def _sync_state(self):
+    script = []
+    cwd = os.getcwd()
+    if cwd != self._cwd:
+      script.append('cd -- {}'.format(_quote_line(cwd)))
+      self._cwd = cwd
+
+    environ = dict(os.environ)
+    if environ != self._environ:
+      for name in sorted(self._environ):
+        if name not in environ and _ENV_NAME_RE.match(name):
+          script.append('unset {}'.format(name))
+      for name, value in sorted(environ.items()):
+        if self._environ.get(name) != value and _ENV_NAME_RE.match(name):
+          script.append('export {}={}'.format(name, _quote_line(value)))
+      self._environ = environ
+
+    return script
+
+  def close(self):
+    """Stop the shell; the next command starts a new one."""
+    if self._proc is None:
+      return
+
+    os.close(self._control)
+    os.close(self._results)
+    if self._proc.poll() is None:
+      try:
+        self._proc.kill()
+      except OSError:
+        pass
+    self._proc.wait()
+    self._proc = None
+
+
+def _write_all(fd, data):
+  while data:
+    written = os.write(fd, data)
+    data = data[written:]
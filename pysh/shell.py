@@ -0,0 +1,193 @@
+"""Decides when a command can be run without going through /bin/sh.
+
+Running ``/bin/sh -c CMD`` costs an extra exec of the shell for every command.
+When CMD is only a list of words, possibly quoted, exec'ing it directly is
+equivalent and cheaper; likewise for a pipeline of such commands.
+"""
+
+# Characters other than | which mean something to the shell outside of quotes.
+# Some of them are only special in certain positions, but words using them are
+# rare enough that it's not worth telling those cases apart.
+_UNQUOTED_SPECIAL = frozenset('&;<>()$`\\*?[]#~{}\n')
+
+# Characters which mean something to the shell inside double quotes.
+_DOUBLE_QUOTED_SPECIAL = frozenset('$`\\')
+
+_WHITESPACE = frozenset(' \t')
+
+# Commands which must be run by the shell: keywords, builtins which act on the
+# shell itself, and builtins whose behaviour differs from the program of the
+# same name (e.g. escape handling in echo, symlinks in pwd).
+SHELL_ONLY_COMMANDS = frozenset([
+  '!', '.', ':', '[[', ']]', '{', '}', 'alias', 'bg', 'break', 'case', 'cd',
+  'command', 'continue', 'do', 'done', 'echo', 'elif', 'else', 'esac', 'eval',
+  'exec', 'exit', 'export', 'fg', 'fi', 'for', 'function', 'getopts', 'hash',
+  'if', 'in', 'jobs', 'local', 'printf', 'pwd', 'read', 'readonly', 'return',
+  'select', 'set', 'shift', 'source', 'then', 'time', 'times', 'trap', 'type',
+  'ulimit', 'umask', 'unalias', 'unset', 'until', 'wait', 'while',
+])
+
+
+def split_pipeline(cmd):
+  """Split cmd into one argv list per pipeline stage, if it needs no shell.
+
+  Returns None unless running the stages directly, connected by pipes, behaves
+  like passing cmd to /bin/sh: each stage may only contain words, single quotes
+  and double quotes which don't contain expansions, and stages may only be
+  joined by |. Redirects, globs, expansions, separators, variable assignments,
+  || and shell builtins all need the shell.
+  """
+  stages = []
+  argv = []
+  word = []
+  in_word = False
+  quote = None
+  for ch in cmd:
+    if quote == "'":
+      if ch == "'":
+        quote = None
+      else:
+        word.append(ch)
+    elif quote == '"':
+      if ch == '"':
+        quote = None
+      elif ch in _DOUBLE_QUOTED_SPECIAL:
+        return None
+      else:
+        word.append(ch)
+    elif ch in _WHITESPACE or ch == '|':
+      if in_word:
+        argv.append(''.join(word))
+        word = []
+        in_word = False
+      if ch == '|':
+        # An empty stage also catches ||.
+        if not _is_simple_command(argv):
+          return None
+        stages.append(argv)
+        argv = []
+    elif ch in _UNQUOTED_SPECIAL:
+      return None
+    else:
+      in_word = True
+      if ch == "'" or ch == '"':
+        quote = ch
+      elif ch == '=' and not argv:
+        # Possibly a variable assignment.
+        return None
+      else:
+        word.append(ch)
+
+  if quote is not None:
+    return None
+
+  if in_word:
+    argv.append(''.join(word))
+
+  if not _is_simple_command(argv):
+    return None
+
+  stages.append(argv)
+  return stages
+
+
+def split_simple_command(cmd):
+  """Split cmd into an argv list, if it can run without the shell.
+
+  Like split_pipeline(), but returns None for pipelines.
+  """
+  stages = split_pipeline(cmd)
+  if stages is None or len(stages) != 1:
+    return None
+
+  return stages[0]
+
+
+# Words which start a compound command, or otherwise make a stage more than a
+# single command.
+_COMPOUND_STARTS = frozenset([
+  '!', '(', '{', 'case', 'for', 'function', 'if', 'select', 'until', 'while',
+  '[[',
+])
+
+
+def split_stages(cmd):
+  """Split a pipeline into the source of each of its stages.
+
+  Unlike split_pipeline(), the stages may use any shell syntax which stays
+  within one command: expansions, redirects, assignments, builtins. Each stage
+  runs the same in a shell of its own, as the shell runs every stage in a
+  subshell anyway. Returns None unless cmd is a single pipeline of two or more
+  stages, joined by | only: ;, &, &&, ||, newlines, comments, here-documents,
+  subshells and compound commands at the top level all leave cmd to the shell
+  as a whole, and so does anything this can't follow with certainty.
+  """
+  stages = []
+  start = 0
+  # Open $( and ${, then the quote in effect, if any, for each level.
+  nesting = []
+  quote = None
+  word_start = True
+  i = 0
+  n = len(cmd)
+  while i < n:
+    ch = cmd[i]
+    if quote == "'":
+      if ch == "'":
+        quote = None
+    elif quote == '`':
+      if ch == '\\':
+        i += 1
+      elif ch == '`':
+        quote = None
+    elif ch == '\\':
+      if i + 1 < n and cmd[i + 1] == '\n':
+        return None
+      i += 1
+    elif ch == '$' and i + 1 < n and cmd[i + 1] in '({':
+      nesting.append((cmd[i + 1], quote))
+      quote = None
+      i += 1
+    elif nesting and ch == (')' if nesting[-1][0] == '(' else '}'):
+      quote = nesting.pop()[1]
+    elif quote == '"':
+      if ch == '"':
+        quote = None
+      elif ch == '`':
+        return None
+    elif ch in '"\'`':
+      quote = ch
+    elif nesting:
+      if ch in '()':
+        # A subshell within $( ), or a case pattern: not worth following.
+        return None
+    elif ch in ';&\n()':
+      if not (ch == '&' and cmd[i - 1:i] in ('<', '>')):
+        # Not part of a redirect such as 2>&1.
+        return None
+    elif cmd.startswith('<<', i):
+      return None
+    elif ch == '#' and word_start:
+      return None
+    elif ch == '|':
+      if cmd.startswith('||', i) or cmd[i - 1:i] == '>':
+        # || or the >| redirect.
+        return None
+      stages.append(cmd[start:i])
+      start = i + 1
+    word_start = ch in _WHITESPACE or ch == '|'
+    i += 1
+
+  if quote is not None or nesting or not stages:
+    return None
+  stages.append(cmd[start:])
+
+  stages = [stage.strip() for stage in stages]
+  for stage in stages:
+    if not stage or stage.split(None, 1)[0] in _COMPOUND_STARTS:
+      return None
+  return stages
+
+
+def _is_simple_command(argv):
+  return bool(argv) and argv[0] not in SHELL_ONLY_COMMANDS
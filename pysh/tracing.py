@@ -0,0 +1,214 @@
+"""Per-command tracing of pysh scripts.
+
+When enabled (with `pysh run --trace FILE` or by setting $PYSH_TRACE to the
+file), every command a script runs is recorded as a span: the expanded
+command, the script file and line it came from, when it started and ended, its
+exit status, how much output was captured, and the CPU time and peak memory
+the command used, from the rusage os.wait4() returns when the command is
+reaped.
+
+The file format depends on its name. A path ending in .json gets the Chrome
+trace_event format, for chrome://tracing or Perfetto, and is written when the
+script exits. Any other path gets one JSON object per line, appended as each
+command finishes; since the environment variable is inherited, scripts which
+run other pysh scripts with tracing on all append to the same file, and the
+pid of each span tells them apart.
+
+Spans record:
+  cmd: the command, after expansion.
+  file, line: where in the script it was run.
+  start, end: time.monotonic() when it started and was reaped, in seconds.
+  status: the exit status; a negative status is the signal that killed it.
+  pipestatus: for pipelines pysh ran itself, the status of each stage.
+  captured_bytes: how much output was captured, if any.
+  utime, stime: user and system CPU seconds, including the command's reaped
+    children (e.g. those of /bin/sh).
+  maxrss: the peak resident set size, as getrusage() reports it (KB on Linux).
+    For pipelines, CPU times are summed and maxrss is the largest stage's.
+The rusage fields are null for a command that was already reaped elsewhere,
+e.g. by polling a background job until it finished, or run in a shell
+session.
+"""
+
+from __future__ import print_function
+import errno
+import os
+import threading
+import time
+
+try:
+  _now = time.monotonic
+except AttributeError:
+  _now = time.time
+
+
+class Tracer(object):
+  """Collects the spans of the commands a script runs, and writes them."""
+
+  def __init__(self, path):
+    self.path = path
+    self.chrome = path.endswith('.json')
+    self._events = []
+    self._lock = threading.Lock()
+    self._file = None
+    if not self.chrome:
+      self._file = open(path, 'a')
+
+    import atexit
+    atexit.register(self.close)
+
+  def start(self, cmd, filename, lineno):
+    """Return a new Span for cmd, run from filename:lineno."""
+    return Span(self, cmd, filename, lineno)
+
+  def record(self, span):
+    import json
+    if self.chrome:
+      event = {
+        'name': span.cmd,
+        'cat': 'command',
+        'ph': 'X',
+        'ts': span.start * 1e6,
+        'dur': (span.end - span.start) * 1e6,
+        'pid': span.pid,
+        'tid': span.tid,
+        'args': span.fields(),
+      }
+      with self._lock:
+        if self._events is not None:
+          self._events.append(event)
+      return
+
+    line = json.dumps(span.fields(), sort_keys=True) + '\n'
+    with self._lock:
+      if self._file is not None:
+        # One write per span, so processes appending to the same file don't
+        # interleave within a line.
+        self._file.write(line)
+        self._file.flush()
+
+  def close(self):
+    with self._lock:
+      if self._file is not None:
+        self._file.close()
+        self._file = None
+      elif self.chrome and self._events is not None:
+        import json
+        with open(self.path, 'w') as trace_f:
+          json.dump({'traceEvents': self._events,
+                     'displayTimeUnit': 'ms'}, trace_f)
+        self._events = None
+
+
+class Span(object):
+  """One command, from when it is started until it is reaped."""
+
+  def __init__(self, tracer, cmd, filename, lineno):
+    self.tracer = tracer
+    self.cmd = cmd
+    self.filename = filename
+    self.lineno = lineno
+    self.pid = os.getpid()
+    self.tid = threading.current_thread().ident
+    self.captured_bytes = None
+    self.status = None
+    self.pipestatus = None
+    self.rusage = None
+    self.start = _now()
+    self.end = None
+
+  def add_output(self, output):
+    if isinstance(output, type(u'')):
+      size = len(output.encode('utf-8'))
+    else:
+      size = len(output)
+    self.captured_bytes = (self.captured_bytes or 0) + size
+
+  def finish(self, proc):
+    """Wait for proc (a Popen or Pipeline) and record the span.
+
+    Returns:
+      proc's returncode.
+    """
+    self.rusage = reap(proc)
+    self.pipestatus = getattr(proc, 'pipestatus', None)
+    self.finish_status(proc.returncode)
+    return proc.returncode
+
+  def finish_status(self, status):
+    """Record the span of a command which pysh didn't reap itself."""
+    self.end = _now()
+    self.status = status
+    self.tracer.record(self)
+
+  def fields(self):
+    fields = {
+      'cmd': self.cmd,
+      'file': self.filename,
+      'line': self.lineno,
+      'start': self.start,
+      'end': self.end,
+      'status': self.status,
+      'captured_bytes': self.captured_bytes,
+      'pid': self.pid,
+      'utime': None,
+      'stime': None,
+      'maxrss': None,
+    }
+    if self.pipestatus is not None:
+      fields['pipestatus'] = self.pipestatus
+    if self.rusage is not None:
+      fields['utime'], fields['stime'], fields['maxrss'] = self.rusage
+    return fields
+
+
+def reap(proc):
+  """Wait for proc (a Popen or Pipeline) with os.wait4().
+
+  Sets the returncode of proc like proc.wait() does.
+
+  Returns:
+    A (utime, stime, maxrss) tuple, or None if some process was already
+    reaped.
+  """
+  total = (0.0, 0.0, 0)
+  for p in getattr(proc, 'procs', [proc]):
+    usage = _reap_one(p)
+    if usage is None or total is None:
+      total = None
+    else:
+      total = (total[0] + usage.ru_utime, total[1] + usage.ru_stime,
+               max(total[2], usage.ru_maxrss))
+
+  # Only computes the returncode (and pipestatus) now.
+  proc.wait()
+  return total
+
+
+def _reap_one(proc):
+  # Holds the lock Popen itself waits under, so a concurrent poll() can't
+  # reap the process and then mistake it for one reaped elsewhere.
+  lock = getattr(proc, '_waitpid_lock', None)
+  if lock is not None:
+    lock.acquire()
+  try:
+    if proc.returncode is not None:
+      return None
+    try:
+      _, status, usage = os.wait4(proc.pid, 0)
+    except OSError as e:
+      if e.errno != errno.ECHILD:
+        raise
+      return None
+    proc.returncode = _returncode(status)
+    return usage
+  finally:
+    if lock is not None:
+      lock.release()
+
+
+def _returncode(status):
+  if os.WIFSIGNALED(status):
+    return -os.WTERMSIG(status)
+  return os.WEXITSTATUS(status)
+
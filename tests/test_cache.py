@@ -0,0 +1,69 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from pysh import cache
+
+
+def test_store_and_load():
+  temp_dir = tempfile.mkdtemp()
+  try:
+    c = cache.BytecodeCache(temp_dir)
+    code = compile('x = 1\n', 'script.pysh', 'exec')
+    key = c.make_key('x = 1\n', 'script.pysh')
+
+    assert c.load('script.pysh', key) is None
+    c.store('script.pysh', key, code)
+    assert c.load('script.pysh', key) == code
+
+    # Changing the content invalidates the entry, and storing evicts it.
+    new_key = c.make_key('x = 2\n', 'script.pysh')
+    assert new_key != key
+    assert c.load('script.pysh', new_key) is None
+    c.store('script.pysh', new_key, code)
+    assert c.load('script.pysh', key) is None
+    assert len(os.listdir(temp_dir)) == 1
+  finally:
+    shutil.rmtree(temp_dir)
+
+
+def test_key_includes_options():
+  key = cache.BytecodeCache.make_key('x = 1\n', 'a.pysh')
+  assert key == cache.BytecodeCache.make_key('x = 1\n', 'a.pysh')
+  assert key != cache.BytecodeCache.make_key('x = 1\n', 'b.pysh')
+  assert key != cache.BytecodeCache.make_key('x = 1\n', 'a.pysh', ['opt'])
+
+
+def _run_and_check_transformer(script_file, env):
+  proc = subprocess.Popen(
+    [sys.executable, '-c',
+     'import sys, pysh\n'
+     'script = sys.argv[1]\n'
+     'pysh.main(script)\n'
+     'print("pysh.ipython.inputtransformer2" in sys.modules)\n',
+     script_file],
+    stdout=subprocess.PIPE, env=env)
+  out, _ = proc.communicate()
+  assert proc.returncode == 0
+  return out
+
+
+def test_cache_hit_skips_transformer():
+  temp_dir = tempfile.mkdtemp()
+  try:
+    script_file = os.path.join(temp_dir, 'test.pysh')
+    with open(script_file, 'w') as script_f:
+      script_f.write('!echo hi\n')
+
+    env = dict(os.environ)
+    env['PYSH_CACHE_DIR'] = os.path.join(temp_dir, 'cache')
+    env.pop(cache.DISABLE_ENV_VAR, None)
+    assert _run_and_check_transformer(script_file, env) == b'hi\nTrue\n'
+    assert _run_and_check_transformer(script_file, env) == b'hi\nFalse\n'
+
+    env[cache.DISABLE_ENV_VAR] = '1'
+    assert _run_and_check_transformer(script_file, env) == b'hi\nTrue\n'
+  finally:
+    shutil.rmtree(temp_dir)
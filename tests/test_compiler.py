@@ -0,0 +1,75 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import pytest
+
+from pysh import compiler
+
+
+EXAMPLE_STDOUT = (b"Hello from Python!\n"
+                  b"test\n"
+                  b"captured: 'foo\\n'\n"
+                  b"foo foo\n")
+
+
+def test_runtime_import_follows_future_imports():
+  source = compiler.compile_to_source(
+    '"""Doc."""\n'
+    'from __future__ import print_function\n'
+    '\n'
+    '@decorator\n'
+    'def f():\n'
+    '  !ls\n',
+    'script.pysh')
+
+  lines = source.split('\n')
+  assert lines[lines.index('from __future__ import print_function') + 2:][:2] == [
+    compiler.RUNTIME_IMPORT, '@decorator']
+  assert "  get_ipython().system('ls', expand=False)" in lines
+
+
+def test_code_keeps_script_line_numbers():
+  code = compiler.compile_to_code('import sys\n\n!ls\nx = 1 / 0\n', 'script.pysh')
+  with pytest.raises(ZeroDivisionError) as exc_info:
+    exec(code, {'__name__': '__main__'})
+
+  assert exc_info.traceback[-1].lineno + 1 == 4
+
+
+@pytest.mark.parametrize('script', [
+  '\n \n\t\n\nx = 1 / 0\n',
+  '\n\n    !ls\n    y = 1\n    x = 1 / 0\n',
+])
+def test_code_keeps_line_numbers_after_leading_blank_lines(script):
+  code = compiler.compile_to_code(script, 'script.pysh')
+  with pytest.raises(ZeroDivisionError) as exc_info:
+    exec(code, {'__name__': '__main__'})
+
+  assert exc_info.traceback[-1].lineno + 1 == 5
+
+
+@pytest.mark.parametrize('extension', ['.py', '.pyc'])
+def test_compiled_example(extension):
+  temp_dir = tempfile.mkdtemp()
+  try:
+    output_path = os.path.join(temp_dir, 'example' + extension)
+    proc = subprocess.Popen(
+      [sys.executable, '-mpysh', 'compile', 'doc/example.pysh',
+       '-o', output_path])
+    proc.wait()
+    assert proc.returncode == 0
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.getcwd()
+    proc = subprocess.Popen(
+      [sys.executable, '-X', 'importtime', output_path],
+      stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+    stdout, stderr = proc.communicate()
+    assert proc.returncode == 3
+    assert stdout == EXAMPLE_STDOUT
+    assert b'pysh.runtime' in stderr
+    assert b'inputtransformer2' not in stderr
+  finally:
+    shutil.rmtree(temp_dir)
@@ -0,0 +1,154 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from pysh import generator
+
+
+_saved_cache_dir = None
+
+
+def setup_module():
+  # The scripts these tests run cache their bytecode and runtime; keep that
+  # out of the user's cache.
+  global _saved_cache_dir
+  _saved_cache_dir = os.environ.get('PYSH_CACHE_DIR')
+  os.environ['PYSH_CACHE_DIR'] = tempfile.mkdtemp()
+
+
+def teardown_module():
+  shutil.rmtree(os.environ['PYSH_CACHE_DIR'])
+  if _saved_cache_dir is None:
+    del os.environ['PYSH_CACHE_DIR']
+  else:
+    os.environ['PYSH_CACHE_DIR'] = _saved_cache_dir
+
+
+def _start_server(socket_path):
+  env = dict(os.environ)
+  env['PYTHONPATH'] = os.getcwd()
+  server = subprocess.Popen(
+    [sys.executable, '-mpysh', 'forkserver', '--socket', socket_path], env=env)
+  for _ in range(100):
+    if os.path.exists(socket_path):
+      break
+    time.sleep(0.05)
+  return server
+
+
+def _client_env(socket_path):
+  env = dict(os.environ)
+  env['PYSH_FORKSERVER_SOCKET'] = socket_path
+  env['PATH'] = os.pathsep.join(
+    [os.path.dirname(sys.executable), env.get('PATH', '')])
+  return env
+
+
+def test_script_runs_in_fork_server():
+  temp_dir = tempfile.mkdtemp()
+  socket_path = os.path.join(temp_dir, 'sock')
+  server = _start_server(socket_path)
+  try:
+    script_file = os.path.join(temp_dir, 'test.pysh')
+    with open(script_file, 'w') as script_f:
+      script_f.write(
+        'import os\n'
+        'import sys\n'
+        'print(sys.argv[1:], os.getcwd(), os.environ["FOO"], input())\n'
+        'sys.stdout.flush()\n'
+        '!echo from shell\n'
+        'sys.exit(int(sys.argv[1]))\n')
+    generator.generate(script_file)
+
+    env = _client_env(socket_path)
+    env['FOO'] = 'bar'
+    proc = subprocess.Popen(
+      [script_file, '7', 'a b'], cwd=temp_dir, env=env,
+      stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    stdout, _ = proc.communicate(b'hello\n')
+    assert stdout == ("['7', 'a b'] {} bar hello\n"
+                      "from shell\n").format(
+                        os.path.realpath(temp_dir)).encode('utf-8')
+    assert proc.returncode == 7
+  finally:
+    server.terminate()
+    server.wait()
+    assert not os.path.exists(socket_path)
+    shutil.rmtree(temp_dir)
+
+
+def test_client_falls_back_without_server():
+  temp_dir = tempfile.mkdtemp()
+  try:
+    script_file = os.path.join(temp_dir, 'test.sh')
+    with open(script_file, 'w') as script_f:
+      script_f.write('echo "fallback $PYSH_FORKSERVER_SOCKET $1"\n')
+
+    proc = subprocess.Popen(
+      [sys.executable, '-S', '-c', generator._FORKSERVER_CLIENT_PY_SCRIPT,
+       script_file, 'arg'],
+      env=_client_env(os.path.join(temp_dir, 'missing')),
+      stdout=subprocess.PIPE)
+    stdout, _ = proc.communicate()
+    assert stdout == b'fallback  arg\n'
+    assert proc.returncode == 0
+  finally:
+    shutil.rmtree(temp_dir)
+
+
+def test_script_reads_terminal():
+  """A server on the client's own terminal gives the script the terminal."""
+  import pty
+  import select
+  temp_dir = tempfile.mkdtemp()
+  socket_path = os.path.join(temp_dir, 'sock')
+  script_file = os.path.join(temp_dir, 'test.pysh')
+  with open(script_file, 'w') as script_f:
+    script_f.write('print("got", input("prompt> "))\n')
+  generator.generate(script_file)
+
+  pid, master = pty.fork()
+  if pid == 0:
+    # A session on the terminal, with the server in it too; the client runs
+    # in the foreground.
+    code = 1
+    try:
+      server = _start_server(socket_path)
+      try:
+        code = subprocess.call([script_file], env=_client_env(socket_path))
+      finally:
+        server.terminate()
+        server.wait()
+    finally:
+      os._exit(code)
+
+  try:
+    output = b''
+    deadline = time.time() + 10
+    sent = False
+    while time.time() < deadline:
+      if not sent and b'prompt> ' in output:
+        os.write(master, b'hello\n')
+        sent = True
+      ready, _, _ = select.select([master], [], [], 0.1)
+      if ready:
+        try:
+          data = os.read(master, 1024)
+        except OSError:
+          break
+        if not data:
+          break
+        output += data
+      elif os.waitpid(pid, os.WNOHANG)[0]:
+        pid = None
+        break
+    assert b'got hello' in output, output
+  finally:
+    if pid is not None:
+      os.kill(pid, 9)
+      os.waitpid(pid, 0)
+    os.close(master)
+    shutil.rmtree(temp_dir)
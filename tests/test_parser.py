@@ -1,6 +1,9 @@
 import collections
+import os
+import shutil
 import six
 import pytest
+import tempfile
 
 from pysh import generator
 
@@ -103,3 +106,87 @@ def test_parse_and_generate(case_name):
   p.write(out)
 
   assert out.getvalue() == expected_normalized_out
+
+
+def test_stamp():
+  p = _parse_string(well_formed)
+  key = generator.stamp_key(False)
+  out = six.StringIO()
+  p.write(out, key)
+  text = out.getvalue()
+
+  stamp, unstamped = generator.split_stamp(text)
+  assert unstamped == well_formed
+  assert stamp == generator.make_stamp(key, well_formed)
+  assert generator.is_up_to_date(text.splitlines(True), key)
+  assert not generator.is_up_to_date(
+    (text + 'print(1)\n').splitlines(True), key)
+  assert not generator.is_up_to_date(
+    text.splitlines(True), generator.stamp_key(False, legacy_bootstrap=True))
+  assert not generator.is_up_to_date(well_formed.splitlines(True), key)
+
+
+def test_generate_all():
+  temp_dir = tempfile.mkdtemp()
+  try:
+    paths = [os.path.join(temp_dir, 'a.pysh'),
+             os.path.join(temp_dir, 'sub', 'b.pysh'),
+             os.path.join(temp_dir, 'sub', 'generated')]
+    os.mkdir(os.path.join(temp_dir, 'sub'))
+    os.mkdir(os.path.join(temp_dir, '.hidden'))
+    for path in paths + [os.path.join(temp_dir, '.hidden', 'c.pysh')]:
+      with open(path, 'w') as script_f:
+        script_f.write(basic_content)
+    with open(os.path.join(temp_dir, 'sub', 'plain.sh'), 'w') as script_f:
+      script_f.write('#!/bin/sh -e\necho plain\n')
+    generator.generate(paths[2])
+
+    results = generator.generate_all([temp_dir], jobs=2)
+    assert results == [(paths[0], True, None), (paths[1], True, None),
+                       (paths[2], False, None)]
+    with open(paths[0]) as script_f:
+      generated = script_f.read()
+    assert generator.STAMP_PREFIX in generated
+
+    with open(paths[1], 'a') as script_f:
+      script_f.write('print(1)\n')
+    results = generator.generate_all([temp_dir, 'missing'], jobs=1)
+    assert [changed for _, changed, _ in results] == [
+      False, True, False, False]
+    assert results[-1][2] is not None
+    with open(paths[0]) as script_f:
+      assert script_f.read() == generated
+  finally:
+    shutil.rmtree(temp_dir)
+
+
+def test_generate_dist_payload():
+  from pysh import payload
+  temp_dir = tempfile.mkdtemp()
+  try:
+    path = os.path.join(temp_dir, 'a.pysh')
+    with open(path, 'w') as script_f:
+      script_f.write(basic_content)
+    data = payload.build()
+    assert generator.generate(path, dist=True, payload_data=data)
+    assert not generator.generate(path, dist=True, payload_data=data)
+    # Another payload replaces the embedded one.
+    other = data[:-64] + b'0' * 64
+    assert generator.generate(path, dist=True, payload_data=other)
+    with open(path, 'rb') as script_f:
+      assert script_f.read().endswith(other)
+    assert generator.generate(path, dist=False)
+  finally:
+    shutil.rmtree(temp_dir)
+
+
+@pytest.mark.parametrize('argv', [
+  ['gen', '-j', '0', 'x'],
+  ['dist', '--jobs', 'many', 'x'],
+  ['gen', '-', 'x'],
+])
+def test_generate_bad_args(argv):
+  from pysh import __main__
+  with pytest.raises(SystemExit) as exc_info:
+    __main__.parse_args(argv)
+  assert exc_info.value.code == 2
@@ -0,0 +1,67 @@
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import zipfile
+
+from pysh import payload
+
+
+def test_find_modules():
+  modules = payload.find_modules()
+  for name in ('pysh', 'pysh.pysh', 'pysh.runtime', 'pysh.capture',
+               'pysh.ipython', 'pysh.ipython.inputtransformer2'):
+    assert name in modules
+  # Only `pysh` subcommands, or Python 2, use these.
+  for name in ('pysh.__main__', 'pysh.generator', 'pysh.forkserver',
+               'pysh.compiler', 'pysh.payload', 'pysh.ipython.py3compat'):
+    assert name not in modules
+  assert modules['pysh'].endswith(os.path.join('pysh', '__init__.py'))
+
+
+def test_build_is_reproducible():
+  code = ('import hashlib, sys\n'
+          'from pysh import payload\n'
+          'sys.stdout.write(hashlib.sha256(payload.build()).hexdigest())\n')
+  digests = set()
+  for seed in ('1', '2'):
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.getcwd()
+    env['PYTHONHASHSEED'] = seed
+    digests.add(subprocess.check_output([sys.executable, '-c', code], env=env))
+  assert len(digests) == 1
+
+  data = payload.build()
+  zip_f = zipfile.ZipFile(io.BytesIO(data))
+  names = zip_f.namelist()
+  assert names == sorted(names)
+  assert 'pysh/runtime.py' in names and 'pysh/runtime.pyc' in names
+  assert all(info.date_time == (1980, 1, 1, 0, 0, 0)
+             for info in zip_f.infolist())
+  assert len(payload.payload_hash(data)) == 64
+  assert payload.payload_hash(b'#!/bin/sh\n' + data) == (
+    payload.payload_hash(data))
+
+
+def test_payload_imports_bytecode():
+  temp_dir = tempfile.mkdtemp()
+  try:
+    zip_path = os.path.join(temp_dir, 'payload.zip')
+    with open(zip_path, 'wb') as zip_f:
+      zip_f.write(payload.build())
+
+    env = dict(os.environ)
+    env.pop('PYTHONPATH', None)
+    out = subprocess.check_output(
+      [sys.executable, '-c',
+       'import sys\n'
+       'sys.path.insert(0, sys.argv[1])\n'
+       'from pysh.ipython import inputtransformer2\n'
+       'import pysh.runtime\n'
+       'sys.stdout.write(pysh.runtime.__file__)\n', zip_path],
+      env=env, cwd=temp_dir)
+    assert out.decode('utf-8') == os.path.join(zip_path, 'pysh', 'runtime.pyc')
+  finally:
+    shutil.rmtree(temp_dir)
@@ -0,0 +1,62 @@
+import os
+import pstats
+import shutil
+import subprocess
+import sys
+import tempfile
+
+
+def test_profile_reports_script_lines():
+  temp_dir = tempfile.mkdtemp()
+  try:
+    script_file = os.path.join(temp_dir, 'test.pysh')
+    with open(script_file, 'w') as script_f:
+      script_f.write(
+        'import time\n'
+        '!echo a \\\n'
+        '  b >/dev/null\n'
+        '!sleep 0.3\n'
+        'time.sleep(0.1)\n')
+    collapsed_file = os.path.join(temp_dir, 'stacks.txt')
+    pstats_file = os.path.join(temp_dir, 'stats.prof')
+
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.getcwd()
+    env['PYSH_CACHE_DIR'] = os.path.join(temp_dir, 'cache')
+    proc = subprocess.Popen(
+      [sys.executable, '-mpysh', 'run', '--profile',
+       '--profile-collapsed', collapsed_file, '--profile-pstats', pstats_file,
+       script_file], env=env, stderr=subprocess.PIPE)
+    _, stderr = proc.communicate()
+    assert proc.returncode == 0, stderr
+
+    report = stderr.decode('utf-8').splitlines()
+    assert report[0].startswith('pysh profile of {}'.format(script_file))
+    rows = [line.split(None, 4) for line in report[2:]]
+    # The slowest line first, with its number in the original script.
+    assert rows[0][0] == '4' and rows[0][4] == '!sleep 0.3'
+    assert 250 < float(rows[0][1]) < 1000
+    assert rows[1][0] == '5' and rows[1][4] == 'time.sleep(0.1)'
+
+    with open(collapsed_file) as collapsed_f:
+      stacks = [line.rsplit(' ', 1) for line in collapsed_f]
+    assert all(s.startswith('<module> (test.pysh:') for s, _ in stacks)
+    sleep_us = sum(int(us) for s, us in stacks
+                   if s.startswith('<module> (test.pysh:4);'))
+    assert sleep_us > 250000
+
+    stats = pstats.Stats(pstats_file)
+    assert any(func[0] == script_file for func in stats.stats)
+  finally:
+    shutil.rmtree(temp_dir)
+
+
+def test_profile_options_need_profile():
+  env = dict(os.environ)
+  env['PYTHONPATH'] = os.getcwd()
+  proc = subprocess.Popen(
+    [sys.executable, '-mpysh', 'run', '--profile-pstats', 'x', 'y.pysh'],
+    env=env, stderr=subprocess.PIPE)
+  _, stderr = proc.communicate()
+  assert proc.returncode == 1
+  assert b'need --profile' in stderr
@@ -7,6 +7,25 @@ import tempfile
 import six
 
 
+_saved_cache_dir = None
+
+
+def setup_module():
+  # The scripts these tests run cache their bytecode and runtime; keep that
+  # out of the user's cache.
+  global _saved_cache_dir
+  _saved_cache_dir = os.environ.get('PYSH_CACHE_DIR')
+  os.environ['PYSH_CACHE_DIR'] = tempfile.mkdtemp()
+
+
+def teardown_module():
+  shutil.rmtree(os.environ['PYSH_CACHE_DIR'])
+  if _saved_cache_dir is None:
+    del os.environ['PYSH_CACHE_DIR']
+  else:
+    os.environ['PYSH_CACHE_DIR'] = _saved_cache_dir
+
+
 def test_example_from_run():
   proc = subprocess.Popen(
     [sys.executable, '-mpysh', 'run', 'doc/example.pysh'],
@@ -173,10 +192,10 @@ def test_e2e_dist():
     proc = subprocess.Popen([sys.executable, '-mpysh', 'dist', script_file])
     proc.wait()
     assert proc.returncode == 0
-    with open(script_file) as script_f:
+    with open(script_file, 'rb') as script_f:
       lines = list(script_f)
 
-    assert lines[0] == '#!/bin/sh -e\n'
+    assert lines[0] == b'#!/bin/sh -e\n'
 
     try:
       proc = subprocess.Popen(
@@ -200,3 +219,134 @@ def test_e2e_dist():
                        env=pipenv_env).wait()
   finally:
     shutil.rmtree(temp_dir)
+
+
+def test_dist_layout():
+  """pysh dist appends a zip of pysh, importable from the script itself."""
+  import zipfile
+  from pysh import embedded
+  temp_dir = tempfile.mkdtemp()
+  try:
+    script_file = os.path.join(temp_dir, 'test.sh')
+    with open(script_file, 'w') as script_f:
+      script_f.write('x = !echo captured\nprint(x.strip())\nimport sys\n'
+                     'sys.exit(3)')
+
+    for _ in range(2):
+      # Again on the dist script, which only replaces the zip.
+      proc = subprocess.Popen([sys.executable, '-mpysh', 'dist', script_file])
+      proc.wait()
+      assert proc.returncode == 0
+
+    with open(script_file, 'rb') as script_f:
+      data = script_f.read()
+    notice = embedded.NOTICE_LINE
+    assert data.count(notice) == 1
+    assert data.index(notice) < data.index(b'PK\x03\x04')
+    assert 'pysh/runtime.py' in zipfile.ZipFile(script_file).namelist()
+
+    # What the bootstrap runs, without the pysh package on the path; pysh is
+    # imported from the zip, even after the script changes directory.
+    env = dict(os.environ)
+    env.pop('PYTHONPATH', None)
+    proc = subprocess.Popen(
+      [sys.executable, '-c',
+       'import os, sys\n'
+       "sys.path.insert(0, os.path.abspath('test.sh'))\n"
+       'os.chdir("/")\n'
+       'import pysh\n'
+       'assert pysh.__file__.startswith(sys.path[0]), pysh.__file__\n'
+       'pysh.main(sys.argv[1])\n', script_file],
+      cwd=temp_dir, env=env, stdout=subprocess.PIPE)
+    stdout, _ = proc.communicate()
+    assert proc.returncode == 3
+    assert stdout == b'captured\n'
+  finally:
+    shutil.rmtree(temp_dir)
+
+
+def test_bootstrap_python_fallback():
+  """When python3 lacks pysh, the script runs with python, as it may have it."""
+  temp_dir = tempfile.mkdtemp()
+  try:
+    script_file = os.path.join(temp_dir, 'test.sh')
+    with open(script_file, 'w') as script_f:
+      script_f.write('import sys\n'
+                     'sys.stdout.write(" ".join(sys.argv[1:]) + "\\n")\n')
+    proc = subprocess.Popen([sys.executable, '-mpysh', 'gen', script_file])
+    proc.wait()
+    assert proc.returncode == 0
+
+    def fake_python(name, flags):
+      path = os.path.join(temp_dir, name)
+      with open(path, 'w') as fake_f:
+        fake_f.write('#!/bin/sh\nexec {} {} "$@"\n'.format(sys.executable,
+                                                         flags))
+      os.chmod(path, 0o755)
+
+    # -I leaves the current directory, hence pysh, off sys.path.
+    fake_python('python3', '-I')
+    fake_python('python', '')
+    env = dict(os.environ)
+    env.pop('PYSH_PYTHON', None)
+    env['PATH'] = os.pathsep.join([temp_dir, env.get('PATH', '')])
+    out = subprocess.check_output([script_file, 'a', 'b c'], env=env)
+    assert out == b'a b c\n'
+
+    # Without pysh for either, the script fails once.
+    fake_python('python', '-I')
+    proc = subprocess.Popen([script_file], env=env, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    out, err = proc.communicate()
+    assert proc.returncode == 253
+    assert err.count(b'requires the pysh package') == 1
+  finally:
+    shutil.rmtree(temp_dir)
+
+
+def test_bootstrap_python():
+  """Nested scripts reuse the interpreter, unless $PATH changed."""
+  temp_dir = tempfile.mkdtemp()
+  try:
+    script_file = os.path.join(temp_dir, 'test.sh')
+    with open(script_file, 'w') as script_f:
+      script_f.write('import os, sys\n'
+                     'sys.stdout.write(sys.executable + "\\n")\n'
+                     'sys.stdout.write(os.environ["PYSH_PYTHON"] + "\\n")\n')
+    proc = subprocess.Popen([sys.executable, '-mpysh', 'gen', script_file])
+    proc.wait()
+    assert proc.returncode == 0
+
+    env = dict(os.environ)
+    env.pop('PYSH_PYTHON', None)
+    env['PATH'] = os.pathsep.join(
+      [os.path.dirname(sys.executable), env.get('PATH', '')])
+    for shell in ('/bin/sh', 'bash'):
+      executable, recorded = subprocess.check_output(
+        [shell, script_file], env=env).decode('utf-8').splitlines()
+      assert executable == recorded
+      assert os.path.realpath(executable) == os.path.realpath(sys.executable)
+
+    # As left by a pysh script which ran with another $PATH.
+    fake_python = os.path.join(temp_dir, 'fake-python')
+    with open(fake_python, 'w') as fake_f:
+      fake_f.write('#!/bin/sh\necho fake\n')
+    os.chmod(fake_python, 0o755)
+    env['PYSH_PYTHON'] = fake_python
+    env['PYSH_PYTHON_PATH'] = '/nonexistent'
+    out = subprocess.check_output(['/bin/sh', script_file], env=env)
+    assert out != b'fake\n'
+    # And with the same $PATH.
+    env['PYSH_PYTHON_PATH'] = env['PATH']
+    out = subprocess.check_output(['/bin/sh', script_file], env=env)
+    assert out == b'fake\n'
+
+    # The legacy header is still available.
+    proc = subprocess.Popen([sys.executable, '-mpysh', 'gen',
+                             '--legacy-bootstrap', script_file])
+    proc.wait()
+    assert proc.returncode == 0
+    with open(script_file) as script_f:
+      assert 'which python3' in script_f.read()
+  finally:
+    shutil.rmtree(temp_dir)
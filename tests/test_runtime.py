@@ -0,0 +1,561 @@
+import io
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+import pytest
+
+import pysh
+from pysh import CalledProcessError
+from pysh import runtime
+from pysh import shell
+
+
+@pytest.mark.parametrize('cmd,argv', [
+  ('true', ['true']),
+  ('  ls  -l\t/tmp ', ['ls', '-l', '/tmp']),
+  ("grep 'a b' \"c d\" e''f", ['grep', 'a b', 'c d', 'ef']),
+  ("cat '$HOME' \"|\"", ['cat', '$HOME', '|']),
+  ('env a=b', ['env', 'a=b']),
+  ('', None),
+  ('   ', None),
+  ('a=b env', None),
+  ('ls | wc', None),
+  ('ls > out', None),
+  ('ls *.py', None),
+  ('ls ~', None),
+  ('echo $HOME', None),
+  ('cat "$HOME"', None),
+  ('ls `pwd`', None),
+  ('ls \\ a', None),
+  ('ls; ls', None),
+  ('ls && ls', None),
+  ('ls # comment', None),
+  ('ls\nls', None),
+  ("ls 'unterminated", None),
+  ('cd /', None),
+  ('exit 2', None),
+  ('echo hi', None),
+])
+def test_split_simple_command(cmd, argv):
+  assert shell.split_simple_command(cmd) == argv
+
+
+def test_empty_quoted_argument_is_kept():
+  assert shell.split_simple_command("env '' \"\"") == ['env', '', '']
+
+
+def test_direct_exec_matches_shell():
+  stub = runtime.get_ipython()
+  assert stub.getoutput("printf %s 'a  b'") == 'a  b'
+  assert stub.getoutput("env -i X='a  b' env") == 'X=a  b\n'
+  with pytest.raises(CalledProcessError) as exc_info:
+    stub.system('false')
+  assert exc_info.value.returncode == 1
+
+
+def test_direct_exec_falls_back_to_shell():
+  stub = runtime.get_ipython()
+  with pytest.raises(CalledProcessError) as exc_info:
+    stub.system('pysh-no-such-command')
+  assert exc_info.value.returncode == 127
+
+  # Scripts without a #! line are run by the shell.
+  temp_dir = tempfile.mkdtemp()
+  try:
+    script = os.path.join(temp_dir, 'script')
+    with open(script, 'w') as script_f:
+      script_f.write('echo from script\n')
+    os.chmod(script, stat.S_IRWXU)
+    assert stub.getoutput(script) == 'from script\n'
+  finally:
+    shutil.rmtree(temp_dir)
+
+
+def test_capture_lines():
+  stub = runtime.get_ipython()
+  lines = stub.getoutput("printf 'a\\n\\nb c\\nd'", capture='lines')
+  assert list(lines) == ['a', '', 'b c', 'd']
+
+
+def test_capture_lines_is_lazy():
+  stub = runtime.get_ipython()
+  lines = stub.getoutput('yes', capture='lines')
+  assert next(lines) == 'y'
+  lines.close()
+
+
+def test_capture_lines_raises_when_exhausted():
+  stub = runtime.get_ipython()
+  lines = stub.getoutput('sh -c "echo a; exit 3"', capture='lines')
+  assert next(lines) == 'a'
+  with pytest.raises(CalledProcessError) as exc_info:
+    next(lines)
+  assert exc_info.value.returncode == 3
+
+
+def test_capture_lines_expands_variables_eagerly():
+  stub = runtime.get_ipython()
+  word = 'before'
+  lines = stub.getoutput('echo {word}', capture='lines')
+  word = 'after'
+  assert list(lines) == ['before']
+
+
+def test_background_jobs_run_concurrently():
+  stub = runtime.get_ipython()
+  start = time.time()
+  jobs = [stub.getoutput('sleep 0.5; echo {i}', background=True)
+          for i in range(4)]
+  assert all(job.returncode is None for job in jobs)
+  assert stub.wait_all(jobs) == ['0\n', '1\n', '2\n', '3\n']
+  assert time.time() - start < 1.5
+  assert jobs[0].returncode == 0
+
+
+def test_background_job_failure_raises_when_awaited():
+  stub = runtime.get_ipython()
+  failing = stub.system('exit 4', background=True)
+  ok = stub.getoutput('echo ok', background=True)
+  with pytest.raises(CalledProcessError) as exc_info:
+    pysh.wait_all()
+  assert exc_info.value.returncode == 4
+  assert ok.result() == 'ok\n'
+  assert failing.returncode == 4
+  assert pysh.wait_all() == []
+
+
+@pytest.mark.parametrize('cmd,stages', [
+  ('ls | wc -l', [['ls'], ['wc', '-l']]),
+  ("a|b 'c|d'|e", [['a'], ['b', 'c|d'], ['e']]),
+  ('a || b', None),
+  ('a | | b', None),
+  ('| a', None),
+  ('a |', None),
+  ('a | cd x', None),
+  ('a | b > c', None),
+])
+def test_split_pipeline(cmd, stages):
+  assert shell.split_pipeline(cmd) == stages
+
+
+def test_pipeline_runs_without_shell():
+  proc = runtime.popen(['seq 3 | sort -r | head -2'], stdout=subprocess.PIPE)
+  assert isinstance(proc, runtime.Pipeline)
+  out, _ = proc.communicate()
+  assert out == b'3\n2\n'
+  assert proc.pipestatus == [0, 0, 0]
+
+
+def test_pipeline_pipefail():
+  stub = runtime.get_ipython()
+  with pytest.raises(CalledProcessError) as exc_info:
+    stub.system('sh -c "exit 3" | false | true')
+  assert exc_info.value.returncode == 1
+  assert exc_info.value.pipestatus == [3, 1, 0]
+
+
+@pytest.mark.parametrize('cmd', [
+  'yes | head -2',
+  'yes y 2>/dev/null | head -2',
+  'yes $PYSH_TEST_NONE y | head -2',
+])
+def test_pipeline_ignores_sigpipe_upstream(cmd):
+  """Also from stages run through /bin/sh, whose status is then 128+13."""
+  stub = runtime.get_ipython()
+  assert stub.getoutput(cmd, expand=False) == 'y\ny\n'
+
+
+def test_pipeline_with_missing_program_uses_shell():
+  stub = runtime.get_ipython()
+  with pytest.raises(CalledProcessError) as exc_info:
+    stub.getoutput('pysh-no-such-command | echo fallback')
+  assert exc_info.value.pipestatus == [127, 0]
+  assert exc_info.value.output == 'fallback\n'
+
+
+@pytest.mark.parametrize('cmd', [
+  'sh -c "exit 3" | cat $PYSH_TEST_NONE',
+  'exit 3 | cat',
+  'echo a | false | printf b',
+  'false 2>&1 | cat >/dev/null',
+])
+def test_pipeline_pipefail_through_shell(cmd):
+  """Stages which need the shell count as much as the others."""
+  stub = runtime.get_ipython()
+  with pytest.raises(CalledProcessError):
+    stub.getoutput(cmd, expand=False)
+  with runtime.shell_session():
+    with pytest.raises(CalledProcessError):
+      stub.getoutput(cmd, expand=False)
+    with pytest.raises(CalledProcessError):
+      stub.system(cmd, expand=False)
+
+
+def test_pipeline_stages_through_shell():
+  stub = runtime.get_ipython()
+  os.environ['PYSH_TEST_VAR'] = 'b c'
+  try:
+    assert stub.getoutput(
+      'echo "a $PYSH_TEST_VAR" | tr a-z A-Z 2>&1 | sed "s/ /|/g"',
+      expand=False) == 'A|B|C\n'
+  finally:
+    del os.environ['PYSH_TEST_VAR']
+  # Not a single pipeline: the shell runs it as a whole.
+  assert stub.getoutput('false | true; echo done', expand=False) == 'done\n'
+
+
+def test_pipeline_communicate_input():
+  proc = runtime.popen(['tr a-z A-Z | rev'], stdin=subprocess.PIPE,
+                       stdout=subprocess.PIPE)
+  assert isinstance(proc, runtime.Pipeline)
+  data = b'abc\n' * 100000
+  out, _ = proc.communicate(data)
+  assert out == b'CBA\n' * 100000
+  assert proc.pipestatus == [0, 0]
+
+
+def test_pmap_keeps_input_order():
+  suffix = '!'
+  start = time.time()
+  out = pysh.pmap('sleep {delay}; echo {word}{suffix}', jobs=3,
+                  word=['a', 'b', 'c'], delay=[0.4, 0.2, 0])
+  assert out == ['a!\n', 'b!\n', 'c!\n']
+  assert time.time() - start < 1
+
+
+def test_pmap_limits_concurrency():
+  temp_dir = tempfile.mkdtemp()
+  try:
+    # Each command fails if more than 2 commands are running.
+    cmd = ('mkdir {temp_dir}/{i} && '
+           'test $(ls {temp_dir} | wc -l) -le 2 && sleep 0.1 && '
+           'rmdir {temp_dir}/{i}')
+    assert runtime.pmap(cmd, jobs=2, i=range(6)) == [''] * 6
+  finally:
+    shutil.rmtree(temp_dir)
+
+
+def test_pmap_failures():
+  with pytest.raises(CalledProcessError) as exc_info:
+    pysh.pmap('exit {code}', jobs=1, code=[0, 3, 4])
+  assert exc_info.value.returncode == 3
+
+  results = pysh.pmap('echo {code}; exit {code}', fail_fast=False,
+                      code=[0, 3, 0])
+  assert results[0] == results[2] == '0\n'
+  assert isinstance(results[1], CalledProcessError)
+  assert results[1].returncode == 3
+  assert results[1].output == '3\n'
+
+
+def test_pmap_rejects_uneven_iterables():
+  with pytest.raises(ValueError):
+    pysh.pmap('echo {a} {b}', a=[1, 2], b=[1])
+
+
+@pytest.mark.parametrize('mode', ['compile', 'runtime'])
+def test_expansion_modes(mode):
+  temp_dir = tempfile.mkdtemp()
+  try:
+    script_file = os.path.join(temp_dir, 'test.pysh')
+    with open(script_file, 'w') as script_f:
+      script_f.write(
+        'def f(name):\n'
+        '  !echo {name.upper()} $name $$name\n'
+        'for name in ["a", "b"]:\n'
+        '  f(name)\n')
+
+    env = dict(os.environ)
+    env['PYSH_EXPAND'] = mode
+    env['PYSH_NO_CACHE'] = '1'
+    proc = subprocess.Popen(
+      [sys.executable, '-mpysh', 'run', script_file], env=env,
+      stdout=subprocess.PIPE)
+    stdout, _ = proc.communicate()
+    assert proc.returncode == 0
+    assert stdout == b'A a\nB b\n'
+  finally:
+    shutil.rmtree(temp_dir)
+
+
+def test_shell_session_runs_commands_in_one_shell():
+  stub = runtime.get_ipython()
+  with pysh.shell_session() as session:
+    assert stub.getoutput('echo $$', expand=False) == '{}\n'.format(
+      session.pid)
+    assert stub.getoutput('echo $$', expand=False) == '{}\n'.format(
+      session.pid)
+    assert stub.getoutput("printf 'a\\r\\nb'", expand=False) == 'a\nb'
+    stub.system('true', expand=False)
+    with pytest.raises(CalledProcessError) as e:
+      stub.getoutput('echo out; exit 3', expand=False)
+    assert e.value.returncode == 3
+    assert e.value.output == 'out\n'
+  assert runtime._SESSION is None
+
+
+def test_shell_session_matches_per_command_state():
+  temp_dir = tempfile.mkdtemp()
+  old_cwd = os.getcwd()
+  stub = runtime.get_ipython()
+  try:
+    with pysh.shell_session():
+      # Each command runs in a subshell; a syntax error doesn't end the session.
+      stub.system('cd /; X=1', expand=False)
+      with pytest.raises(CalledProcessError):
+        stub.system('echo (', expand=False)
+      assert stub.getoutput('echo "$X"', expand=False) == '\n'
+
+      os.chdir(temp_dir)
+      os.environ['PYSH_TEST_VAR'] = "it's"
+      assert stub.getoutput('pwd; echo "$PYSH_TEST_VAR"', expand=False) == (
+        "{}\nit's\n".format(os.getcwd()))
+      del os.environ['PYSH_TEST_VAR']
+      assert stub.getoutput('echo "${PYSH_TEST_VAR-unset}"',
+                            expand=False) == 'unset\n'
+  finally:
+    os.environ.pop('PYSH_TEST_VAR', None)
+    os.chdir(old_cwd)
+    shutil.rmtree(temp_dir)
+
+
+@pytest.mark.parametrize('as_sh', [False, True])
+def test_shell_session_under_bash(as_sh):
+  """bash runs each command as soon as it reads it, also as sh."""
+  from pysh import session
+  bash = '/bin/bash'
+  if not os.path.exists(bash):
+    pytest.skip('no /bin/bash')
+  temp_dir = tempfile.mkdtemp()
+  shell_session = None
+  try:
+    if as_sh:
+      os.symlink(bash, os.path.join(temp_dir, 'sh'))
+      bash = os.path.join(temp_dir, 'sh')
+    shell_session = session.ShellSession(shell=bash)
+    assert shell_session.run('echo hi', capture=True) == (0, b'hi\n')
+    # Newlines in commands and the environment.
+    os.environ['PYSH_TEST_VAR'] = "a\nb'c"
+    assert shell_session.run("echo 'x\ny'\nexit 3\necho no",
+                             capture=True) == (3, b'x\ny\n')
+    assert shell_session.run('printf %s "$PYSH_TEST_VAR"',
+                             capture=True) == (0, b"a\nb'c")
+  finally:
+    os.environ.pop('PYSH_TEST_VAR', None)
+    if shell_session is not None:
+      shell_session.close()
+    shutil.rmtree(temp_dir)
+
+
+def test_shell_session_restarts_after_shell_dies():
+  stub = runtime.get_ipython()
+  with pysh.shell_session() as session:
+    with pytest.raises(CalledProcessError) as e:
+      stub.system('kill -9 $$', expand=False)
+    assert e.value.returncode == -9
+    assert session.pid is None
+    assert stub.getoutput('echo ok', expand=False) == 'ok\n'
+
+
+@pytest.mark.parametrize('capture,output_type', [
+  ('bytes', bytes),
+  ('bytearray', bytearray),
+])
+def test_binary_capture(capture, output_type):
+  stub = runtime.get_ipython()
+  out = stub.getoutput("printf 'a\\377\\r\\n'", capture=capture)
+  assert type(out) is output_type
+  assert out == b'a\xff\r\n'
+
+  with pytest.raises(CalledProcessError) as e:
+    stub.getoutput("printf '\\377'; exit 1", capture=capture)
+  assert e.value.output == b'\xff'
+
+
+def test_bytearray_capture_grows():
+  out = runtime.get_ipython().getoutput('seq 100000', capture='bytearray')
+  assert out.decode().split() == [str(i) for i in range(1, 100001)]
+
+
+def test_mmap_capture():
+  from pysh import capture
+  stub = runtime.get_ipython()
+  with stub.getoutput('seq 100000', capture='mmap') as out:
+    assert out.mapped
+    assert len(out) == len(out.buffer) > capture.MMAP_THRESHOLD
+    assert out[:6] == b'1\n2\n3\n'
+    assert out.decode().split() == [str(i) for i in range(1, 100001)]
+
+  small = stub.getoutput('echo hi', capture='mmap')
+  assert not small.mapped
+  assert bytes(small) == b'hi\n' and small.decode() == 'hi\n'
+  assert len(stub.getoutput('true', capture='mmap')) == 0
+
+
+def test_binary_capture_in_background_and_session():
+  stub = runtime.get_ipython()
+  job = stub.getoutput("printf '\\377'", capture='bytes', background=True)
+  assert job.result() == b'\xff'
+  with pytest.raises(ValueError):
+    stub.getoutput('true', capture='mmap', background=True)
+
+  with pysh.shell_session():
+    assert stub.getoutput("printf '\\377\\r\\n'", capture='bytes') == (
+      b'\xff\r\n')
+
+
+def test_bounded_capture():
+  stub = runtime.get_ipython()
+  with stub.getoutput('seq 1000', capture='bounded') as out:
+    assert not out.truncated
+    assert out.decode() == ''.join('{}\n'.format(i) for i in range(1, 1001))
+
+  os.environ['PYSH_CAPTURE_LIMIT'] = '1K'
+  try:
+    with stub.getoutput('seq 100000', capture='bounded') as out:
+      assert out.truncated
+      assert len(out.head) == len(out.tail) == 1024
+      assert out.head.startswith(b'1\n2\n')
+      assert out.tail.endswith(b'99999\n100000\n')
+      assert out.size == len(out.read())
+      with out.open(encoding='utf-8') as output_f:
+        assert [int(line) for line in output_f] == list(range(1, 100001))
+      assert '[... {} bytes omitted ...]'.format(out.size - 2048) in str(out)
+
+    with pytest.raises(CalledProcessError) as e:
+      stub.getoutput('seq 100000; exit 2', capture='bounded')
+    assert e.value.output.startswith('1\n2\n')
+    assert e.value.output.endswith('99999\n100000\n')
+    assert len(e.value.output) < 2100
+  finally:
+    del os.environ['PYSH_CAPTURE_LIMIT']
+
+
+def test_capture_both():
+  stub = runtime.get_ipython()
+  out = stub.getoutput('echo out; echo err >&2', capture='both')
+  assert out == ('out\n', 'err\n')
+  assert (out.stdout, out.stderr) == ('out\n', 'err\n')
+
+  # More than a pipe holds on both streams at once, as well as a pipeline.
+  out, err = stub.getoutput('seq 100000 >&2; seq 100000', capture='both')
+  assert out == err == ''.join('{}\n'.format(i) for i in range(1, 100001))
+  with pytest.raises(CalledProcessError) as e:
+    stub.getoutput('ls -d / /nonexistent-pysh | sort', capture='both')
+  assert e.value.pipestatus == [2, 0]
+  assert e.value.output == '/\n' and 'nonexistent-pysh' in e.value.stderr
+
+  with pytest.raises(CalledProcessError) as e:
+    stub.getoutput('echo out; echo failed >&2; exit 3', capture='both')
+  assert e.value.returncode == 3
+  assert (e.value.output, e.value.stderr) == ('out\n', 'failed\n')
+
+  with pytest.raises(ValueError):
+    stub.getoutput('true', capture='both', background=True)
+  with pytest.raises(ValueError):
+    stub.getoutput('true', capture='bytes', tee=True)
+
+
+def test_capture_tee():
+  code = ('from pysh import runtime\n'
+          'stub = runtime.get_ipython()\n'
+          'out = stub.getoutput("echo a; echo b >&2", tee=True)\n'
+          'assert out == "a\\n", out\n'
+          'both = stub.getoutput("echo c; echo d >&2", capture="both", '
+          'tee=True)\n'
+          'assert both == ("c\\n", "d\\n"), both\n')
+  env = dict(os.environ)
+  env['PYTHONPATH'] = os.getcwd()
+  proc = subprocess.Popen([sys.executable, '-c', code], env=env,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+  stdout, stderr = proc.communicate()
+  assert proc.returncode == 0, stderr
+  # Without capture='both', stderr isn't captured and goes through as usual.
+  assert stdout == b'a\nc\n'
+  assert stderr == b'b\nd\n'
+
+
+def test_stdin_sources():
+  stub = runtime.get_ipython()
+  assert stub.getoutput('cat', stdin='\xe9\n') == '\xe9\n'
+  assert stub.getoutput('cat', stdin=bytearray(b'\xff'), capture='bytes') == (
+    b'\xff')
+  assert stub.getoutput('cat', stdin=io.BytesIO(b'a\nb\n')) == 'a\nb\n'
+  assert stub.getoutput('sort -r | head -2', stdin=['a\n', b'b\n', 'c\n']) == (
+    'c\nb\n')
+
+  temp_dir = tempfile.mkdtemp()
+  try:
+    path = os.path.join(temp_dir, 'input')
+    with open(path, 'w') as input_f:
+      input_f.write('1\n2\n3\n')
+    with open(path) as input_f:
+      assert input_f.readline() == '1\n'
+      # The command reads the file from where the script got to.
+      assert stub.getoutput('cat', stdin=input_f) == '2\n3\n'
+  finally:
+    shutil.rmtree(temp_dir)
+
+
+def test_stdin_streams_without_deadlock():
+  stub = runtime.get_ipython()
+  lines = ('{}\n'.format(i) for i in range(200000))
+  # cat writes back more than a pipe holds while it's still being fed.
+  out = stub.getoutput('cat', stdin=lines, capture='bytes')
+  assert out.count(b'\n') == 200000
+  out, err = stub.getoutput('tee /dev/stderr', capture='both',
+                            stdin=('x' * 1000 for _ in range(1000)))
+  assert len(out) == len(err) == 1000000
+
+  job = stub.getoutput('wc -l', stdin=['a\n'] * 10, background=True)
+  assert job.result().strip() == '10'
+  stub.system('test "$(cat)" = hi', stdin='hi')
+  with pysh.shell_session():
+    assert stub.getoutput('cat', stdin='not the session\n') == (
+      'not the session\n')
+
+
+def test_stdin_early_exit_and_errors():
+  stub = runtime.get_ipython()
+  consumed = []
+  def lines():
+    for i in range(10 ** 7):
+      consumed.append(i)
+      yield '{}\n'.format(i)
+  assert stub.getoutput('head -1', stdin=lines()) == '0\n'
+  assert len(consumed) < 10 ** 7
+
+  def failing():
+    yield 'a\n'
+    raise KeyError('source failed')
+  with pytest.raises(KeyError):
+    stub.getoutput('cat', stdin=failing())
+  with pytest.raises(KeyError):
+    stub.system('cat >/dev/null', stdin=failing())
+
+
+def test_stdin_pipe_is_closed_on_exec():
+  """Else on Python 2 the command inherits the write end, and never gets EOF."""
+  import fcntl
+  from pysh import feed
+  feeder = feed.Feeder('x')
+  try:
+    for fd in (feeder.stdin, feeder._fd):
+      assert fcntl.fcntl(fd, fcntl.F_GETFD) & fcntl.FD_CLOEXEC
+  finally:
+    feeder.close()
+
+
+def test_capture_limit():
+  from pysh import capture
+  for value, limit in [('', 65536), ('100', 100), (' 2k', 2048),
+                       ('1M', 1 << 20)]:
+    os.environ['PYSH_CAPTURE_LIMIT'] = value
+    try:
+      assert capture.capture_limit() == limit
+    finally:
+      del os.environ['PYSH_CAPTURE_LIMIT']
@@ -0,0 +1,95 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from pysh import generator
+from pysh import payload
+from pysh import runtime_cache
+
+
+def _make_dist_script(temp_dir, name='test.sh'):
+  script_file = os.path.join(temp_dir, name)
+  with open(script_file, 'w') as script_f:
+    script_f.write('import pysh\nprint(pysh.__file__)\n')
+  proc = subprocess.Popen([sys.executable, '-mpysh', 'dist', script_file])
+  proc.wait()
+  assert proc.returncode == 0
+  return script_file
+
+
+def _run_bootstrap(script_file, cache_dir):
+  # What the shell part of the bootstrap runs, without pysh on the path.
+  env = dict(os.environ)
+  env.pop('PYTHONPATH', None)
+  env['PYSH_CACHE_DIR'] = cache_dir
+  code = generator.bootstrap_py_script(dist=True)
+  return subprocess.check_output([sys.executable, '-c', code, script_file],
+                                 env=env, cwd='/').decode('utf-8').strip()
+
+
+def test_bootstrap_extracts_once():
+  temp_dir = tempfile.mkdtemp()
+  try:
+    cache_dir = os.path.join(temp_dir, 'cache')
+    script_file = _make_dist_script(temp_dir)
+    with open(script_file, 'rb') as script_f:
+      key = payload.payload_hash(script_f)
+    runtime_dir = os.path.join(cache_dir, 'runtime', key)
+
+    assert _run_bootstrap(script_file, cache_dir) == os.path.join(
+      runtime_dir, 'pysh', '__init__.py')
+    cached = os.path.join(runtime_dir, 'pysh', '__pycache__')
+    assert any(name.startswith('runtime.') for name in os.listdir(cached))
+    os.utime(runtime_dir, (0, 0))
+
+    # Another script with the same payload uses the same copy, and marks it
+    # as used.
+    other_file = _make_dist_script(temp_dir, 'other.sh')
+    assert _run_bootstrap(other_file, cache_dir) == os.path.join(
+      runtime_dir, 'pysh', '__init__.py')
+    assert os.listdir(os.path.join(cache_dir, 'runtime')) == [key]
+    assert os.stat(runtime_dir).st_mtime > 0
+
+    # Without the cache, pysh is imported from the script itself.
+    env_file = os.path.join(temp_dir, 'cache-file')
+    open(env_file, 'w').close()
+    assert _run_bootstrap(script_file, env_file) == os.path.join(
+      script_file, 'pysh', '__init__.pyc')
+  finally:
+    shutil.rmtree(temp_dir)
+
+
+def test_extract_into_existing():
+  temp_dir = tempfile.mkdtemp()
+  try:
+    script_file = _make_dist_script(temp_dir)
+    path = os.path.join(temp_dir, 'runtime', 'key')
+    assert runtime_cache.extract(script_file, path) == path
+    # As when another run extracted it first.
+    assert runtime_cache.extract(script_file, path) == path
+    assert os.listdir(os.path.dirname(path)) == ['key']
+  finally:
+    shutil.rmtree(temp_dir)
+
+
+def test_prune():
+  temp_dir = tempfile.mkdtemp()
+  try:
+    now = time.time()
+    for i in range(6):
+      os.mkdir(os.path.join(temp_dir, 'old{}'.format(i)))
+      os.utime(os.path.join(temp_dir, 'old{}'.format(i)),
+               (now - 10 * 86400 - i, now - 10 * 86400 - i))
+    for name in ('recent', 'new', 'key.tmp-abc'):
+      os.mkdir(os.path.join(temp_dir, name))
+
+    runtime_cache.prune(temp_dir, keep=4, exclude='new')
+    # The 3 most recent besides 'new', and the temporary directory, which
+    # may still be in use.
+    assert sorted(os.listdir(temp_dir)) == [
+      'key.tmp-abc', 'new', 'old0', 'old1', 'recent']
+  finally:
+    shutil.rmtree(temp_dir)
@@ -0,0 +1,70 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+
+def _imported_modules(argv, env=None):
+  proc = subprocess.Popen(
+    [sys.executable, '-X', 'importtime', '-mpysh'] + argv,
+    stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=env)
+  _, stderr = proc.communicate()
+  assert proc.returncode == 0, stderr
+  return set(line.split('|')[-1].strip()
+             for line in stderr.decode('utf-8').splitlines()
+             if line.startswith('import time:'))
+
+
+def test_gen_imports_no_runtime():
+  temp_dir = tempfile.mkdtemp()
+  try:
+    script_file = os.path.join(temp_dir, 'test.pysh')
+    with open(script_file, 'w') as script_f:
+      script_f.write('!echo hi\n')
+
+    modules = _imported_modules(['gen', script_file])
+    assert 'pysh.generator' in modules
+    for module in ('pysh.pysh', 'pysh.runtime', 'pysh.ipython.text',
+                   'pysh.ipython.inputtransformer2', 'subprocess', 'zipfile'):
+      assert module not in modules
+  finally:
+    shutil.rmtree(temp_dir)
+
+
+def test_cached_run_imports_no_transformer():
+  temp_dir = tempfile.mkdtemp()
+  try:
+    script_file = os.path.join(temp_dir, 'test.pysh')
+    with open(script_file, 'w') as script_f:
+      script_f.write('!true\n')
+
+    env = dict(os.environ)
+    env['PYSH_CACHE_DIR'] = os.path.join(temp_dir, 'cache')
+    env.pop('PYSH_NO_CACHE', None)
+    _imported_modules(['run', script_file], env)
+    modules = _imported_modules(['run', script_file], env)
+    assert 'pysh.runtime' in modules
+    for module in ('pysh.generator', 'pysh.ipython.inputtransformer2',
+                   'pysh.ipython.py3compat', 'textwrap', 'tempfile',
+                   'hashlib', 'zipfile'):
+      assert module not in modules
+  finally:
+    shutil.rmtree(temp_dir)
+
+
+def test_runtime_imports_lazily():
+  """`import pysh.runtime` leaves what only some commands need for later."""
+  code = ('import sys\n'
+          'import pysh.runtime\n'
+          'sys.stdout.write("\\n".join(sorted(sys.modules)))\n')
+  env = dict(os.environ)
+  env['PYTHONPATH'] = os.getcwd()
+  modules = set(subprocess.check_output(
+    [sys.executable, '-c', code], env=env).decode('utf-8').split('\n'))
+  assert 'pysh.runtime' in modules
+  for module in ('pysh.session', 'pysh.feed', 'pysh.capture',
+                 'pysh.tracing', 'pysh.ipython', 'pysh.ipython.text',
+                 'pysh.pysh', 'pysh.cache', 'tempfile', 'multiprocessing',
+                 'mmap', 'json', 'string'):
+    assert module not in modules
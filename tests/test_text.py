@@ -0,0 +1,102 @@
+import random
+import re
+import string
+
+import pytest
+
+from pysh.ipython import text
+
+
+def test_template_cache_counts_and_evicts():
+  cache = text.TemplateCache(maxsize=2)
+  built = []
+
+  def build(key):
+    return lambda: built.append(key) or key.upper()
+
+  assert cache.get('a', build('a')) == 'A'
+  assert cache.get('b', build('b')) == 'B'
+  assert cache.get('a', build('a')) == 'A'
+  assert cache.get('c', build('c')) == 'C'
+  # 'b' was the least recently used.
+  assert cache.get('b', build('b')) == 'B'
+  assert built == ['a', 'b', 'c', 'b']
+  assert cache.info() == text.CacheInfo(hits=1, misses=4, maxsize=2,
+                                        currsize=2)
+
+  cache.clear()
+  assert cache.info() == text.CacheInfo(0, 0, 2, 0)
+
+
+def test_vformat_reuses_parsed_template():
+  formatter = text.DollarFormatter()
+  formatter.template_cache.clear()
+  for i in range(3):
+    assert formatter.vformat('x={ i * 2} $i $$i', [], {'i': i}) == (
+      'x={} {} $i'.format(i * 2, i))
+  info = formatter.template_cache.info()
+  assert (info.hits, info.misses) == (2, 1)
+
+  # FullEvalFormatter parses the same string differently.
+  assert text.FullEvalFormatter().vformat('$i', [], {'i': 1}) == '$i'
+
+
+def test_vformat_errors_are_raised_every_time():
+  formatter = text.DollarFormatter()
+  for _ in range(2):
+    with pytest.raises(SyntaxError):
+      formatter.vformat("awk '{print $1}'", [], {})
+    with pytest.raises(NameError):
+      formatter.vformat('{missing}', [], {})
+    with pytest.raises(ValueError):
+      formatter.vformat('{', [], {})
+
+
+class RegexDollarFormatter(text.DollarFormatter):
+  """DollarFormatter.parse as it was, before the single-pass scanner."""
+
+  _pattern = re.compile(r"(.*?)\$(\$?[\w\.]+)(?=([^']*'[^']*')*[^']*$)")
+
+  def parse(self, fmt_string):
+    for literal_txt, field_name, format_spec, conversion in (
+        string.Formatter.parse(self, fmt_string)):
+      continue_from = 0
+      txt = ''
+      for m in self._pattern.finditer(literal_txt):
+        new_txt, new_field = m.group(1, 2)
+        if new_field.startswith('$'):
+          txt += new_txt + new_field
+        else:
+          yield (txt + new_txt, new_field, '', None)
+          txt = ''
+        continue_from = m.end()
+      yield (txt + literal_txt[continue_from:], field_name, format_spec,
+             conversion)
+
+
+def test_dollar_parse_matches_regex():
+  # Newlines are left out: the regex dropped the text before a newline.
+  alphabet = u"ab_1.$$$''' \"{}é-"
+  rng = random.Random(1234)
+  old = RegexDollarFormatter()
+  new = text.DollarFormatter()
+  for _ in range(5000):
+    fmt = ''.join(rng.choice(alphabet) for _ in range(rng.randint(0, 24)))
+    try:
+      expected = list(old.parse(fmt))
+    except ValueError:
+      with pytest.raises(ValueError):
+        list(new.parse(fmt))
+      continue
+    assert list(new.parse(fmt)) == expected, fmt
+
+
+@pytest.mark.parametrize('fmt,expected', [
+  ("echo $a '$b' $c", [('echo ', 'a', '', None), (" '$b' ", 'c', '', None),
+                       ('', None, None, None)]),
+  ("$a isn't", [("$a isn't", None, None, None)]),
+  ('$$a $a.b$', [('$a ', 'a.b', '', None), ('$', None, None, None)]),
+  ('one\ntwo $x', [('one\ntwo ', 'x', '', None), ('', None, None, None)]),
+])
+def test_dollar_parse(fmt, expected):
+  assert list(text.DollarFormatter().parse(fmt)) == expected
@@ -0,0 +1,123 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import pytest
+
+from pysh import runtime
+
+
+SCRIPT = '''\
+n = 3
+out = !seq $n
+!seq 10 | sort -r | head -2 >/dev/null
+!false
+'''
+
+
+def _run_traced(temp_dir, trace_file, use_env):
+  script_file = os.path.join(temp_dir, 'test.pysh')
+  with open(script_file, 'w') as script_f:
+    script_f.write(SCRIPT)
+
+  env = dict(os.environ)
+  env['PYTHONPATH'] = os.getcwd()
+  env['PYSH_NO_CACHE'] = '1'
+  argv = [sys.executable, '-mpysh', 'run', script_file]
+  if use_env:
+    env['PYSH_TRACE'] = trace_file
+  else:
+    argv[3:3] = ['--trace', trace_file]
+  proc = subprocess.Popen(argv, env=env, stderr=subprocess.PIPE)
+  _, stderr = proc.communicate()
+  assert proc.returncode == 1
+  assert b'CalledProcessError' in stderr
+  return script_file
+
+
+@pytest.mark.parametrize('use_env', [False, True])
+def test_trace_json_lines(use_env):
+  temp_dir = tempfile.mkdtemp()
+  try:
+    trace_file = os.path.join(temp_dir, 'trace.jsonl')
+    script_file = _run_traced(temp_dir, trace_file, use_env)
+    with open(trace_file) as trace_f:
+      spans = [json.loads(line) for line in trace_f]
+
+    assert [(s['cmd'], s['line'], s['status'], s['captured_bytes'])
+            for s in spans] == [
+      ('seq 3', 2, 0, 6),
+      ('seq 10 | sort -r | head -2 >/dev/null', 3, 0, None),
+      ('false', 4, 1, None),
+    ]
+    for span in spans:
+      assert span['file'] == script_file
+      assert span['start'] <= span['end']
+      assert span['utime'] >= 0 and span['stime'] >= 0
+      assert span['maxrss'] > 0
+  finally:
+    shutil.rmtree(temp_dir)
+
+
+def test_trace_chrome():
+  temp_dir = tempfile.mkdtemp()
+  try:
+    trace_file = os.path.join(temp_dir, 'trace.json')
+    _run_traced(temp_dir, trace_file, use_env=False)
+    with open(trace_file) as trace_f:
+      trace = json.load(trace_f)
+
+    events = trace['traceEvents']
+    assert [e['name'] for e in events] == [
+      'seq 3', 'seq 10 | sort -r | head -2 >/dev/null', 'false']
+    assert all(e['ph'] == 'X' and e['dur'] >= 0 for e in events)
+    assert events[0]['args']['line'] == 2
+  finally:
+    shutil.rmtree(temp_dir)
+
+
+def test_trace_pipeline_and_background():
+  temp_dir = tempfile.mkdtemp()
+  try:
+    tracer = runtime.start_tracing(os.path.join(temp_dir, 'trace.jsonl'))
+    spans = []
+    tracer.record = spans.append
+    stub = runtime.get_ipython()
+    stub.system('seq 10 | sort -r | head -2', expand=False)
+    job = stub.getoutput('seq 2', background=True, expand=False)
+    assert job.result() == '1\n2\n'
+    assert list(stub.getoutput('seq 2', capture='lines', expand=False)) == [
+      '1', '2']
+  finally:
+    runtime._TRACER.close()
+    runtime._TRACER = None
+    shutil.rmtree(temp_dir)
+
+  assert [(s.cmd, s.status, s.pipestatus, s.captured_bytes)
+          for s in spans] == [
+    ('seq 10 | sort -r | head -2', 0, [0, 0, 0], None),
+    ('seq 2', 0, None, 4),
+    ('seq 2', 0, None, 4),
+  ]
+  assert all(s.filename == __file__.replace('.pyc', '.py') for s in spans)
+
+
+def test_trace_shell_session():
+  temp_dir = tempfile.mkdtemp()
+  try:
+    tracer = runtime.start_tracing(os.path.join(temp_dir, 'trace.jsonl'))
+    spans = []
+    tracer.record = spans.append
+    stub = runtime.get_ipython()
+    with runtime.shell_session():
+      assert stub.getoutput('echo hi', expand=False) == 'hi\n'
+  finally:
+    runtime._TRACER.close()
+    runtime._TRACER = None
+    shutil.rmtree(temp_dir)
+
+  assert [(s.cmd, s.status, s.captured_bytes, s.rusage) for s in spans] == [
+    ('echo hi', 0, 3, None)]
@@ -0,0 +1,229 @@
+import random
+import pytest
+
+from pysh import runtime
+from pysh.ipython import inputtransformer2
+
+
+CORPUS = {
+  'plain_python': ('import sys\n'
+                   'print("hello")\n'),
+  'system': ('!echo hi\n'
+             '!!echo captured\n'),
+  'system_assign': ('x = !ls\n'
+                    'a, b = !echo a b\n'),
+  'nested_blocks': ('x = !ls\n'
+                    'if x:\n'
+                    '    !echo {x}\n'
+                    '    for y in x:\n'
+                    '        z = !echo $y\n'
+                    '!echo done\n'),
+  'tabs': ('if 1:\n'
+           '\tif 2:\n'
+           '\t\t!ls\n'
+           '\tx = !echo\n'
+           '!done\n'),
+  'unbalanced_quote': ("!echo 'it\n"
+                       'x = 1\n'
+                       '!echo "still\n'),
+  'unbalanced_paren': ('def f():\n'
+                       '    !echo (\n'
+                       '    return 1\n'
+                       '!echo )\n'),
+  'continued': ('!echo a \\\n'
+                '  b \\\n'
+                '  c\n'
+                'x = \\\n'
+                '  !ls\n'
+                'print(x)\n'),
+  'strings_and_comments': ('"""\n'
+                           '!not a command\n'
+                           '"""\n'
+                           '# !not a command either\n'
+                           'x = "!nope"\n'
+                           '!cmd\n'),
+  'magic_and_help': ('x = %magic arg\n'
+                     '%foo?\n'
+                     'foo?\n'
+                     '!echo 1?\n'
+                     '!echo 2\n'),
+  'brackets': ('x = [\n'
+               '!ls\n'
+               ']\n'
+               ')\n'
+               '(\n'
+               '!ls\n'),
+  'leading_indent': ('\n'
+                     '    !ls\n'
+                     '    x = !ls\n'),
+}
+
+
+_FRAGMENTS = [
+  '!ls\n', 'x = !echo {a}\n', 'if a:\n', '    !echo\n', '  y = 1\n', 'foo?\n',
+  '!echo "unterminated\n', 'z = (\n', ')\n', '!echo \\\n', '   more\n',
+  '%magic x\n', '\n', '# comment\n', '  \n', '"""s\n', '!echo 1?\n',
+  'b = %m\n', '\t!t\n', 'def f():\n', '    return 1\n', '!!cat\n',
+]
+
+
+def _random_cells(count, seed=1234):
+  rand = random.Random(seed)
+  for _ in range(count):
+    yield ''.join(rand.choice(_FRAGMENTS)
+                  for _ in range(rand.randint(1, 12)))
+
+
+def _transform(cell, single_pass):
+  manager = inputtransformer2.TransformerManager(single_pass=single_pass)
+  try:
+    return manager.transform_cell(cell)
+  except Exception as e:
+    return (type(e), str(e))
+
+
+@pytest.mark.parametrize('case_name', sorted(CORPUS.keys()))
+def test_engines_match(case_name):
+  cell = CORPUS[case_name]
+  assert _transform(cell, True) == _transform(cell, False)
+
+
+def test_engines_match_random():
+  for cell in _random_cells(500):
+    assert _transform(cell, True) == _transform(cell, False), cell
+
+
+def test_example_script():
+  with open('doc/example.pysh') as example_f:
+    cell = example_f.read()
+
+  transformed = _transform(cell, True)
+  assert transformed == _transform(cell, False)
+  assert "get_ipython().system('echo test')\n" in transformed
+  assert "foo_output = get_ipython().getoutput('echo foo')\n" in transformed
+
+
+@pytest.mark.parametrize('single_pass', [True, False])
+def test_continued_lines_keep_line_numbers(single_pass):
+  transformed = _transform(CORPUS['continued'], single_pass)
+  assert transformed.split('\n') == [
+    "get_ipython().system('echo a    b    c')", '', '',
+    'x = \\', "  get_ipython().getoutput('ls')",
+    'print(x)', '']
+
+
+def test_single_pass_has_no_total_limit():
+  cell = '!echo\n' * (inputtransformer2.TRANSFORM_LOOP_LIMIT + 1)
+  transformed = _transform(cell, True)
+  assert transformed == ("get_ipython().system('echo')\n" *
+                         (inputtransformer2.TRANSFORM_LOOP_LIMIT + 1))
+
+
+@pytest.mark.parametrize('line,expected', [
+  ('x = ![lines] ls -l\n',
+   "x = get_ipython().getoutput('ls -l', capture='lines')\n"),
+  ('!![lines]find .\n',
+   "get_ipython().getoutput('find .', capture='lines')\n"),
+  ('x = ![ -f x ] && echo y\n',
+   "x = get_ipython().getoutput('[ -f x ] && echo y')\n"),
+  ('x = ![nosuchmodifier] ls\n',
+   "x = get_ipython().getoutput('[nosuchmodifier] ls')\n"),
+  ('![lines] ls\n', "get_ipython().system('[lines] ls')\n"),
+  ('data = ![bytes] cat x.bin\n',
+   "data = get_ipython().getoutput('cat x.bin', capture='bytes')\n"),
+  ('log = ![bounded] make\n',
+   "log = get_ipython().getoutput('make', capture='bounded')\n"),
+  ('out, err = ![both,tee] make\n',
+   "out, err = get_ipython().getoutput('make', capture='both', tee=True)\n"),
+  ('out = ![stdin=rows,lines] sort\n',
+   "out = get_ipython().getoutput('sort', stdin=rows, capture='lines')\n"),
+  ('![stdin=self.rows] gzip >x.gz &\n',
+   "get_ipython().system('gzip >x.gz', stdin=self.rows, background=True)\n"),
+  ('![stdin=1x] cat\n', "get_ipython().system('[stdin=1x] cat')\n"),
+  ('![stdin=rows,lines] cat\n',
+   "get_ipython().system('[stdin=rows,lines] cat')\n"),
+  ('data = ![mmap] cat x.bin &\n',
+   "data = get_ipython().getoutput('cat x.bin', capture='mmap', "
+   "background=True)\n"),
+])
+def test_capture_modifiers(line, expected):
+  assert _transform(line, True) == expected
+
+
+@pytest.mark.parametrize('line,expected', [
+  ('!make a &\n', "get_ipython().system('make a', background=True)\n"),
+  ('j = !make b  & \n',
+   "j = get_ipython().getoutput('make b', background=True)\n"),
+  ('!!make c&\n', "get_ipython().getoutput('make c', background=True)\n"),
+  ('!a 2>&1 &\n', "get_ipython().system('a 2>&1', background=True)\n"),
+  ('!a && b\n', "get_ipython().system('a && b')\n"),
+  ('!echo \\&\n', "get_ipython().system('echo \\\\&')\n"),
+])
+def test_background(line, expected):
+  assert _transform(line, True) == expected
+
+
+class _Obj(object):
+  attr = 'A'
+
+
+EXPANSION_NAMESPACE = {'x': 'X', 'l': [1, 2, 3], 'd': {'k': 1}, 'obj': _Obj()}
+
+
+@pytest.mark.parametrize('cmd', [
+  'echo plain',
+  'echo {x} $x $$x {{x}}',
+  'echo {l[1:3]} {d!r} {d["k"]} {len(l) * 2}',
+  'echo $obj.attr {obj.attr!s}',
+  "echo '$x' $x '{x}'",
+  "awk '{print $1}'",
+  'echo {',
+  'echo }',
+  'echo {missing} {x}',
+  'echo {x:>5}',
+  'echo {x!z}',
+  'echo {x # comment}',
+  'echo { x} {\tx}',
+])
+def test_compile_time_expansion_matches_runtime(cmd):
+  args = inputtransformer2._command_args(cmd, True)
+  if args[-1] != 'expand=False':
+    # Left for the runtime to expand.
+    assert args == [repr(cmd)]
+    return
+
+  ns = dict(EXPANSION_NAMESPACE, get_ipython=runtime.get_ipython)
+  assert eval(args[0], ns) == runtime._expand(
+    runtime._dollar_formatter(), cmd, dict(EXPANSION_NAMESPACE))
+
+
+def test_runtime_expansion_mode():
+  manager = inputtransformer2.TransformerManager(compile_time_expansion=False)
+  assert manager.transform_cell('!echo {x}\ny = !ls $d\n') == (
+    "get_ipython().system('echo {x}')\n"
+    "y = get_ipython().getoutput('ls $d')\n")
+
+
+def test_class_body_expands_at_runtime():
+  manager = inputtransformer2.TransformerManager(compile_time_expansion=True)
+  out = manager.transform_cell(
+    'class C:\n'
+    '    x = "classattr"\n'
+    '    !echo {x}\n'
+    '    y = !echo $x\n'
+    '    def f(self):\n'
+    '        !echo {x}\n'
+    '!echo {x}\n')
+  lines = out.splitlines()
+  assert lines[2] == "    get_ipython().system('echo {x}')"
+  assert lines[3] == "    y = get_ipython().getoutput('echo $x')"
+  assert 'expand=False' in lines[5]
+  assert 'expand=False' in lines[6]
+
+  # And the class attribute is expanded.
+  stub = runtime.get_ipython()
+  ns = {'get_ipython': lambda: stub}
+  exec(manager.transform_cell('class C:\n'
+                              '    x = "classattr"\n'
+                              '    y = !echo {x}\n'), ns)
+  assert ns['C'].y == 'classattr\n'